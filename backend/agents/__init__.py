@@ -1,11 +1,32 @@
-from .researcher import ResearcherAgent
-from .recommender import RecommenderAgent
-from .itinerary_generator import ItineraryGeneratorAgent
-from .formatter import FormatterAgent
-
-__all__ = [
-    "ResearcherAgent",
-    "RecommenderAgent",
-    "ItineraryGeneratorAgent",
-    "FormatterAgent",
-]
+"""
+The agents implementing the itinerary pipeline stages.
+
+Agent classes are imported from their modules on first access, and the
+modules load their heavy dependencies and API clients on first use, so
+importing this package is cheap.
+"""
+
+import importlib
+
+from dotenv import load_dotenv
+
+# Load environment variables from a .env file before any agent module reads them
+load_dotenv()
+
+# Agent class name -> module defining it
+_AGENT_MODULES = {
+    "ResearcherAgent": ".researcher",
+    "ResearchCompactorAgent": ".compactor",
+    "RecommenderAgent": ".recommender",
+    "ItineraryGeneratorAgent": ".itinerary_generator",
+    "FormatterAgent": ".formatter",
+    "MapperAgent": ".mapper",
+}
+
+__all__ = list(_AGENT_MODULES)
+
+
+def __getattr__(name: str):
+    if name in _AGENT_MODULES:
+        return getattr(importlib.import_module(_AGENT_MODULES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,190 @@
+"""
+Caching primitives shared by the agents: a persistent TTL/LRU key-value store
+backed by SQLite, and single-flight coalescing of concurrent identical calls.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = os.getenv(
+    "CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(__file__)), ".cache")
+)
+
+
+def make_key(*parts) -> str:
+    """
+    Builds a stable cache key from JSON-serialisable parts.
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    A persistent key-value cache stored in a SQLite file.
+
+    Entries expire ``ttl`` seconds after they were written. Expired entries are
+    kept for a further ``stale_ttl`` seconds so callers can serve them while
+    refreshing (see ``get_entry``). When the cache holds more than
+    ``max_entries`` items, the least recently used ones are evicted.
+    Values must be JSON-serialisable.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, stale_ttl: float = 0):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache
+               (key TEXT PRIMARY KEY, value TEXT, created_at REAL, accessed_at REAL)"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get_entry(self, key: str):
+        """
+        Returns ``(value, age)`` for ``key`` without applying the TTL, or None if
+        the entry is missing or older than ``ttl + stale_ttl``. Does not update
+        the hit/miss counters.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl + self.stale_ttl:
+                return None
+            self._conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+        return json.loads(row[0]), now - row[1]
+
+    def get(self, key: str):
+        """
+        Returns the cached value for ``key``, or None if it is missing or expired.
+        """
+        entry = self.get_entry(key)
+        if entry is None or entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value):
+        """
+        Stores ``value`` under ``key`` and evicts expired and least recently used entries.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM cache WHERE created_at < ?",
+                (now - self.ttl - self.stale_ttl,),
+            )
+            self._conn.execute(
+                """DELETE FROM cache WHERE key IN
+                   (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    async def aget(self, key: str):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aget_entry(self, key: str):
+        return await asyncio.to_thread(self.get_entry, key)
+
+    async def aset(self, key: str, value):
+        await asyncio.to_thread(self.set, key, value)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters and the current size of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+
+    The first caller for a key starts the coroutine as a task; callers arriving
+    while it is still in flight await the same result (or exception) instead of
+    starting their own. A caller that is cancelled stops waiting, and the task
+    is cancelled once no caller is waiting for it.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, fn):
+        """
+        Runs ``fn()`` for ``key`` unless a call for that key is already in flight.
+
+        Args:
+            key (str): The coalescing key.
+            fn: A zero-argument callable returning an awaitable.
+        """
+        call = self._inflight.get(key)
+        if call is not None:
+            self.coalesced += 1
+        else:
+            call = self._inflight[key] = {
+                "task": asyncio.ensure_future(fn()),
+                "waiters": 0,
+            }
+
+            def forget(_):
+                if self._inflight.get(key) is call:
+                    del self._inflight[key]
+
+            call["task"].add_done_callback(forget)
+
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"])
+        finally:
+            call["waiters"] -= 1
+            if not call["waiters"] and not call["task"].done():
+                call["task"].cancel()
@@ -0,0 +1,48 @@
+"""
+Upstream API clients shared by the whole process, created on first use.
+
+Each module registers a factory for the client it needs at import time; the
+client, and the SDK behind it, is only built when ``get_client`` is first
+called. This keeps imports cheap, so the API starts accepting requests sooner.
+"""
+
+import threading
+
+_factories = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def register_client(name: str, factory):
+    """
+    Registers the zero-argument callable that builds the client ``name``.
+    """
+    _factories[name] = factory
+
+
+def get_client(name: str):
+    """
+    Returns the shared client ``name``, building it on first use.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = _factories[name]()
+    return client
+
+
+def set_client(name: str, client):
+    """
+    Replaces the shared client ``name``, e.g. with a fake in benchmarks.
+    """
+    _clients[name] = client
+
+
+def warm_up_clients():
+    """
+    Builds every registered client that has not been built yet.
+    """
+    for name in list(_factories):
+        get_client(name)
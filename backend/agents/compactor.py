@@ -0,0 +1,287 @@
+"""
+Compaction of research results before they are pasted into the recommender
+prompt.
+
+Search results for overlapping queries repeat the same pages and the same
+passages, and page extracts carry navigation and cookie-banner boilerplate.
+The compactor deduplicates results by URL and by near-duplicate content,
+strips boilerplate sentences, ranks what is left by relevance to the user's
+interests, and keeps the best snippets within a token budget.
+"""
+
+import logging
+import os
+import re
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+# Maximum number of tokens of research context sent to the recommender
+RESEARCH_TOKEN_BUDGET = int(os.getenv("RESEARCH_TOKEN_BUDGET", 6000))
+# Share of the budget reserved for accommodation results
+ACCOMM_BUDGET_SHARE = float(os.getenv("ACCOMM_BUDGET_SHARE", 0.25))
+# Maximum number of tokens kept from a single result
+SNIPPET_MAX_TOKENS = int(os.getenv("SNIPPET_MAX_TOKENS", 300))
+# Results sharing at least this fraction of word 5-grams are near-duplicates
+DUPLICATE_THRESHOLD = 0.6
+
+# Whole banner and navigation phrases, so that sentences merely mentioning a
+# cookie or a catalog are kept
+BOILERPLATE = re.compile(
+    r"\b(?:(?:accept|allow|reject|manage)(?: all)? cookies"
+    r"|(?:site|website) uses cookies|cookie (?:policy|settings|preferences)"
+    r"|privacy policy|terms (?:of|and) (?:use|service|conditions)"
+    r"|all rights reserved|subscribe to our|sign up for (?:our|the) newsletter"
+    r"|(?:sign|log) ?in to|skip to (?:main )?content|click here|enable javascript"
+    r"|your browser (?:does not|doesn't) support|share this (?:page|article|post)"
+    r"|follow us on|copyright (?:© ?)?\d{4})\b|© ?\d{4}",
+    re.IGNORECASE,
+)
+MARKUP = re.compile(r"!?\[([^\]]*)\]\([^)]*\)|https?://\S+|[#*_`|>]+")
+SENTENCE = re.compile(r"(?<=[.!?])\s+|\n+")
+WORD = re.compile(r"[a-z0-9]+")
+STOPWORDS = {"a", "an", "and", "the", "of", "in", "to", "for", "on", "with", "at"}
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        logger.warning("tiktoken encoding unavailable, estimating token counts: %r", e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts gpt-4o tokens, or estimates them at four characters per token when
+    the tokenizer is unavailable.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Truncates text to at most ``max_tokens`` tokens, at a word boundary.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _encoding()
+    if encoding is None:
+        text = text[: max_tokens * 4]
+    else:
+        text = encoding.decode(
+            encoding.encode(text, disallowed_special=())[:max_tokens]
+        )
+    return text.rsplit(" ", 1)[0] + " ..."
+
+
+def normalize_url(url: str) -> str:
+    """
+    Reduces a URL to host and path, without "www." or a trailing slash.
+    """
+    parts = urlsplit(url.strip().lower())
+    host = parts.netloc.removeprefix("www.")
+    return f"{host}{parts.path.rstrip('/')}"
+
+
+def words(text: str) -> list:
+    return WORD.findall(text.lower())
+
+
+def shingles(text: str, size: int = 5) -> set:
+    tokens = words(text)
+    return {tuple(tokens[i : i + size]) for i in range(max(1, len(tokens) - size + 1))}
+
+
+class ResearchCompactorAgent:
+    """
+    Shrinks the research results to the most relevant, non-redundant content
+    within a token budget, preserving their structure.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = RESEARCH_TOKEN_BUDGET,
+        accomm_share: float = ACCOMM_BUDGET_SHARE,
+        snippet_max_tokens: int = SNIPPET_MAX_TOKENS,
+    ):
+        self.token_budget = token_budget
+        self.accomm_share = accomm_share
+        self.snippet_max_tokens = snippet_max_tokens
+        self.totals = {"requests": 0, "tokens_before": 0, "tokens_after": 0}
+
+    def warm_up(self):
+        """
+        Loads the tokenizer ahead of the first request.
+        """
+        _encoding()
+
+    def clean(self, content: str, seen_sentences: set) -> str:
+        """
+        Removes markup, boilerplate and sentences already seen in other results.
+        """
+        kept = []
+        for sentence in SENTENCE.split(MARKUP.sub(r"\1", content or "")):
+            sentence = " ".join(sentence.split())
+            key = " ".join(words(sentence))
+            if len(key) < 20 or BOILERPLATE.search(sentence) or key in seen_sentences:
+                continue
+            seen_sentences.add(key)
+            kept.append(sentence)
+        return " ".join(kept)
+
+    def relevance(self, result: dict, terms: set) -> float:
+        """
+        Scores a result by the search engine's score and by how many of the
+        interest terms it mentions.
+        """
+        found = set(words(f"{result.get('title', '')} {result['content']}"))
+        coverage = len(terms & found) / len(terms) if terms else 0.0
+        return 0.5 * float(result.get("score") or 0) + 0.5 * coverage
+
+    def compact(self, groups: list, terms: set, budget: int) -> list:
+        """
+        Compacts groups of results (one group per search query) to fit ``budget``.
+
+        Args:
+            groups (list): Lists of Tavily results ("url", "title", "content", "score").
+            terms (set): Words describing the user's interests.
+            budget (int): Maximum number of tokens across all kept results.
+
+        Returns:
+            list: The groups, in their original order, holding only the kept
+            results in order of relevance, each with "title", "url" and "content".
+        """
+        # Deduplicate by URL, keeping the highest scored copy
+        by_url = {}
+        for group_index, group in enumerate(groups):
+            for result in group:
+                key = normalize_url(result.get("url", ""))
+                best = by_url.get(key)
+                if best is None or (result.get("score") or 0) > (
+                    best[1].get("score") or 0
+                ):
+                    by_url[key] = (group_index, result)
+
+        # Clean content and rank, most relevant first
+        seen_sentences = set()
+        candidates = []
+        for group_index, result in sorted(
+            by_url.values(), key=lambda r: -(r[1].get("score") or 0)
+        ):
+            content = self.clean(result.get("content"), seen_sentences)
+            if not content:
+                continue
+            candidate = {
+                "title": result.get("title", ""),
+                "url": result.get("url", ""),
+                "content": content,
+                "score": result.get("score"),
+            }
+            candidates.append(
+                (self.relevance(candidate, terms), group_index, candidate)
+            )
+        candidates.sort(key=lambda c: -c[0])
+
+        # Drop near-duplicates of better ranked results, then fill the budget
+        compacted = [[] for _ in groups]
+        kept_shingles = []
+        remaining = budget
+        for _, group_index, candidate in candidates:
+            candidate_shingles = shingles(candidate["content"])
+            if any(
+                len(candidate_shingles & s) / len(candidate_shingles | s)
+                >= DUPLICATE_THRESHOLD
+                for s in kept_shingles
+            ):
+                continue
+            if remaining < 50:
+                break
+            content = truncate_tokens(
+                candidate["content"], min(self.snippet_max_tokens, remaining)
+            )
+            cost = count_tokens(f"{candidate['title']} {candidate['url']} {content}")
+            if cost > remaining:
+                continue
+            remaining -= cost
+            kept_shingles.append(candidate_shingles)
+            compacted[group_index].append(
+                {
+                    "title": candidate["title"],
+                    "url": candidate["url"],
+                    "content": content,
+                }
+            )
+        return compacted
+
+    def run(self, travel_info: dict) -> dict:
+        """
+        Replaces the research results in ``travel_info`` with their compacted
+        form and records the token savings under "research_compaction".
+
+        Args:
+            travel_info (dict): The output of the research stage.
+
+        Returns:
+            dict: The same travel information with compacted research results.
+        """
+        user_prefs = travel_info["user_form_submission"]
+        terms = {
+            w for interest in user_prefs["interests"] for w in words(interest)
+        } - STOPWORDS
+        activity_results = travel_info["activity_research_results"]
+        accomm_results = travel_info["accomm_research_results"]
+        tokens_before = count_tokens(f"{activity_results}\n{accomm_results}")
+
+        accomm_budget = int(self.token_budget * self.accomm_share)
+        travel_info["activity_research_results"] = [
+            group
+            for group in self.compact(
+                activity_results, terms, self.token_budget - accomm_budget
+            )
+            if group
+        ]
+        travel_info["accomm_research_results"] = {
+            **accomm_results,
+            "results": self.compact(
+                [accomm_results.get("results", [])],
+                terms | set(words(user_prefs["accomm_type"])),
+                accomm_budget,
+            )[0],
+        }
+
+        tokens_after = count_tokens(
+            f"{travel_info['activity_research_results']}\n"
+            f"{travel_info['accomm_research_results']}"
+        )
+        travel_info["research_compaction"] = {
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "tokens_saved": max(0, tokens_before - tokens_after),
+        }
+        self.totals["requests"] += 1
+        self.totals["tokens_before"] += tokens_before
+        self.totals["tokens_after"] += tokens_after
+        logger.debug(
+            "Research compacted",
+            extra={"tokens_before": tokens_before, "tokens_after": tokens_after},
+        )
+        return travel_info
+
+    def stats(self) -> dict:
+        """
+        Returns the token counts before and after compaction, summed over requests.
+        """
+        return {
+            **self.totals,
+            "tokens_saved": max(
+                0, self.totals["tokens_before"] - self.totals["tokens_after"]
+            ),
+        }
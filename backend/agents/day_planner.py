@@ -0,0 +1,148 @@
+"""
+Deterministic, geography-aware splitting of activities into itinerary days.
+
+Activities with coordinates are clustered by proximity into balanced days
+(sizes differ by at most one), each day is ordered to minimise walking/driving
+distance with a nearest-neighbour tour improved by 2-opt, and the days
+themselves are ordered so that consecutive days cover neighbouring areas.
+Activities without coordinates fill the lightest days.
+"""
+
+import math
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Kilometres per degree of latitude
+KM_PER_DEGREE = 111.32
+
+
+def has_coordinates(activity: dict) -> bool:
+    return isinstance(activity.get("lat"), (int, float)) and isinstance(
+        activity.get("lng"), (int, float)
+    )
+
+
+def project(activities: list) -> np.ndarray:
+    """
+    Projects the activities' coordinates onto a plane in kilometres. The
+    equirectangular approximation is accurate enough at city scale.
+    """
+    lat = np.array([a["lat"] for a in activities], dtype=float)
+    lng = np.array([a["lng"] for a in activities], dtype=float)
+    scale = math.cos(math.radians(lat.mean()))
+    return np.column_stack([lng * scale, lat]) * KM_PER_DEGREE
+
+
+def balanced_clusters(points: np.ndarray, k: int, iterations: int = 20) -> list:
+    """
+    Partitions points into ``k`` clusters of near-equal size, k-means style,
+    solving each assignment step exactly as a transportation problem.
+
+    Returns:
+        list: For each cluster, the indices of its points.
+    """
+    n = len(points)
+    # Farthest-point initialisation, starting from the most outlying point
+    centre = points.mean(axis=0)
+    seeds = [int(np.argmax(((points - centre) ** 2).sum(axis=1)))]
+    while len(seeds) < k:
+        distances = ((points[:, None] - points[seeds][None]) ** 2).sum(axis=2)
+        seeds.append(int(np.argmax(distances.min(axis=1))))
+    centres = points[seeds]
+
+    # Cluster i may take sizes[i] points; each becomes sizes[i] assignment slots
+    sizes = [n // k + (1 if i < n % k else 0) for i in range(k)]
+    slot_cluster = np.repeat(np.arange(k), sizes)
+    labels = None
+    for _ in range(iterations):
+        cost = ((points[:, None] - centres[slot_cluster][None]) ** 2).sum(axis=2)
+        rows, cols = linear_sum_assignment(cost)
+        new_labels = np.empty(n, dtype=int)
+        new_labels[rows] = slot_cluster[cols]
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        centres = np.array([points[labels == i].mean(axis=0) for i in range(k)])
+
+    return [list(np.flatnonzero(labels == i)) for i in range(k)]
+
+
+def path_length(order: list, distances: np.ndarray) -> float:
+    return sum(distances[a, b] for a, b in zip(order, order[1:]))
+
+
+def shortest_path(points: np.ndarray) -> list:
+    """
+    Orders points into a short open path: the best nearest-neighbour tour over
+    all starting points, refined with 2-opt.
+
+    Returns:
+        list: The indices of the points in visiting order.
+    """
+    n = len(points)
+    if n <= 2:
+        return list(range(n))
+    distances = np.sqrt(((points[:, None] - points[None]) ** 2).sum(axis=2))
+
+    best = None
+    for start in range(n):
+        order, remaining = [start], set(range(n)) - {start}
+        while remaining:
+            nearest = min(remaining, key=lambda j: distances[order[-1], j])
+            order.append(nearest)
+            remaining.remove(nearest)
+        if best is None or path_length(order, distances) < path_length(best, distances):
+            best = order
+
+    # 2-opt: reverse any segment whose reversal shortens the path
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            for j in range(i + 2, n):
+                before = distances[best[i], best[i + 1]]
+                after = distances[best[i], best[j]]
+                if j + 1 < n:
+                    before += distances[best[j], best[j + 1]]
+                    after += distances[best[i + 1], best[j + 1]]
+                if after < before - 1e-9:
+                    best[i + 1 : j + 1] = best[i + 1 : j + 1][::-1]
+                    improved = True
+    return best
+
+
+def plan_days(activities: list, num_days: int) -> list:
+    """
+    Splits activities into ``num_days`` days, grouping nearby activities and
+    ordering each day to reduce travel.
+
+    Args:
+        activities (list): Activity recommendations, optionally with numeric
+            "lat" and "lng" keys.
+        num_days (int): The length of the trip.
+
+    Returns:
+        list: ``num_days`` lists of activities, in visiting order. Days may be
+        empty when there are fewer activities than days.
+    """
+    num_days = max(1, num_days)
+    located = [a for a in activities if has_coordinates(a)]
+    unlocated = [a for a in activities if not has_coordinates(a)]
+
+    days = [[] for _ in range(num_days)]
+    if located:
+        points = project(located)
+        k = min(num_days, len(located))
+        clusters = balanced_clusters(points, k)
+        centroids = np.array([points[c].mean(axis=0) for c in clusters])
+        # Order the days so that consecutive days cover neighbouring areas
+        for slot, cluster_index in enumerate(shortest_path(centroids)):
+            cluster = clusters[cluster_index]
+            order = shortest_path(points[cluster])
+            days[slot] = [located[cluster[i]] for i in order]
+
+    # Activities without coordinates go to the lightest days
+    for activity in unlocated:
+        min(days, key=len).append(activity)
+    return days
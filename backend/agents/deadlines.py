@@ -0,0 +1,118 @@
+"""
+Time limits for pipeline runs.
+
+Each run has an overall budget of ``REQUEST_BUDGET`` seconds, bound with
+``request_budget``, and each stage a deadline of its own (``STAGE_TIMEOUTS``).
+A stage gets whichever runs out first. When it does, the stage is cancelled,
+which aborts its in-flight upstream calls, and fails with ``DeadlineExceeded``.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+def parse_timeouts(spec: str) -> dict:
+    """
+    Parses "stage=seconds" pairs separated by commas.
+    """
+    timeouts = {}
+    for pair in filter(None, (p.strip() for p in spec.split(","))):
+        stage, _, seconds = pair.partition("=")
+        timeouts[stage.strip()] = float(seconds)
+    return timeouts
+
+
+# Seconds a whole pipeline run may take; 0 for no limit
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", 300))
+# Seconds each stage may take; stages not listed take STAGE_TIMEOUT (0: no limit)
+STAGE_TIMEOUTS = parse_timeouts(
+    os.getenv(
+        "STAGE_TIMEOUTS",
+        "research=60,compact=30,recommend=120,map=60,generate_itinerary=120,format=30",
+    )
+)
+STAGE_TIMEOUT = float(os.getenv("STAGE_TIMEOUT", 0))
+
+# When the current run's budget runs out, in time.monotonic() seconds
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    A pipeline stage ran out of time.
+    """
+
+
+@contextmanager
+def request_budget(seconds: float = REQUEST_BUDGET):
+    """
+    Sets the time budget of the pipeline run in this context.
+
+    Args:
+        seconds (float, optional): The budget; 0 for no limit. Defaults to
+            ``REQUEST_BUDGET``.
+    """
+    token = deadline.set(time.monotonic() + seconds if seconds > 0 else None)
+    try:
+        yield
+    finally:
+        deadline.reset(token)
+
+
+def stage_timeout(stage: str) -> float:
+    """
+    Returns the seconds the stage may run for now, or None if unlimited.
+    """
+    timeout = STAGE_TIMEOUTS.get(stage, STAGE_TIMEOUT) or None
+    end = deadline.get()
+    if end is not None:
+        left = end - time.monotonic()
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+def with_deadline(stage: str, fn):
+    """
+    Wraps a pipeline node so that it fails with ``DeadlineExceeded`` once its
+    stage deadline or the run's budget has passed. Synchronous nodes cannot be
+    interrupted, so they are only checked before they start.
+    """
+
+    def expired(timeout: float) -> DeadlineExceeded:
+        return DeadlineExceeded(
+            f"The {stage} stage did not finish within its {max(timeout, 0):.1f}s deadline"
+        )
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def run_async(state):
+            timeout = stage_timeout(stage)
+            if timeout is None:
+                return await fn(state)
+            if timeout <= 0:
+                raise expired(timeout)
+            scope = asyncio.timeout(timeout)
+            try:
+                async with scope:
+                    return await fn(state)
+            except TimeoutError:
+                if scope.expired():
+                    raise expired(timeout) from None
+                raise
+
+        return run_async
+
+    @wraps(fn)
+    def run(state):
+        timeout = stage_timeout(stage)
+        if timeout is not None and timeout <= 0:
+            raise expired(timeout)
+        return fn(state)
+
+    return run
@@ -1,9 +1,60 @@
-import numpy as np
-from dotenv import load_dotenv
-from scipy.optimize import linear_sum_assignment
-from thefuzz import fuzz
+import logging
+import os
+import re
+from urllib.parse import unquote
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Minimum similarity (0-100) for an image to be assigned to a name
+IMAGE_MATCH_THRESHOLD = float(os.getenv("IMAGE_MATCH_THRESHOLD", 60))
+# With many images per name, only this many coarse-ranked candidates per name
+# are scored in full
+IMAGE_MATCH_CANDIDATES = int(os.getenv("IMAGE_MATCH_CANDIDATES", 10))
+# Score matrices up to this many name-URL pairs, e.g. a few accommodations and
+# their images, are assigned greedily without numpy and scipy
+IMAGE_MATCH_GREEDY_PAIRS = int(os.getenv("IMAGE_MATCH_GREEDY_PAIRS", 100))
+
+WORD = re.compile(r"[a-z]+[a-z0-9]*|[0-9]+[a-z][a-z0-9]*")
+DIMENSIONS = re.compile(r"\d+x\d+")
+# Words in image paths that say nothing about what the image shows
+NOISE_WORDS = {
+    "jpg",
+    "jpeg",
+    "png",
+    "gif",
+    "webp",
+    "avif",
+    "svg",
+    "scaled",
+    "max",
+    "min",
+    "thumb",
+    "thumbnail",
+    "small",
+    "medium",
+    "large",
+}
+
+
+def url_tokens(url: str) -> str:
+    """
+    Reduces an image URL to the words in its filename, or in the rest of its
+    path if the filename has none, e.g.
+    "https://cdn.example.com/uploads/hotel-de-crillon-1024x768.jpg?v=2" becomes
+    "hotel de crillon".
+    """
+    path = url.split("?", 1)[0].split("#", 1)[0]
+    path = unquote(path.split("//", 1)[-1].partition("/")[2]).lower()
+    directory, _, filename = path.rpartition("/")
+    for part in (filename, directory):
+        words = [
+            w
+            for w in WORD.findall(part)
+            if w not in NOISE_WORDS and not DIMENSIONS.fullmatch(w)
+        ]
+        if words:
+            return " ".join(words)
+    return ""
 
 
 class FormatterAgent:
@@ -11,10 +62,40 @@ class FormatterAgent:
     This agent takes the generated itinerary and formats it into the final response format to be sent to the user.
     """
 
+    def __init__(
+        self,
+        match_threshold: float = IMAGE_MATCH_THRESHOLD,
+        match_candidates: int = IMAGE_MATCH_CANDIDATES,
+        greedy_pairs: int = IMAGE_MATCH_GREEDY_PAIRS,
+        placeholder_image: str = None,
+    ):
+        self.match_threshold = match_threshold
+        self.match_candidates = match_candidates
+        self.greedy_pairs = greedy_pairs
+        # Image used for names with no sufficiently similar URL
+        self.placeholder_image = placeholder_image
+
+    def warm_up(self):
+        """
+        Imports the matching libraries ahead of the first request.
+        """
+        import numpy
+        import rapidfuzz.process
+        import scipy.optimize
+
     def match_names_to_urls(self, names: list, urls: list) -> dict:
         """
         Matches names to URLs based on similarity scores using the Hungarian algorithm.
 
+        URLs are reduced to their path and filename words (see ``url_tokens``).
+        Small matrices (up to ``greedy_pairs`` pairs) are scored with a
+        whole-string ratio and assigned greedily, best pair first. Larger ones
+        are scored against all names in one batched call; for large image sets,
+        a cheap whole-string ratio first narrows the URLs down to the
+        ``match_candidates`` best per name. There may be more names than URLs or
+        vice versa; names left unassigned, or whose assignment scores below
+        ``match_threshold``, map to ``placeholder_image``.
+
         Args:
             names (list): List of names to match.
             urls (list): List of URLs to match with names.
@@ -22,26 +103,69 @@ class FormatterAgent:
         Returns:
             dict: A dictionary mapping each name to the best matching URL.
         """
-        # Create a similarity score matrix
-        score_matrix = np.zeros((len(names), len(urls)))
-        print("Score matrix: ", score_matrix)
-        # Compute the similarity scores
-        for i, name in enumerate(names):
-            for j, url in enumerate(urls):
-                score_matrix[i, j] = fuzz.ratio(name, url)
+        name_to_url_mapping = dict.fromkeys(names, self.placeholder_image)
+        if not names or not urls:
+            return name_to_url_mapping
 
-        # Apply the Hungarian algorithm to find the optimal assignment
-        row_ind, col_ind = linear_sum_assignment(score_matrix, maximize=True)
+        from rapidfuzz import fuzz, utils
+
+        processed_names = [utils.default_process(name) for name in names]
+        tokens = [url_tokens(url) for url in urls]
+        if len(names) * len(urls) <= self.greedy_pairs:
+            pairs = sorted(
+                (
+                    (fuzz.ratio(name, t, score_cutoff=self.match_threshold), i, j)
+                    for i, name in enumerate(processed_names)
+                    for j, t in enumerate(tokens)
+                ),
+                reverse=True,
+            )
+            assigned_names, assigned_urls = set(), set()
+            for score, i, j in pairs:
+                if score < self.match_threshold:
+                    break
+                if i in assigned_names or j in assigned_urls:
+                    continue
+                assigned_names.add(i)
+                assigned_urls.add(j)
+                name_to_url_mapping[names[i]] = urls[j]
+            return name_to_url_mapping
+
+        import numpy as np
+        from rapidfuzz import process
+        from scipy.optimize import linear_sum_assignment
+
+        # Keep the coarse top candidates of each name
+        candidates = np.arange(len(urls))
+        if len(urls) > self.match_candidates * len(names):
+            coarse = process.cdist(
+                [name.replace(" ", "") for name in processed_names],
+                [t.replace(" ", "") for t in tokens],
+                scorer=fuzz.ratio,
+                dtype=np.int16,
+            )
+            candidates = np.unique(
+                np.argpartition(-coarse, self.match_candidates, axis=1)[
+                    :, : self.match_candidates
+                ]
+            )
 
-        print("The assignment is: ", row_ind, col_ind)
+        # Similarity score matrix, shape (len(names), len(candidates))
+        score_matrix = process.cdist(
+            processed_names,
+            [tokens[j] for j in candidates],
+            scorer=fuzz.partial_ratio,
+            score_cutoff=self.match_threshold,
+            dtype=np.float32,
+        )
 
-        name_to_url_mapping = {}
-        used_urls = set()
+        # Apply the Hungarian algorithm to find the optimal assignment
+        row_ind, col_ind = linear_sum_assignment(score_matrix, maximize=True)
 
         # Create the name to URL mapping
         for i, j in zip(row_ind, col_ind):
-            name_to_url_mapping[names[i]] = urls[j]
-            used_urls.add(urls[j])
+            if score_matrix[i, j] >= self.match_threshold:
+                name_to_url_mapping[names[i]] = urls[candidates[j]]
 
         return name_to_url_mapping
 
@@ -78,7 +202,10 @@ class FormatterAgent:
                 [k["name"] for k in travel_info["accomm_recs"]],
                 travel_info["accomm_research_results"]["images"],
             )
-            print("Did the mapping: ", accomm_name_url_mapping)
+            logger.debug(
+                "Matched accommodation images",
+                extra={"payload": accomm_name_url_mapping},
+            )
 
             # Format accommodation recommendations with image URLs
             formatted_accomm_recs = [
@@ -90,15 +217,11 @@ class FormatterAgent:
                 for k in travel_info["accomm_recs"]
             ]
 
-            print("Formatted Accommodation Recommendations: ", formatted_accomm_recs)
-
             # Remove 'id' keys from itinerary activities
             formatted_itinerary = self.remove_ids_from_itinerary_activities(
                 travel_info["itinerary"]
             )
 
-            print("Formatted Itinerary: ", formatted_itinerary)
-
             # Combine formatted accommodations and itinerary into the final response
             formatted_response = {
                 "accomm_recs": formatted_accomm_recs,
@@ -107,8 +230,7 @@ class FormatterAgent:
 
             return formatted_response
         except Exception as e:
-            print("Error in FormatterAgent: ")
-            print(e.args)
+            logger.exception("Error in FormatterAgent")
             raise e
 
 
@@ -1,15 +1,24 @@
+import asyncio
+import logging
 import os
-from dotenv import load_dotenv
-from openai import OpenAI
+
+from .llm import chat_completion, stream_json_completion
+from .progress import report_partial, reset_partial, streaming_enabled
 
 import json
 
-load_dotenv()
-client = OpenAI()
+logger = logging.getLogger(__name__)
+
+# How days are planned unless the request says otherwise:
+# "llm" asks the model, "local" uses the geography-aware day planner, and
+# "auto" asks the model but falls back to the planner if it is slow or fails
+ITINERARY_SCHEDULER = os.getenv("ITINERARY_SCHEDULER", "llm")
+# Seconds to wait for the model in "auto" mode
+ITINERARY_LLM_TIMEOUT = float(os.getenv("ITINERARY_LLM_TIMEOUT", 20))
 
 
 class ItineraryGeneratorAgent:
-    def generate_itinerary(self, travel_info):
+    async def generate_itinerary(self, travel_info):
         system_prompt = f"""
         You are a travel agent that excels at taking some recommended places and providing a coherent itinerary.
         You will be given a list of objects representing recommended places to visit and things to do in a particular city over a specified number of days.
@@ -37,7 +46,7 @@ class ItineraryGeneratorAgent:
             Here are the recommendations for the user's trip: {travel_info['activity_recs']}
             """
 
-        response = client.chat.completions.create(
+        params = dict(
             model="gpt-4o",
             response_format={"type": "json_object"},
             messages=[
@@ -49,26 +58,182 @@ class ItineraryGeneratorAgent:
             ],
         )
 
-        res = response.choices[0].message.content
+        # Stream each day to the progress listener as soon as it is generated
+        if streaming_enabled():
+
+            def report_day(key: str, itinerary_day: dict):
+                if key == "itinerary":
+                    report_partial(
+                        key,
+                        self.resolve_day(itinerary_day, travel_info["activity_recs"]),
+                    )
+
+            return await stream_json_completion(report_day, **params)
+
+        res = await chat_completion(**params)
         return res
 
-    def run(self, travel_info: dict) -> dict:
+    def resolve_day(self, itinerary_day: dict, activity_recs: list) -> dict:
+        """
+        Replaces the activity ids of a generated itinerary day with the
+        corresponding recommendations.
+        """
+        activity_ids = itinerary_day.get("recommended_activity_ids") or []
+        return {
+            "day": itinerary_day.get("day"),
+            "activity_recs": [
+                rec
+                for rec in activity_recs
+                if rec.get("id") is not None and rec["id"] in activity_ids
+            ],
+        }
+
+    async def generate_itinerary_with_llm(self, travel_info: dict) -> list:
+        res = json.loads(await self.generate_itinerary(travel_info))["itinerary"]
+        # get the recommendations corresponding to the ids in the itinerary
+        return [
+            self.resolve_day(itinerary_day, travel_info["activity_recs"])
+            for itinerary_day in res
+        ]
+
+    async def plan_with_llm(
+        self, travel_info: dict, instructions: str, candidates: list
+    ) -> list:
+        """
+        Asks the model to plan part of an existing itinerary again, e.g. one
+        day. The prompt is much smaller than ``generate_itinerary``'s: only the
+        candidate activities are listed, by id and title.
+
+        Args:
+            travel_info (dict): Information about the user's trip.
+            instructions (str): What to plan, e.g. "Plan day 2 again".
+            candidates (list): The activity recommendations to choose from.
+
+        Returns:
+            list: The planned days, each a dict with the "day" number and its
+            "recommended_activity_ids", keeping only candidates and using each
+            at most once.
+        """
+        system_prompt = """
+        You are a travel agent editing an existing travel itinerary.
+        You will be given a list of candidate activities, each with a unique identifier and a title, and the change to make.
+        Output a JSON object with a single attribute 'itinerary', a list of JSON objects for the days you planned, each with the structure:
+        {
+            'day': The day number of the itinerary, e.g. 1
+            'recommended_activity_ids': A list of the unique integer identifiers ONLY of the candidate activities for that day
+        }
+        Only use the given candidates, each at most once.
+        """
+
+        user_prefs = travel_info["user_form_submission"]
+        user_prompt = f"""
+            The user is travelling to {user_prefs['location']} for {user_prefs['num_days']} days during {user_prefs['time_range']}.
+            {instructions}
+
+            Candidates: {json.dumps([{"id": rec["id"], "title": rec["title"]} for rec in candidates])}
+            """
+
+        # Asking again for the same change must give a new plan
+        res = await chat_completion(
+            model="gpt-4o",
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            cache=False,
+        )
+        allowed = {rec["id"] for rec in candidates}
+        days = []
+        for itinerary_day in json.loads(res)["itinerary"]:
+            ids = []
+            for activity_id in itinerary_day["recommended_activity_ids"]:
+                if activity_id in allowed:
+                    allowed.discard(activity_id)
+                    ids.append(activity_id)
+            days.append({"day": itinerary_day["day"], "recommended_activity_ids": ids})
+        return days
+
+    def warm_up(self):
+        """
+        Imports the day planner and its numerical libraries ahead of the first
+        request, and the geocoder's NLP pipeline if days are planned locally.
+        """
+        from . import day_planner
+
+        if ITINERARY_SCHEDULER in ("local", "auto"):
+            from .mapper import load_nlp
+
+            load_nlp()
+
+    async def locate_activities(self, travel_info: dict):
+        """
+        Attaches coordinates to the activity recommendations, unless the map
+        stage already has (see ``MapperAgent.run``). Without them the day
+        planner cannot group nearby activities.
+        """
+        if all("lat" in rec for rec in travel_info["activity_recs"]):
+            return
+        from .mapper import MapperAgent
+
+        await MapperAgent().run(travel_info)
+
+    async def plan_itinerary_locally(self, travel_info: dict) -> list:
+        """
+        Splits the recommended activities into days without a model call,
+        grouping nearby activities (see ``day_planner.plan_days``). Activities
+        are geocoded first if the pipeline has not done so.
+
+        Args:
+            travel_info (dict): Information about the user's trip, including the
+                activity recommendations.
+
+        Returns:
+            list: The itinerary days, in the structure produced by ``resolve_day``.
+        """
+        from .day_planner import plan_days
+
+        await self.locate_activities(travel_info)
+        days = plan_days(
+            travel_info["activity_recs"],
+            travel_info["user_form_submission"]["num_days"],
+        )
+        itinerary = []
+        for day, activity_recs in enumerate(days, start=1):
+            itinerary.append({"day": day, "activity_recs": activity_recs})
+            report_partial("itinerary", itinerary[-1])
+        return itinerary
+
+    async def run(self, travel_info: dict) -> dict:
         try:
-            res = json.loads(self.generate_itinerary(travel_info))["itinerary"]
-            # get the recommendations corresponding to the ids in the itinerary
-            travel_info["itinerary"] = [
-                {
-                    "day": itinerary_day["day"],
-                    "activity_recs": [
-                        rec
-                        for rec in travel_info["activity_recs"]
-                        if rec["id"] in itinerary_day["recommended_activity_ids"]
-                    ],
-                }
-                for itinerary_day in res
-            ]
-            print("Itinerary Generated!")
+            scheduler = (
+                travel_info["user_form_submission"].get("scheduler")
+                or ITINERARY_SCHEDULER
+            )
+            if scheduler == "local":
+                travel_info["itinerary"] = await self.plan_itinerary_locally(
+                    travel_info
+                )
+            elif scheduler == "auto":
+                try:
+                    travel_info["itinerary"] = await asyncio.wait_for(
+                        self.generate_itinerary_with_llm(travel_info),
+                        ITINERARY_LLM_TIMEOUT,
+                    )
+                except Exception as e:
+                    logger.warning("Falling back to local itinerary planning: %r", e)
+                    # The planner reports its own days, in place of those the
+                    # model streamed before timing out
+                    reset_partial("itinerary")
+                    travel_info["itinerary"] = await self.plan_itinerary_locally(
+                        travel_info
+                    )
+            else:
+                travel_info["itinerary"] = await self.generate_itinerary_with_llm(
+                    travel_info
+                )
+            logger.debug("Itinerary Generated!")
             return travel_info
         except Exception as e:
-            print("Error in ItineraryGeneratorAgent: ", e)
+            logger.exception("Error in ItineraryGeneratorAgent")
             raise e
@@ -0,0 +1,70 @@
+import json
+
+
+class JsonItemStream:
+    """
+    Incrementally parses a streamed JSON object of the form
+    ``{"key": [{...}, {...}], ...}`` and emits each array item as soon as its
+    closing brace has arrived.
+
+    Feed text chunks with ``feed``; it returns the ``(key, item)`` pairs that
+    were completed by that chunk. The accumulated text is available as ``text``.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._pending_key = None
+        self._array_key = None
+        self._item_start = None
+
+    def feed(self, chunk: str) -> list:
+        """
+        Consumes a chunk of the JSON document.
+
+        Args:
+            chunk (str): The next piece of streamed text.
+
+        Returns:
+            list: ``(key, item)`` tuples for every array item completed by this chunk.
+        """
+        self.text += chunk
+        items = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._string_start is not None:
+                        self._pending_key = json.loads(text[self._string_start : i + 1])
+                        self._string_start = None
+                continue
+
+            if char == '"':
+                self._in_string = True
+                # Strings directly inside the top-level object are candidate keys
+                if self._stack == ["{"]:
+                    self._string_start = i
+            elif char in "{[":
+                if char == "[" and self._stack == ["{"]:
+                    self._array_key = self._pending_key
+                elif char == "{" and self._stack == ["{", "["]:
+                    self._item_start = i
+                self._stack.append(char)
+            elif char in "}]":
+                self._stack.pop()
+                if char == "}" and self._stack == ["{", "["]:
+                    item = json.loads(text[self._item_start : i + 1])
+                    items.append((self._array_key, item))
+                    self._item_start = None
+        self._pos = len(text)
+        return items
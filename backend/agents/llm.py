@@ -0,0 +1,247 @@
+import contextvars
+import functools
+import logging
+import os
+import time
+
+from .cache import CACHE_DIR, DiskCache, SingleFlight, make_key
+from .clients import get_client, register_client
+from .json_stream import JsonItemStream
+from .telemetry import call_upstream, record_usage, upstream_duration, upstream_errors
+
+logger = logging.getLogger(__name__)
+
+# Retries of transient OpenAI failures. The client's own retries are disabled
+# so that every attempt is visible to the metrics.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+# Hedge slow non-streamed completions with a second request. Off by default, as
+# a hedged completion is billed twice.
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+
+
+def create_openai_client():
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(max_retries=0)
+
+
+# The OpenAI client shared by every agent, created on first use
+register_client("openai", create_openai_client)
+
+completion_cache = DiskCache(
+    path=os.getenv("LLM_CACHE_PATH", os.path.join(CACHE_DIR, "llm_cache.db")),
+    ttl=float(os.getenv("LLM_CACHE_TTL", 24 * 60 * 60)),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1000)),
+)
+_single_flight = SingleFlight()
+# Items parsed so far and the item callbacks of each in-flight streamed JSON
+# completion, by completion key
+_json_streams = {}
+
+
+def is_transient(error: Exception) -> bool:
+    import openai
+
+    return isinstance(
+        error,
+        (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError),
+    )
+
+
+async def create_completion(operation: str, params: dict):
+    return await call_upstream(
+        "openai",
+        operation,
+        lambda: get_client("openai").chat.completions.create(**params),
+        retries=LLM_MAX_RETRIES,
+        retryable=is_transient,
+        hedge=LLM_HEDGE and not params.get("stream"),
+    )
+
+
+def completion_key(
+    model: str, messages: list, response_format: dict = None, **kwargs
+) -> str:
+    """
+    Returns the cache and coalescing key of a completion request.
+    """
+    return make_key(model, messages, response_format, kwargs)
+
+
+async def chat_completion(
+    model: str,
+    messages: list,
+    response_format: dict = None,
+    cache: bool = True,
+    **kwargs,
+) -> str:
+    """
+    Creates a chat completion and returns the content of the first choice.
+
+    Completions are cached on disk keyed on the model, messages, response format
+    and any extra parameters, and concurrent identical requests share a single
+    upstream call.
+
+    Args:
+        model (str): The OpenAI model name.
+        messages (list): The chat messages.
+        response_format (dict, optional): The response format, e.g. {"type": "json_object"}.
+        cache (bool, optional): If False, always requests a new completion,
+            neither cached nor shared, e.g. when the user asks for another
+            answer to the same prompt.
+
+    Returns:
+        str: The message content of the completion.
+    """
+    params = dict(model=model, messages=messages, **kwargs)
+    if response_format is not None:
+        params["response_format"] = response_format
+
+    async def request() -> str:
+        response = await create_completion("completion", params)
+        record_usage(model, response.usage)
+        return response.choices[0].message.content
+
+    if not cache:
+        return await request()
+
+    key = completion_key(model, messages, response_format, **kwargs)
+
+    async def create() -> str:
+        cached = await completion_cache.aget(key)
+        if cached is not None:
+            return cached
+
+        content = await request()
+        await completion_cache.aset(key, content)
+        return content
+
+    return await _single_flight.do(key, create)
+
+
+async def stream_chat_completion(
+    model: str, messages: list, response_format: dict = None, **kwargs
+):
+    """
+    Streams a chat completion, yielding content deltas as they arrive.
+
+    Shares the completion cache with ``chat_completion``: a cached completion is
+    yielded as a single chunk, and a streamed completion is cached once it has
+    finished. Streams are not coalesced; see ``stream_json_completion``.
+
+    Args:
+        model (str): The OpenAI model name.
+        messages (list): The chat messages.
+        response_format (dict, optional): The response format, e.g. {"type": "json_object"}.
+    """
+    key = completion_key(model, messages, response_format, **kwargs)
+    cached = await completion_cache.aget(key)
+    if cached is not None:
+        yield cached
+        return
+
+    params = dict(
+        model=model,
+        messages=messages,
+        stream=True,
+        # The last chunk reports the token usage
+        stream_options={"include_usage": True},
+        **kwargs,
+    )
+    if response_format is not None:
+        params["response_format"] = response_format
+    start = time.perf_counter()
+    stream = await create_completion("stream_start", params)
+    chunks = []
+    status = "error"
+    try:
+        async for chunk in stream:
+            record_usage(model, getattr(chunk, "usage", None))
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunks[-1]
+        status = "ok"
+    except Exception as e:
+        upstream_errors.inc(service="openai", error=type(e).__name__)
+        raise
+    finally:
+        # Time until the whole completion has been received
+        upstream_duration.observe(
+            time.perf_counter() - start,
+            service="openai",
+            operation="stream",
+            status=status,
+        )
+    await completion_cache.aset(key, "".join(chunks))
+
+
+async def stream_json_completion(on_item, **params) -> str:
+    """
+    Streams a JSON-mode chat completion and calls ``on_item(key, item)`` for each
+    object of a top-level array as soon as it is complete.
+
+    Concurrent identical requests share a single upstream call, like
+    ``chat_completion``: a caller joining a stream in progress is first given
+    the items already parsed, and one joining a non-streamed completion is given
+    every item once it finishes. Errors raised by ``on_item`` are logged and do
+    not interrupt the stream.
+
+    Args:
+        on_item (callable): Called with the array key and the parsed item.
+        **params: Parameters forwarded to ``stream_chat_completion``.
+
+    Returns:
+        str: The complete message content.
+    """
+    # Calls back in the caller's context, which holds its progress listener
+    on_item = functools.partial(contextvars.copy_context().run, on_item)
+    key = completion_key(**params)
+    stream = _json_streams.get(key)
+    if stream is None and key not in _single_flight:
+        stream = _json_streams[key] = {"items": [], "listeners": []}
+
+        async def create() -> str:
+            try:
+                parser = JsonItemStream()
+                async for delta in stream_chat_completion(**params):
+                    for item in parser.feed(delta):
+                        stream["items"].append(item)
+                        for listener in list(stream["listeners"]):
+                            notify(listener, *item)
+                return parser.text
+            finally:
+                if _json_streams.get(key) is stream:
+                    del _json_streams[key]
+
+    else:
+        create = None
+
+    if stream is None:
+        # A non-streamed completion is in flight
+        text = await _single_flight.do(key, create)
+        parser = JsonItemStream()
+        for item in parser.feed(text):
+            notify(on_item, *item)
+        return text
+
+    for item in stream["items"]:
+        notify(on_item, *item)
+    stream["listeners"].append(on_item)
+    try:
+        return await _single_flight.do(key, create)
+    finally:
+        stream["listeners"].remove(on_item)
+
+
+def notify(on_item, key: str, item: dict):
+    try:
+        on_item(key, item)
+    except Exception as e:
+        logger.warning("Handling a streamed %s item failed: %r", key, e)
+
+
+def cache_stats() -> dict:
+    """
+    Returns hit/miss counters for the completion cache.
+    """
+    return {**completion_cache.stats(), "coalesced": _single_flight.coalesced}
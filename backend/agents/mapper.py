@@ -1,5 +1,237 @@
-import spacy
-import requests
+import asyncio
+import hashlib
+import logging
+import math
+import os
+from functools import lru_cache
+from urllib.parse import quote
+
+from .cache import CACHE_DIR, DiskCache, SingleFlight, make_key
+from .clients import get_client, register_client
+from .scheduler import Scheduler
+from .telemetry import call_upstream, is_transient_http_error
+
+logger = logging.getLogger(__name__)
+
+SPACY_MODEL = os.getenv("SPACY_MODEL", "en_core_web_sm")
+# Entity labels that name a geocodable place: facilities (museums, bridges),
+# organisations (often venues), countries/cities and other locations
+PLACE_LABELS = {"FAC", "ORG", "GPE", "LOC"}
+
+# "maptiler" or "local" (the offline stand-in, see LocalGeocoder)
+GEOCODER = os.getenv("GEOCODER", "maptiler")
+GEOCODE_MAX_CONCURRENCY = int(os.getenv("GEOCODE_MAX_CONCURRENCY", 8))
+GEOCODE_MAX_RETRIES = int(os.getenv("GEOCODE_MAX_RETRIES", 1))
+# Hedge slow geocoding requests with a second request. Off by default, as a
+# hedged request is billed twice.
+GEOCODE_HEDGE = os.getenv("GEOCODE_HEDGE", "0") == "1"
+
+
+@lru_cache(maxsize=None)
+def load_nlp():
+    """
+    Loads the spaCy pipeline once per process, keeping only the components
+    needed for named-entity recognition.
+
+    Returns:
+        The shared ``spacy.Language``, or None if spaCy or the model is not
+        installed, in which case activity titles are geocoded as-is.
+    """
+    try:
+        import spacy
+
+        return spacy.load(
+            SPACY_MODEL, disable=["tagger", "parser", "lemmatizer", "attribute_ruler"]
+        )
+    except (ImportError, OSError) as e:
+        logger.warning(
+            "spaCy model %s unavailable, geocoding titles as-is: %r", SPACY_MODEL, e
+        )
+        return None
+
+
+def extract_places(texts: list) -> list:
+    """
+    Extracts the most specific place name from each text in one batched pass.
+
+    Args:
+        texts (list): Activity titles, e.g. "Visit the Louvre Museum".
+
+    Returns:
+        list: For each text, the first facility/organisation entity, else the
+        first place entity, else the text itself.
+    """
+    nlp = load_nlp()
+    if nlp is None:
+        return list(texts)
+
+    places = []
+    for text, doc in zip(texts, nlp.pipe(texts, batch_size=64)):
+        entities = [e for e in doc.ents if e.label_ in PLACE_LABELS]
+        entities.sort(key=lambda e: e.label_ not in ("FAC", "ORG"))
+        places.append(entities[0].text if entities else text)
+    return places
+
+
+class MapTilerGeocoder:
+    """
+    Asyncio client for the MapTiler geocoding API, sharing a pool of keep-alive
+    connections across requests.
+    """
+
+    def __init__(self, api_key: str, timeout: float = 10, max_connections: int = 10):
+        self.base_url = "https://api.maptiler.com/geocoding"
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._http = None
+
+    @property
+    def http(self):
+        """
+        The pooled ``httpx.AsyncClient``, created on first use.
+        """
+        if self._http is None or self._http.is_closed:
+            import httpx
+
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=60,
+            )
+            self._http = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return self._http
+
+    async def geocode(self, query: str) -> dict:
+        """
+        Geocodes a free-text place query.
+
+        Returns:
+            dict: ``{"lat", "lng"}`` of the best match, or None if nothing matched.
+        """
+        response = await self.http.get(
+            f"{self.base_url}/{quote(query, safe='')}.json",
+            params={"key": self.api_key, "limit": 1},
+        )
+        response.raise_for_status()
+        features = response.json().get("features")
+        if not features:
+            return None
+        lng, lat = features[0]["center"][:2]
+        return {"lat": lat, "lng": lng}
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class LocalGeocoder:
+    """
+    Offline stand-in for tests and benchmarks.
+
+    Known places are looked up in ``places``; anything else is placed
+    deterministically within ``radius_km`` of a point derived from the last
+    comma-separated part of the query (usually the city), so activities in the
+    same city land near each other.
+    """
+
+    def __init__(self, places: dict = None, radius_km: float = 5, delay: float = 0):
+        self.places = {k.casefold(): v for k, v in (places or {}).items()}
+        self.radius_km = radius_km
+        self.delay = delay
+
+    @staticmethod
+    def _unit(text: str, salt: str) -> float:
+        digest = hashlib.sha256(f"{salt}:{text}".encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2**64
+
+    async def geocode(self, query: str) -> dict:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        key = query.casefold().strip()
+        if key in self.places:
+            return dict(self.places[key])
+
+        city = key.rsplit(",", 1)[-1].strip()
+        lat = -60 + 120 * self._unit(city, "lat")
+        lng = -180 + 360 * self._unit(city, "lng")
+        distance = self.radius_km * math.sqrt(self._unit(key, "r"))
+        bearing = 2 * math.pi * self._unit(key, "theta")
+        lat += distance * math.cos(bearing) / 111.32
+        lng += distance * math.sin(bearing) / (111.32 * math.cos(math.radians(lat)))
+        return {"lat": lat, "lng": lng}
+
+    async def aclose(self):
+        pass
+
+
+def make_geocoder(name: str = GEOCODER):
+    if name == "local":
+        return LocalGeocoder()
+    return MapTilerGeocoder(
+        api_key=os.getenv("MAPTILER_API_KEY"), max_connections=GEOCODE_MAX_CONCURRENCY
+    )
+
+
+register_client("geocoder", make_geocoder)
+
+# Every upstream geocoding call in the process is admitted through this scheduler
+geocode_scheduler = Scheduler(
+    max_concurrency=GEOCODE_MAX_CONCURRENCY,
+    rate=float(os.getenv("GEOCODE_RATE_LIMIT", 10)),
+    burst=float(os.getenv("GEOCODE_RATE_BURST", 10)),
+    name="geocoder",
+)
+
+# Place coordinates rarely change, so entries are kept for a long time.
+# Places that could not be geocoded are cached as {} to avoid retrying them.
+geocode_cache = DiskCache(
+    path=os.getenv("GEOCODE_CACHE_PATH", os.path.join(CACHE_DIR, "geocode_cache.db")),
+    ttl=float(os.getenv("GEOCODE_CACHE_TTL", 30 * 24 * 60 * 60)),
+    max_entries=int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", 50000)),
+)
+_single_flight = SingleFlight()
+
+
+async def geocode(query: str) -> dict:
+    """
+    Geocodes a place query through the persistent cache, coalescing concurrent
+    lookups of the same place.
+
+    Returns:
+        dict: ``{"lat", "lng"}``, or None if the place could not be found.
+    """
+    geocoder = get_client("geocoder")
+    key = make_key(type(geocoder).__name__, " ".join(query.casefold().split()))
+    cached = await geocode_cache.aget(key)
+    if cached is not None:
+        return cached or None
+
+    async def fetch():
+        coordinates = await geocode_scheduler.run(
+            lambda: call_upstream(
+                "geocoder",
+                "geocode",
+                lambda: geocoder.geocode(query),
+                retries=GEOCODE_MAX_RETRIES,
+                retryable=is_transient_http_error,
+                hedge=GEOCODE_HEDGE,
+                scheduler=geocode_scheduler,
+            )
+        )
+        await geocode_cache.aset(key, coordinates or {})
+        return coordinates
+
+    return await _single_flight.do(key, fetch)
+
+
+def cache_stats() -> dict:
+    return {
+        **geocode_cache.stats(),
+        "coalesced": _single_flight.coalesced,
+        "scheduler": geocode_scheduler.stats(),
+    }
 
 
 class MapperAgent:
@@ -7,53 +239,73 @@ class MapperAgent:
     This agent takes in recommended activities and returns the coordinates of the locations where the activities are located.
     """
 
-    async def extract_locations_and_geocode(self, input_data):
-        # Load spaCy model
-        nlp = spacy.load("en_core_web_sm")
+    def warm_up(self):
+        """
+        Loads the spaCy pipeline ahead of the first request.
+        """
+        load_nlp()
+
+    async def geocode_activities(self, activity_recs: list, location: str) -> list:
+        """
+        Geocodes activities concurrently.
 
-        # MapTiler API key (replace with your actual key)
-        MAPTILER_API_KEY = "MY-MAPTILER-API-KEY"  # NOTE: put this in an old commit, but reprovisioned the key
-        # Extract place names using NER
-        doc = nlp(input_data["text"])
-        print([e.label_ for e in doc.ents])
-        place_names = [ent.text for ent in doc.ents if ent.label_ in "GPE"]
+        Place names are extracted from all titles in one NLP batch and looked up
+        within the trip's location.
 
-        # Use MapTiler Geocoding API to get coordinates
-        response = requests.get(
-            f"https://api.maptiler.com/geocoding/{input_data['text']}.json",
-            params={"key": MAPTILER_API_KEY},
+        Args:
+            activity_recs (list): Activity recommendations with a "title".
+            location (str): The destination, used to disambiguate place names.
+
+        Returns:
+            list: For each activity, ``{"lat", "lng"}`` or None if it could not
+            be geocoded.
+        """
+        places = await asyncio.to_thread(
+            extract_places, [rec["title"] for rec in activity_recs]
+        )
+        results = await asyncio.gather(
+            *(geocode(f"{place}, {location}") for place in places),
+            return_exceptions=True,
         )
-        locations = []
-        if response.status_code == 200:
-            data = response.json()
-            if data["features"]:
-                # Get the first result
-                feature = data["features"][0]
-                locations.append(
-                    {
-                        "name": input_data["text"],
-                        "lng": feature["center"][0],
-                        "lat": feature["center"][1],
-                    }
-                )
-
-        if not locations:
-            raise Exception(detail="No locations found")
-
-        return locations
+        coordinates = []
+        for place, result in zip(places, results):
+            if isinstance(result, Exception):
+                logger.warning("Geocoding failed for %r: %r", place, result)
+                result = None
+            coordinates.append(result)
+        return coordinates
 
+    async def run(self, travel_info: dict) -> dict:
+        """
+        Attaches "lat" and "lng" to every activity recommendation (None where
+        the activity could not be geocoded).
+
+        Args:
+            travel_info (dict): Information about the user's trip, including the
+                activity recommendations.
+
+        Returns:
+            dict: The same travel information with coordinates attached.
+        """
+        coordinates = await self.geocode_activities(
+            travel_info["activity_recs"],
+            travel_info["user_form_submission"]["location"],
+        )
+        for rec, point in zip(travel_info["activity_recs"], coordinates):
+            rec["lat"] = point["lat"] if point else None
+            rec["lng"] = point["lng"] if point else None
+        logger.debug("Activities geocoded!")
+        return travel_info
 
-async def main():
-    test_input = {"text": "Union Hall in Cincinatti, OH"}
 
+async def main():
     mapper_agent = MapperAgent()
-    locations = await mapper_agent.extract_locations_and_geocode(test_input)
+    activity_recs = [{"title": "Union Hall"}, {"title": "Visit Findlay Market"}]
+    coordinates = await mapper_agent.geocode_activities(activity_recs, "Cincinnati, OH")
 
     print("Extracted locations:")
-    print(locations)
+    print(coordinates)
 
 
 if __name__ == "__main__":
-    import asyncio
-
     asyncio.run(main())
@@ -0,0 +1,50 @@
+"""
+Per-run progress reporting for agents.
+
+The pipeline runner registers a listener for the current run with
+``partial_results.set``; agents call ``report_partial`` as pieces of their output
+become available. The listener is held in a context variable, so concurrent
+runs on the shared agent instances each report to their own listener.
+"""
+
+import logging
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Called with (key, item) for each partial result of the current run, and with
+# (key, None) when those reported so far under key are void (see ``reset_partial``)
+partial_results: ContextVar[Optional[Callable[[str, dict], None]]] = ContextVar(
+    "partial_results", default=None
+)
+
+
+def streaming_enabled() -> bool:
+    """
+    Returns True if a listener is registered for partial results of the current run.
+    """
+    return partial_results.get() is not None
+
+
+def report_partial(key: str, item: dict):
+    """
+    Forwards a partial result to the listener of the current run, if any.
+    Errors raised by the listener are logged, so that reporting progress never
+    fails the agent.
+    """
+    listener = partial_results.get()
+    if listener is not None:
+        try:
+            listener(key, item)
+        except Exception as e:
+            logger.warning("Reporting a partial %s result failed: %r", key, e)
+
+
+def reset_partial(key: str):
+    """
+    Tells the listener of the current run that the partial results reported
+    so far under ``key`` are void, e.g. because the agent is starting over
+    with another approach and will report them again.
+    """
+    report_partial(key, None)
@@ -1,12 +1,10 @@
 import json
-from dotenv import load_dotenv
-from openai import OpenAI
+import logging
 
-# Load environment variables from a .env file
-load_dotenv()
+from .llm import chat_completion, stream_json_completion
+from .progress import report_partial, streaming_enabled
 
-# Initialize the OpenAI client
-client = OpenAI()
+logger = logging.getLogger(__name__)
 
 
 class RecommenderAgent:
@@ -14,7 +12,7 @@ class RecommenderAgent:
     Generates travel recommendations based on user preferences and research data.
     """
 
-    def generate_recs(self, travel_info: dict) -> str:
+    async def generate_recs(self, travel_info: dict) -> str:
         """
         Generates recommendations for activities and accommodations.
 
@@ -57,7 +55,7 @@ class RecommenderAgent:
             {travel_info['accomm_research_results']}
             """
 
-        response = client.chat.completions.create(
+        params = dict(
             model="gpt-4o",
             response_format={"type": "json_object"},
             messages=[
@@ -66,10 +64,14 @@ class RecommenderAgent:
             ],
         )
 
-        res = response.choices[0].message.content
+        # Stream recommendations to the progress listener as they are generated
+        if streaming_enabled():
+            return await stream_json_completion(report_partial, **params)
+
+        res = await chat_completion(**params)
         return res
 
-    def run(self, travel_info: dict) -> dict:
+    async def run(self, travel_info: dict) -> dict:
         """
         Runs the recommendation process and updates travel information with recommendations.
 
@@ -80,14 +82,11 @@ class RecommenderAgent:
             dict: Updated travel information with recommendations.
         """
         try:
-            travel_info["activity_recs"] = json.loads(self.generate_recs(travel_info))[
-                "activity_recs"
-            ]
-            travel_info["accomm_recs"] = json.loads(self.generate_recs(travel_info))[
-                "accomm_recs"
-            ]
-            print("Recommendations generated successfully!")
+            recs = json.loads(await self.generate_recs(travel_info))
+            travel_info["activity_recs"] = recs["activity_recs"]
+            travel_info["accomm_recs"] = recs["accomm_recs"]
+            logger.debug("Recommendations generated successfully!")
             return travel_info
         except Exception as e:
-            print("An error occurred while generating recommendations.", e)
+            logger.exception("An error occurred while generating recommendations")
             raise e
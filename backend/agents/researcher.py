@@ -1,23 +1,24 @@
-import os
+import asyncio
+import logging
 
-from dotenv import load_dotenv
-from tavily import TavilyClient
+from .search import search
 
-from concurrent.futures import ThreadPoolExecutor
-
-# Load environment variables from a .env file
-load_dotenv()
-
-# Initialize the TavilyClient with the API key from environment variables
-tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
+logger = logging.getLogger(__name__)
 
 
 class ResearcherAgent:
     """
     Conducts research using the Tavily API and returns a summary of findings.
+
+    Args:
+        search_fn (callable, optional): The search function, with the signature
+            of ``agents.search.search``. Defaults to that function.
     """
 
-    def research_location_activities(self, user_prefs: dict) -> dict:
+    def __init__(self, search_fn=None):
+        self.search = search_fn or search
+
+    async def research_location_activities(self, user_prefs: dict) -> dict:
         """
         Research activities available at a given location.
 
@@ -38,22 +39,32 @@ class ResearcherAgent:
                 f"Best {user_prefs['budget']} {interest} in {user_prefs['location']}"
             )
 
-        # Perform concurrent searches
-        with ThreadPoolExecutor() as executor:
-            activity_results = list(
-                executor.map(
-                    lambda q: tavily_client.search(
-                        query=q,
-                        search_depth="advanced",
-                        max_results=min(user_prefs["num_days"], 5),
-                    ),
-                    search_queries,
+        # Perform concurrent searches, tolerating individual failures
+        activity_results = await asyncio.gather(
+            *(
+                self.search(
+                    query=q,
+                    search_depth="advanced",
+                    max_results=min(user_prefs["num_days"], 5),
                 )
-            )
+                for q in search_queries
+            ),
+            return_exceptions=True,
+        )
+        for q, r in zip(search_queries, activity_results):
+            if isinstance(r, Exception):
+                logger.warning("Activity search failed for %r: %r", q, r)
+
+        results = [
+            r["results"] for r in activity_results if not isinstance(r, Exception)
+        ]
+        if not results:
+            raise Exception("All activity searches failed")
+
         # Extract and return the results
-        return [r["results"] for r in activity_results]
+        return results
 
-    def research_location_accomm(self, user_prefs: dict) -> dict:
+    async def research_location_accomm(self, user_prefs: dict) -> dict:
         """
         Research accommodations available at a given location.
 
@@ -63,15 +74,21 @@ class ResearcherAgent:
         Returns:
             dict: Results of the research on accommodations.
         """
-        accomm_results = tavily_client.search(
-            query=f"Best {user_prefs['budget']} {user_prefs['accomm_type']} in {user_prefs['location']}",
-            include_images=True,
-            max_results=3,
-        )
+        query = f"Best {user_prefs['budget']} {user_prefs['accomm_type']} in {user_prefs['location']}"
+        try:
+            accomm_results = await self.search(
+                query=query,
+                include_images=True,
+                max_results=3,
+            )
+        except Exception as e:
+            # Degrade to no accommodation context rather than failing the request
+            logger.warning("Accommodation search failed for %r: %r", query, e)
+            accomm_results = {"query": query, "results": [], "images": []}
 
         return accomm_results
 
-    def run(self, user_prefs: dict):
+    async def run(self, user_prefs: dict):
         """
         Run the research process based on user preferences.
 
@@ -83,14 +100,16 @@ class ResearcherAgent:
         """
         try:
             travel_info = {"user_form_submission": user_prefs}
-            travel_info["activity_research_results"] = (
-                self.research_location_activities(user_prefs)
-            )
-            travel_info["accomm_research_results"] = self.research_location_accomm(
-                user_prefs
+            # Issue activity and accommodation queries together
+            (
+                travel_info["activity_research_results"],
+                travel_info["accomm_research_results"],
+            ) = await asyncio.gather(
+                self.research_location_activities(user_prefs),
+                self.research_location_accomm(user_prefs),
             )
-            print("Research completed successfully!")
+            logger.debug("Research completed successfully!")
             return travel_info
         except Exception as e:
-            print("An error occurred during research:", e)
+            logger.exception("An error occurred during research")
             raise e
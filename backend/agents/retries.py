@@ -0,0 +1,114 @@
+"""
+Retry policies for pipeline stages.
+
+Upstream calls retry their own transient failures (see
+``telemetry.call_upstream``). A stage is retried as a whole when it fails for
+another reason, e.g. a completion that does not parse or an outage outlasting
+the call retries. Each attempt starts from a copy of the stage's input, since
+stages modify their input in place, and attempts share the stage deadline. A
+retried stage reports its partial results again.
+"""
+
+import asyncio
+import copy
+import inspect
+import logging
+import os
+from functools import wraps
+
+from agents.deadlines import DeadlineExceeded, parse_timeouts
+from agents.telemetry import Counter
+
+logger = logging.getLogger(__name__)
+
+# Times each stage is retried after failing; stages not listed are retried
+# STAGE_RETRY times. Synchronous stages are retried without a delay.
+STAGE_RETRIES = {
+    stage: int(retries)
+    for stage, retries in parse_timeouts(
+        os.getenv(
+            "STAGE_RETRIES",
+            "research=1,compact=0,recommend=1,map=1,generate_itinerary=1,format=0",
+        )
+    ).items()
+}
+STAGE_RETRY = int(os.getenv("STAGE_RETRY", 0))
+# Delay before the first retry of a stage, doubled for each further retry
+STAGE_RETRY_BACKOFF = float(os.getenv("STAGE_RETRY_BACKOFF", 1.0))
+
+stage_retries = Counter(
+    "travelforge_stage_retries_total",
+    "Pipeline stages run again after failing",
+    ("stage",),
+)
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Returns whether a failed stage is worth running again: not when it ran out
+    of time or an upstream API rejected the request itself (a 4xx other than
+    timeouts, conflicts and rate limiting).
+    """
+    if isinstance(error, DeadlineExceeded):
+        return False
+    status = getattr(error, "status_code", None) or getattr(
+        getattr(error, "response", None), "status_code", None
+    )
+    if isinstance(status, int) and 400 <= status < 500:
+        return status in (408, 409, 429)
+    return True
+
+
+def with_retries(stage: str, fn, retries: int = None):
+    """
+    Wraps a pipeline node so that it is run again when it fails with a
+    retryable error.
+
+    Args:
+        stage (str): The node name, whose policy is looked up in ``STAGE_RETRIES``.
+        fn: The node function.
+        retries (int, optional): Overrides the stage's policy.
+    """
+    retries = STAGE_RETRIES.get(stage, STAGE_RETRY) if retries is None else retries
+    if retries <= 0:
+        return fn
+
+    def attempt_input(state, attempt: int):
+        # The last attempt may modify the original
+        return state if attempt >= retries else copy.deepcopy(state)
+
+    def should_retry(attempt: int, error: Exception) -> bool:
+        if attempt >= retries or not is_retryable(error):
+            return False
+        stage_retries.inc(stage=stage)
+        logger.warning("Retrying the %s stage after: %r", stage, error)
+        return True
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def run_async(state):
+            attempt = 0
+            while True:
+                try:
+                    return await fn(attempt_input(state, attempt))
+                except Exception as e:
+                    if not should_retry(attempt, e):
+                        raise
+                await asyncio.sleep(STAGE_RETRY_BACKOFF * 2**attempt)
+                attempt += 1
+
+        return run_async
+
+    @wraps(fn)
+    def run(state):
+        attempt = 0
+        while True:
+            try:
+                return fn(attempt_input(state, attempt))
+            except Exception as e:
+                if not should_retry(attempt, e):
+                    raise
+            attempt += 1
+
+    return run
@@ -0,0 +1,105 @@
+"""
+Process-wide admission control for outbound API calls: a token-bucket rate
+limiter combined with a concurrency bound.
+"""
+
+import asyncio
+import time
+
+from .telemetry import Gauge, upstream_wait
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter.
+
+    Tokens are refilled continuously at ``rate`` per second up to ``capacity``;
+    each ``acquire`` consumes one token, waiting until one is available.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class Scheduler:
+    """
+    Bounds the number of concurrent calls and the rate at which they start.
+
+    Shared by every request in the process so that outbound concurrency stays
+    fixed regardless of how many pipelines are running. ``name`` labels the
+    scheduler's metrics, usually with the upstream service.
+    """
+
+    def __init__(
+        self, max_concurrency: int, rate: float, burst: float = None, name: str = None
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._bucket = TokenBucket(rate, burst or rate)
+        self.waiting = 0
+        self.active = 0
+        if name:
+            schedulers.append(self)
+
+    async def run(self, fn):
+        """
+        Runs ``fn()`` once a concurrency slot and a rate-limit token are available.
+
+        Args:
+            fn: A zero-argument callable returning an awaitable.
+        """
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            await self._bucket.acquire()
+            if self.name:
+                upstream_wait.observe(time.perf_counter() - start, service=self.name)
+            self.active += 1
+            try:
+                return await fn()
+            finally:
+                self.active -= 1
+        finally:
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "waiting": self.waiting,
+        }
+
+
+# Named schedulers, reported by the waiting gauge
+schedulers = []
+
+upstream_waiting = Gauge(
+    "travelforge_upstream_waiting",
+    "Outbound calls waiting for a concurrency slot or rate-limit token",
+    ("service",),
+    collect=lambda: {(scheduler.name,): scheduler.waiting for scheduler in schedulers},
+)
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from .cache import CACHE_DIR, DiskCache, SingleFlight, make_key
+from .clients import get_client, register_client
+from .scheduler import Scheduler
+from .telemetry import call_upstream, is_transient_http_error
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTavilyClient:
+    """
+    Minimal asyncio client for the Tavily search API.
+
+    Mirrors the request payload of ``tavily.TavilyClient.search`` so results are
+    interchangeable, but uses a shared ``httpx.AsyncClient`` with a pool of
+    keep-alive connections instead of blocking ``requests`` calls.
+    """
+
+    def __init__(self, api_key: str, timeout: float = 100, max_connections: int = 10):
+        self.base_url = "https://api.tavily.com/search"
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._http = None
+
+    @property
+    def http(self):
+        """
+        The pooled ``httpx.AsyncClient``, created on first use.
+        """
+        if self._http is None or self._http.is_closed:
+            import httpx
+
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=60,
+            )
+            self._http = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return self._http
+
+    async def search(
+        self,
+        query: str,
+        search_depth: str = "basic",
+        topic: str = "general",
+        days: int = 2,
+        max_results: int = 5,
+        include_domains: list = None,
+        exclude_domains: list = None,
+        include_answer: bool = False,
+        include_raw_content: bool = False,
+        include_images: bool = False,
+        use_cache: bool = True,
+    ) -> dict:
+        """
+        Sends a search request to the Tavily API.
+
+        Args:
+            query (str): The search query.
+            search_depth (str): Either "basic" or "advanced".
+
+        Returns:
+            dict: The decoded JSON response.
+        """
+        data = {
+            "query": query,
+            "search_depth": search_depth,
+            "topic": topic,
+            "days": days,
+            "include_answer": include_answer,
+            "include_raw_content": include_raw_content,
+            "max_results": max_results,
+            "include_domains": include_domains or None,
+            "exclude_domains": exclude_domains or None,
+            "include_images": include_images,
+            "api_key": self.api_key,
+            "use_cache": use_cache,
+        }
+        response = await self.http.post(self.base_url, json=data)
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", 8))
+# Retries of transient Tavily failures (connection errors, 429 and 5xx)
+SEARCH_MAX_RETRIES = int(os.getenv("SEARCH_MAX_RETRIES", 1))
+# Hedge slow searches with a second request (see agents.telemetry.HEDGE_PERCENTILE).
+# Off by default, as a hedged search is billed twice.
+SEARCH_HEDGE = os.getenv("SEARCH_HEDGE", "0") == "1"
+
+# The async Tavily client, created on first use with the API key from the environment
+register_client(
+    "tavily",
+    lambda: AsyncTavilyClient(
+        api_key=os.getenv("TAVILY_API_KEY"), max_connections=SEARCH_MAX_CONCURRENCY
+    ),
+)
+
+# Every upstream search in the process is admitted through this scheduler
+search_scheduler = Scheduler(
+    max_concurrency=SEARCH_MAX_CONCURRENCY,
+    rate=float(os.getenv("SEARCH_RATE_LIMIT", 10)),
+    burst=float(os.getenv("SEARCH_RATE_BURST", 10)),
+    name="tavily",
+)
+
+search_cache = DiskCache(
+    path=os.getenv("SEARCH_CACHE_PATH", os.path.join(CACHE_DIR, "search_cache.db")),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", 6 * 60 * 60)),
+    stale_ttl=float(os.getenv("SEARCH_CACHE_STALE_TTL", 24 * 60 * 60)),
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 5000)),
+)
+_single_flight = SingleFlight()
+_revalidations = set()
+
+
+class SearchStats:
+    """
+    Per-query lookup counters and latency for the search cache.
+
+    Only the ``max_queries`` most recently seen normalized queries are tracked.
+    """
+
+    def __init__(self, max_queries: int = 1000):
+        self.max_queries = max_queries
+        self.queries = OrderedDict()
+        self.totals = {"hits": 0, "stale_hits": 0, "misses": 0, "revalidations": 0}
+
+    def record(self, query: str, outcome: str, latency: float):
+        self.totals[outcome] += 1
+        stats = self.queries.pop(query, None) or {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "total_latency": 0.0,
+            "max_latency": 0.0,
+        }
+        stats[outcome] += 1
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        self.queries[query] = stats
+        if len(self.queries) > self.max_queries:
+            self.queries.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        lookups = (
+            self.totals["hits"] + self.totals["stale_hits"] + self.totals["misses"]
+        )
+        queries = {}
+        for query, stats in self.queries.items():
+            count = stats["hits"] + stats["stale_hits"] + stats["misses"]
+            queries[query] = {
+                "lookups": count,
+                "hit_rate": (stats["hits"] + stats["stale_hits"]) / count,
+                "mean_latency": stats["total_latency"] / count,
+                "max_latency": stats["max_latency"],
+            }
+        return {
+            **self.totals,
+            "hit_rate": (
+                (self.totals["hits"] + self.totals["stale_hits"]) / lookups
+                if lookups
+                else 0.0
+            ),
+            "queries": queries,
+        }
+
+
+search_stats = SearchStats()
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a search query for use as a cache key: case-folded with
+    whitespace collapsed.
+    """
+    return " ".join(query.casefold().split())
+
+
+async def _fetch(key: str, query: str, params: dict) -> dict:
+    async def fetch() -> dict:
+        result = await search_scheduler.run(
+            lambda: call_upstream(
+                "tavily",
+                "search",
+                lambda: get_client("tavily").search(query=query, **params),
+                retries=SEARCH_MAX_RETRIES,
+                retryable=is_transient_http_error,
+                hedge=SEARCH_HEDGE,
+                scheduler=search_scheduler,
+            )
+        )
+        await search_cache.aset(key, result)
+        return result
+
+    return await _single_flight.do(key, fetch)
+
+
+async def _revalidate(key: str, query: str, params: dict):
+    try:
+        await _fetch(key, query, params)
+    except Exception as e:
+        logger.warning("Search revalidation failed for %r: %r", query, e)
+
+
+async def search(query: str, **params) -> dict:
+    """
+    Searches Tavily through the shared search cache.
+
+    Fresh entries are returned directly. Entries past their TTL but within the
+    stale window are returned immediately while a background task refreshes
+    them. Misses are fetched upstream, with concurrent identical queries
+    sharing one request.
+
+    Args:
+        query (str): The search query.
+        **params: Parameters forwarded to ``AsyncTavilyClient.search``.
+
+    Returns:
+        dict: The Tavily search response.
+    """
+    normalized = normalize_query(query)
+    key = make_key(normalized, params)
+    start = time.perf_counter()
+
+    entry = await search_cache.aget_entry(key)
+    if entry is not None:
+        result, age = entry
+        if age <= search_cache.ttl:
+            outcome = "hits"
+        else:
+            outcome = "stale_hits"
+            if key not in _single_flight:
+                search_stats.totals["revalidations"] += 1
+                task = asyncio.create_task(_revalidate(key, query, params))
+                _revalidations.add(task)
+                task.add_done_callback(_revalidations.discard)
+    else:
+        outcome = "misses"
+        result = await _fetch(key, query, params)
+
+    search_stats.record(normalized, outcome, time.perf_counter() - start)
+    return result
+
+
+def cache_stats() -> dict:
+    """
+    Returns hit-rate and per-query latency statistics for the search cache.
+    """
+    return {
+        **search_stats.snapshot(),
+        "coalesced": _single_flight.coalesced,
+        "entries": len(search_cache),
+        "max_entries": search_cache.max_entries,
+        "ttl": search_cache.ttl,
+        "stale_ttl": search_cache.stale_ttl,
+        "scheduler": search_scheduler.stats(),
+    }
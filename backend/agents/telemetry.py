@@ -0,0 +1,603 @@
+"""
+Process-wide metrics and optional tracing for the itinerary pipeline.
+
+Metrics are kept in memory and rendered in the Prometheus text exposition
+format by ``render_metrics``, which the API serves on ``/metrics``. When
+``TRACING`` is enabled, pipeline stages and upstream calls are also recorded
+as OpenTelemetry-style spans, one trace per task (the trace ID is the task ID),
+which the API serves on ``/traces/{task_id}``.
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Record spans for each task's pipeline stages and upstream calls
+TRACING = os.getenv("TRACING", "0") == "1"
+# Number of most recent traces kept in memory
+TRACE_MAX_TASKS = int(os.getenv("TRACE_MAX_TASKS", 200))
+
+# Hedge upstream calls that opt in with a second request once they have taken
+# longer than this percentile of recent successful calls of the same kind
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+# Calls of a kind observed before any of them is hedged
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+# Number of recent calls of each kind the percentile is computed over
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 200))
+
+# Upper bounds in seconds, from cache hits to slow completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named family of time series, one per combination of label values.
+    Metrics register themselves with ``REGISTRY`` when created.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def samples(self):
+        """
+        Yields ``(name suffix, label string, value)`` for each sample.
+        """
+        with self._lock:
+            series = list(self._series.items())
+        for key, value in series:
+            yield "", self._labels(key), value
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Gauges created with ``collect`` are read at
+    scrape time instead: ``collect()`` returns the value, or a dict mapping
+    tuples of label values to values.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple = (), collect=None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.warning("Collecting %s failed: %r", self.name, e)
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            if value is not None:
+                yield "", self._labels(tuple(map(str, key))), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative), sum, count
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the ``with`` block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(k, (list(v[0]), v[1], v[2])) for k, v in self._series.items()]
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (("le", _format_value(float(bound))),)
+                yield "_bucket", self._labels(key, le), cumulative
+            yield "_sum", self._labels(key), total
+            yield "_count", self._labels(key), count
+
+
+REGISTRY = []
+
+
+def render_metrics() -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(port: int, host: str = "0.0.0.0"):
+    """
+    Serves ``render_metrics`` over plain HTTP, for processes without the API
+    (e.g. standalone job workers). Every request path returns the metrics.
+    """
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = (await asyncio.to_thread(render_metrics)).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+stage_duration = Histogram(
+    "travelforge_stage_duration_seconds",
+    "Duration of pipeline stages",
+    ("stage", "status"),
+)
+stages_in_flight = Gauge(
+    "travelforge_stages_in_flight", "Pipeline stages currently running", ("stage",)
+)
+upstream_duration = Histogram(
+    "travelforge_upstream_duration_seconds",
+    "Duration of each attempt of an outbound API call",
+    ("service", "operation", "status"),
+)
+upstream_in_flight = Gauge(
+    "travelforge_upstream_in_flight", "Outbound API calls in progress", ("service",)
+)
+upstream_wait = Histogram(
+    "travelforge_upstream_wait_seconds",
+    "Time outbound calls wait for a concurrency slot and rate-limit token",
+    ("service",),
+)
+upstream_errors = Counter(
+    "travelforge_upstream_errors_total",
+    "Failed attempts of outbound API calls",
+    ("service", "error"),
+)
+upstream_retries = Counter(
+    "travelforge_upstream_retries_total",
+    "Outbound API calls retried after a transient failure",
+    ("service",),
+)
+upstream_hedges = Counter(
+    "travelforge_upstream_hedges_total",
+    "Slow outbound API calls hedged with a second request, by the request that answered",
+    ("service", "winner"),
+)
+llm_tokens = Counter(
+    "travelforge_llm_tokens_total",
+    "Tokens used by chat completions",
+    ("model", "kind"),
+)
+
+
+def record_usage(model: str, usage):
+    """
+    Counts the prompt and completion tokens of a completion's ``usage``.
+    """
+    if usage is None:
+        return
+    llm_tokens.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+    llm_tokens.inc(usage.completion_tokens or 0, model=model, kind="completion")
+
+
+def retry_after(error: Exception) -> float:
+    """
+    Returns the delay requested by the Retry-After header of a failed HTTP
+    response, if any.
+    """
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def is_transient_http_error(error: Exception) -> bool:
+    """
+    Returns whether an httpx error is worth retrying: connection problems,
+    timeouts, rate limiting and server errors.
+    """
+    import httpx
+
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class LatencyWindow:
+    """
+    The durations of the most recent successful calls of one kind.
+    """
+
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self.samples = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        Returns the q-th percentile, or None until ``HEDGE_MIN_SAMPLES`` calls
+        have been observed.
+        """
+        if len(self.samples) < max(HEDGE_MIN_SAMPLES, 1):
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+# (service, operation) -> LatencyWindow
+latencies = {}
+
+
+async def hedged(service: str, fn, delay: float, scheduler=None):
+    """
+    Awaits ``fn()``, starting a second ``fn()`` if the first has not finished
+    after ``delay`` seconds. Returns the first successful result and cancels
+    the other request; fails only if both requests fail.
+
+    The second request is admitted through ``scheduler``, if given, like any
+    other call to the service.
+    """
+    primary = asyncio.ensure_future(fn())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    hedge = asyncio.ensure_future(scheduler.run(fn) if scheduler else fn())
+    pending = {primary, hedge}
+    try:
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for request in done:
+                if request.exception() is None:
+                    winner = "primary" if request is primary else "hedge"
+                    upstream_hedges.inc(service=service, winner=winner)
+                    return request.result()
+            if not pending:
+                upstream_hedges.inc(service=service, winner="none")
+                # Both failed; report the original request's error
+                return primary.result()
+    finally:
+        for request in pending:
+            request.cancel()
+
+
+async def call_upstream(
+    service: str,
+    operation: str,
+    fn,
+    retries: int = 0,
+    retryable=None,
+    backoff: float = 0.5,
+    max_backoff: float = 8,
+    hedge: bool = False,
+    scheduler=None,
+):
+    """
+    Calls an outbound API, retrying transient failures with exponential backoff
+    and recording the duration and outcome of every attempt.
+
+    With ``hedge``, an attempt still running after ``HEDGE_PERCENTILE`` of the
+    recent durations of this kind of call is raced against a second, identical
+    request. Only use it for idempotent calls. A caller that admits its calls
+    through a ``Scheduler`` passes it as ``scheduler``, so that the second
+    request takes its own concurrency slot and rate-limit token.
+
+    Args:
+        service (str): The upstream service, e.g. "openai".
+        operation (str): The kind of call, e.g. "completion".
+        fn: A zero-argument callable returning an awaitable.
+        retries (int): Maximum number of retries.
+        retryable (callable, optional): Returns whether an exception is
+            transient. Nothing is retried without it.
+        backoff (float): Delay before the first retry, doubled for each retry
+            unless the response asked for a specific delay.
+        max_backoff (float): Maximum delay between attempts.
+        hedge (bool): Hedge slow attempts with a second request.
+        scheduler (Scheduler, optional): Admits the second request of a
+            hedged attempt.
+
+    Returns:
+        The result of ``fn()``.
+    """
+    window = latencies.setdefault((service, operation), LatencyWindow())
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        upstream_in_flight.inc(service=service)
+        hedge_after = window.percentile(HEDGE_PERCENTILE) if hedge else None
+        try:
+            with span(f"{service}.{operation}", attempt=attempt):
+                if hedge_after is None:
+                    result = await fn()
+                else:
+                    result = await hedged(service, fn, hedge_after, scheduler)
+        except asyncio.CancelledError:
+            # Aborted, e.g. by a stage deadline or a cancelled task
+            upstream_in_flight.dec(service=service)
+            upstream_duration.observe(
+                time.perf_counter() - start,
+                service=service,
+                operation=operation,
+                status="cancelled",
+            )
+            raise
+        except Exception as e:
+            upstream_in_flight.dec(service=service)
+            upstream_duration.observe(
+                time.perf_counter() - start,
+                service=service,
+                operation=operation,
+                status="error",
+            )
+            upstream_errors.inc(service=service, error=type(e).__name__)
+            if attempt >= retries or retryable is None or not retryable(e):
+                raise
+            delay = retry_after(e) or backoff * 2**attempt
+            attempt += 1
+            upstream_retries.inc(service=service)
+            logger.warning(
+                "Retrying %s %s in %.1fs after: %r", service, operation, delay, e
+            )
+            await asyncio.sleep(min(delay, max_backoff))
+            continue
+        upstream_in_flight.dec(service=service)
+        elapsed = time.perf_counter() - start
+        window.observe(elapsed)
+        upstream_duration.observe(
+            elapsed, service=service, operation=operation, status="ok"
+        )
+        return result
+
+
+def instrument_stage(stage: str, fn):
+    """
+    Wraps a pipeline node so that each run is timed, counted as in flight and
+    recorded as a span. Synchronous nodes stay synchronous.
+    """
+
+    @contextmanager
+    def measure():
+        stages_in_flight.inc(stage=stage)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            with bind_log_fields(stage=stage), span(f"stage.{stage}"):
+                yield
+            status = "ok"
+        finally:
+            stages_in_flight.dec(stage=stage)
+            stage_duration.observe(
+                time.perf_counter() - start, stage=stage, status=status
+            )
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def run_async(state):
+            with measure():
+                return await fn(state)
+
+        return run_async
+
+    @wraps(fn)
+    def run(state):
+        with measure():
+            return fn(state)
+
+    return run
+
+
+class SpanStore:
+    """
+    Keeps the finished spans of the ``max_traces`` most recent traces.
+    """
+
+    def __init__(self, max_traces: int):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, span: dict):
+        with self._lock:
+            spans = self._traces.get(span["trace_id"])
+            if spans is None:
+                spans = self._traces[span["trace_id"]] = []
+                if len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            spans.append(span)
+
+    def get(self, trace_id: str) -> list:
+        with self._lock:
+            return sorted(
+                self._traces.get(trace_id, ()),
+                key=lambda s: s["start_time_unix_nano"],
+            )
+
+
+spans = SpanStore(TRACE_MAX_TASKS)
+
+# Fields added to every log record, e.g. the task ID and stage being run
+log_fields: ContextVar[dict] = ContextVar("log_fields", default={})
+
+
+@contextmanager
+def bind_log_fields(**fields):
+    """
+    Adds ``fields`` to the log records emitted inside the ``with`` block and
+    in tasks started from it.
+    """
+    token = log_fields.set({**log_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
+
+
+# (trace ID, ID of the innermost open span) of the running task
+current_span: ContextVar[tuple] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def trace(task_id: str):
+    """
+    Records the spans opened inside the ``with`` block, and in tasks started
+    from it, under the trace of ``task_id``.
+    """
+    token = current_span.set((task_id, None) if TRACING else None)
+    try:
+        yield
+    finally:
+        current_span.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Records the ``with`` block as a span of the current trace, nested under the
+    innermost open span. Does nothing outside a trace or with tracing disabled.
+
+    Yields:
+        dict: The span, whose "attributes" may be added to, or None.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    trace_id, parent_id = parent
+    record = {
+        "trace_id": trace_id,
+        "span_id": secrets.token_hex(8),
+        "parent_span_id": parent_id,
+        "name": name,
+        "start_time_unix_nano": time.time_ns(),
+        "end_time_unix_nano": None,
+        "attributes": attributes,
+        "status": "OK",
+    }
+    token = current_span.set((trace_id, record["span_id"]))
+    try:
+        yield record
+    except BaseException as e:
+        record["status"] = "ERROR"
+        record["attributes"]["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        record["end_time_unix_nano"] = time.time_ns()
+        spans.add(record)
@@ -0,0 +1,319 @@
+"""
+This module contains the batch runner for itinerary requests submitted
+together, e.g. by partners overnight.
+
+Items are grouped by destination (see ``result_cache.place_key``). The
+research of every item in a group goes through one ``GroupSearch``, so each
+distinct query ("Top tourist attractions in Paris", ...) is sent once per
+group and its results are shared; only the stages after research run once per
+item. Identical requests within a batch run once, the duplicates following the
+first. Items share their pipeline with identical requests submitted on their
+own: an item waits for the outcome of such a request already running (see
+``jobs.follow_inflight``), takes over those still queued when its turn comes,
+and those submitted while it runs attach to it.
+
+Batches run in the process that accepted them, at most ``concurrency`` items
+at a time. Their items are stored as tasks, so ``/task-status`` and
+``/task-events`` work for each of them, and a failed item can be retried on
+its own.
+"""
+
+import asyncio
+import copy
+import logging
+import os
+import uuid
+
+from agents.cache import make_key
+from agents.researcher import ResearcherAgent
+from agents.retries import with_retries
+from agents.search import normalize_query, search
+from agents.telemetry import bind_log_fields, instrument_stage, span, trace
+from db.db import (
+    CANCELLED,
+    FAILED,
+    PENDING,
+    RUNNING,
+    STALE_AFTER,
+    SUCCESS,
+    TERMINAL_STATES,
+    adopt_queued,
+    create_batch,
+    find_inflight,
+    get_batch,
+    get_task,
+    start_task,
+    touch_batch,
+)
+from events import task_events
+from jobs import (
+    dedup_stats,
+    follow_inflight,
+    generate_itinerary_job,
+    run_cancellable,
+    upstream_calls,
+)
+from result_cache import place_key
+from schemas import ItineraryRequest
+
+logger = logging.getLogger(__name__)
+
+# Largest number of requests accepted in one batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 500))
+# Items of a batch run at once, unless the batch asks for another number
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))
+# Results fetched for each shared query: the most any research query asks for
+SHARED_SEARCH_RESULTS = 5
+
+# Searches sent for batch items, and those answered by a search already sent
+# for another item of the same group
+batch_stats = {"batches": 0, "items": 0, "searches": 0, "saved_search_calls": 0}
+
+
+class GroupSearch:
+    """
+    The search function used for the research of one location group.
+
+    Each distinct query is sent once, with enough results for any item, and
+    shared by every item that asks for it. Failed searches are not shared with
+    those asking after the failure. Callers get their own copy of the
+    response, cut to the number of results they asked for.
+    """
+
+    def __init__(self):
+        self._searches = {}
+
+    async def __call__(self, query: str, max_results: int = 5, **params) -> dict:
+        key = make_key(normalize_query(query), params)
+        if key in self._searches:
+            batch_stats["saved_search_calls"] += 1
+        else:
+            batch_stats["searches"] += 1
+            future = asyncio.ensure_future(
+                search(
+                    query=query,
+                    max_results=max(max_results, SHARED_SEARCH_RESULTS),
+                    **params,
+                )
+            )
+            future.add_done_callback(lambda done: self._forget_failed(key, done))
+            self._searches[key] = future
+        # Shielded, so that a cancelled item does not cancel the search for others
+        response = copy.deepcopy(await asyncio.shield(self._searches[key]))
+        response["results"] = response["results"][:max_results]
+        return response
+
+    def _forget_failed(self, key: str, future: asyncio.Future):
+        """
+        Drops a failed search, so that retries and later items search again.
+        """
+        if future.cancelled() or future.exception() is not None:
+            if self._searches.get(key) is future:
+                del self._searches[key]
+
+
+class BatchRunner:
+    """
+    Runs submitted batches in the background of this process.
+    """
+
+    def __init__(self):
+        # Batches and retried items running in this process, by ID
+        self._runs = {}
+
+    async def submit(self, requests: list, concurrency: int = None) -> dict:
+        """
+        Stores a batch and starts running it.
+
+        Args:
+            requests (list): The batch's ``ItineraryRequest``s.
+            concurrency (int, optional): The number of items run at once.
+                Defaults to ``BATCH_CONCURRENCY``.
+
+        Returns:
+            dict: The "batch_id" and the "items", in submission order, each with
+            its "task_id" and "location".
+        """
+        batch_id = str(uuid.uuid4())
+        items, leaders, groups = [], {}, {}
+        for request in requests:
+            task_id = str(uuid.uuid4())
+            payload = request.model_dump()
+            fingerprint = request.fingerprint()
+            leader_id = leaders.setdefault(fingerprint, task_id)
+            if leader_id == task_id:
+                groups.setdefault(place_key(request.location), []).append(
+                    (task_id, payload)
+                )
+                leader_id = None
+            items.append((task_id, payload, leader_id, fingerprint))
+        await asyncio.to_thread(create_batch, batch_id, items)
+
+        concurrency = min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+        self._start(batch_id, self._run(batch_id, groups, concurrency))
+        batch_stats["batches"] += 1
+        batch_stats["items"] += len(items)
+        logger.info(
+            "Batch submitted",
+            extra={
+                "batch_id": batch_id,
+                "items": len(items),
+                "groups": len(groups),
+                "concurrency": concurrency,
+            },
+        )
+        return {
+            "batch_id": batch_id,
+            "items": [
+                {"task_id": task_id, "location": payload["location"]}
+                for task_id, payload, _, _ in items
+            ],
+        }
+
+    def retry(self, batch_id: str, task_id: str, payload: dict):
+        """
+        Runs a batch item requeued by ``retry_task`` again, resuming from its
+        checkpoint. Its research, if still needed, is not shared.
+        """
+        self._start(
+            task_id,
+            self._run_item(batch_id, task_id, payload, None, asyncio.Semaphore(1)),
+        )
+
+    def _start(self, run_id: str, coro):
+        task = asyncio.create_task(coro)
+        self._runs[run_id] = task
+        task.add_done_callback(lambda _: self._runs.pop(run_id, None))
+
+    async def stop(self):
+        """
+        Cancels the batches and items running in this process. Their unfinished
+        items are eventually failed as abandoned by the retention sweeper.
+        """
+        tasks = list(self._runs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, batch_id: str, groups: dict, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+        # Items are started group by group, as the semaphore admits them in
+        # order, so a group's items run close together and share its searches
+        runs = []
+        for group in groups.values():
+            research_fn = self._group_research()
+            runs.extend(
+                self._run_item(batch_id, task_id, payload, research_fn, semaphore)
+                for task_id, payload in group
+            )
+        heartbeat = asyncio.create_task(self._heartbeat(batch_id))
+        try:
+            await asyncio.gather(*runs)
+        finally:
+            heartbeat.cancel()
+        logger.info("Batch finished", extra={"batch_id": batch_id})
+
+    @staticmethod
+    def _group_research():
+        """
+        Returns the research stage shared by the items of one location group.
+        """
+        researcher = ResearcherAgent(search_fn=GroupSearch())
+        return instrument_stage("research", with_retries("research", researcher.run))
+
+    @staticmethod
+    async def _heartbeat(batch_id: str):
+        while True:
+            await asyncio.sleep(STALE_AFTER / 4)
+            try:
+                await asyncio.to_thread(touch_batch, batch_id)
+            except Exception:
+                logger.exception("Touching batch items failed")
+
+    @staticmethod
+    async def _run_item(
+        batch_id: str, task_id: str, payload: dict, research_fn, semaphore
+    ):
+        async with semaphore:
+            with bind_log_fields(task_id=task_id, batch_id=batch_id):
+                try:
+                    # Looked up while the item is PENDING, so it does not find itself
+                    fingerprint = ItineraryRequest(**payload).fingerprint()
+                    leader_id = await asyncio.to_thread(find_inflight, fingerprint)
+                    # Skip items cancelled while waiting for their turn
+                    if not await asyncio.to_thread(start_task, task_id):
+                        return
+                    with trace(task_id), span("job", task_id=task_id):
+                        await run_cancellable(
+                            task_id,
+                            BatchRunner._job(
+                                task_id, payload, research_fn, fingerprint, leader_id
+                            ),
+                        )
+                except Exception as e:
+                    logger.error("Batch item failed: %r", e)
+
+    @staticmethod
+    async def _job(
+        task_id: str, payload: dict, research_fn, fingerprint: str, leader_id: str
+    ):
+        """
+        Shares the pipeline of the identical request ``leader_id`` running, if
+        any and it succeeds. Otherwise runs the item's own pipeline, for the
+        identical requests still queued too.
+        """
+        if leader_id and await follow_inflight(task_id, leader_id, payload):
+            logger.info("Batch item resolved by an identical request")
+            return
+        adopted = await asyncio.to_thread(adopt_queued, task_id, fingerprint)
+        if adopted:
+            saved = upstream_calls(payload)
+            dedup_stats["attached"] += len(adopted)
+            dedup_stats["saved_search_calls"] += saved["search"] * len(adopted)
+            dedup_stats["saved_llm_calls"] += saved["llm"] * len(adopted)
+            logger.info("Batch item took over %d queued requests", len(adopted))
+        try:
+            await generate_itinerary_job(task_id, payload, research_fn)
+        finally:
+            # Their clients follow their own events, not the item's
+            for adopted_id in adopted:
+                task = await asyncio.to_thread(get_task, adopted_id)
+                if task and task["state"] in TERMINAL_STATES:
+                    task_events.publish(adopted_id, task)
+
+
+def batch_status(batch_id: str) -> dict:
+    """
+    Returns the aggregate progress of a batch.
+
+    Args:
+        batch_id (str): The unique identifier for the batch.
+
+    Returns:
+        dict: The number of items in each state, the fraction finished, and the
+        state of each item in submission order, or None if the batch is not
+        found. Items already deleted by the retention sweeper are reported as
+        NOT_FOUND.
+    """
+    batch = get_batch(batch_id)
+    if batch is None:
+        return None
+    states = batch["states"]
+    items = [
+        {"task_id": task_id, "state": states.get(task_id, "NOT_FOUND")}
+        for task_id in batch["task_ids"]
+    ]
+    counts = dict.fromkeys([PENDING, RUNNING, SUCCESS, FAILED, CANCELLED], 0)
+    for item in items:
+        counts[item["state"]] = counts.get(item["state"], 0) + 1
+    finished = sum(1 for item in items if item["state"] not in (PENDING, RUNNING))
+    return {
+        "id": batch["id"],
+        "created_at": batch["created_at"],
+        "total": len(items),
+        "counts": counts,
+        "progress": finished / len(items),
+        "finished": finished == len(items),
+        "items": items,
+    }
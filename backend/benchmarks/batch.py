@@ -0,0 +1,166 @@
+"""
+Benchmark of the batch endpoint against submitting the same requests one by
+one, with the offline OpenAI and Tavily stand-ins of ``benchmarks.fakes``.
+
+Generates ``--requests`` itinerary requests spread over ``--locations``
+destinations, with varied seasons, budgets, trip lengths and interests, and
+runs them at the same concurrency either
+
+- individually: ``POST /generate-itinerary`` for each, polling
+  ``/task-status``, with ``--concurrency`` in-process job workers;
+- as a batch: one ``POST /batches`` polled through ``/batches/{id}``; or
+- overlapping: both at once, as when a partner's batch repeats requests its
+  users have just made, which then share their pipelines.
+
+Each mode runs in a fresh process with empty caches. Reports wall time and
+the number of upstream search and LLM calls. Run from the backend directory:
+
+    python -m benchmarks.batch [--requests 60] [--locations 4] [--concurrency 8]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+from .pipeline import TERMINAL, configure_environment, install_clients, serve_app
+
+LOCATIONS = ["Paris, France", "Rome, Italy", "Kyoto, Japan", "Lisbon, Portugal"]
+TIME_RANGES = ["June", "October"]
+BUDGETS = ["low", "medium"]
+INTERESTS = ["art", "food", "history", "nightlife", "nature", "shopping"]
+MODES = ["individual", "batch", "overlap"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--locations", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--search-latency", type=float, default=0.8)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=MODES)
+    args = parser.parse_args(argv)
+    # Settings expected by the pipeline benchmark helpers
+    args.record = False
+    args.llm_error_rate = args.search_error_rate = 0.0
+    args.workers = args.concurrency if args.mode != "batch" else 0
+    return args
+
+
+def make_requests(args) -> list:
+    rng = random.Random(args.seed)
+    locations = [LOCATIONS[i % len(LOCATIONS)] for i in range(args.locations)]
+    return [
+        {
+            "location": rng.choice(locations),
+            "time_range": rng.choice(TIME_RANGES),
+            "budget": rng.choice(BUDGETS),
+            "accomm_type": "hotel",
+            "num_days": rng.randint(2, 6),
+            "interests": rng.sample(INTERESTS, 2),
+        }
+        for _ in range(args.requests)
+    ]
+
+
+async def run_individual(http, requests: list, args) -> int:
+    async def run(request):
+        response = await http.post("/generate-itinerary", json=request)
+        response.raise_for_status()
+        task_id = response.json()["task_id"]
+        while True:
+            task = (await http.get(f"/task-status/{task_id}")).json()
+            if task["state"] in TERMINAL:
+                return task["state"] == "SUCCESS"
+            await asyncio.sleep(args.poll_interval)
+
+    return sum(await asyncio.gather(*(run(r) for r in requests)))
+
+
+async def run_batch(http, requests: list, args) -> int:
+    response = await http.post(
+        "/batches", json={"requests": requests, "concurrency": args.concurrency}
+    )
+    response.raise_for_status()
+    batch_id = response.json()["batch_id"]
+    while True:
+        status = (await http.get(f"/batches/{batch_id}")).json()
+        if status["finished"]:
+            return status["counts"]["SUCCESS"]
+        await asyncio.sleep(args.poll_interval)
+
+
+async def run_overlap(http, requests: list, args) -> int:
+    return sum(
+        await asyncio.gather(
+            run_batch(http, requests, args), run_individual(http, requests, args)
+        )
+    )
+
+
+async def measure(args) -> dict:
+    import httpx
+
+    requests = make_requests(args)
+    run = {"individual": run_individual, "batch": run_batch, "overlap": run_overlap}[
+        args.mode
+    ]
+    async with serve_app() as base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+            start = time.perf_counter()
+            succeeded = await run(http, requests, args)
+            elapsed = time.perf_counter() - start
+    return {"succeeded": succeeded, "wall_seconds": elapsed}
+
+
+def run_mode(args) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        os.environ["LOG_LEVEL"] = "WARNING"
+        models = install_clients(args)
+        results = asyncio.run(measure(args))
+    results["upstream"] = {name: model.stats() for name, model in models.items()}
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.mode:
+        print(json.dumps(run_mode(args)))
+        return
+
+    print(
+        f"{args.requests} requests over {args.locations} destinations,"
+        f" concurrency {args.concurrency}"
+    )
+    print(f"{'mode':<12} {'ok':>4} {'wall s':>8} {'searches':>9} {'llm calls':>10}")
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.batch", *argv, "--mode", mode],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{mode:<12} {r['succeeded']:4d} {r['wall_seconds']:8.2f}"
+            f" {r['upstream']['search']['calls']:9d}"
+            f" {r['upstream']['llm']['calls']:10d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
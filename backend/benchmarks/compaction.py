@@ -0,0 +1,92 @@
+"""
+Benchmark for compacting research results before the recommend stage.
+
+Runs ``ResearchCompactorAgent`` over the recorded research of the pipeline
+benchmark and reports the tokens kept and the time per run. It then checks
+which sentences ``clean`` keeps. Banner and navigation boilerplate should be
+dropped. Real content that merely mentions such words ("cookie", "catalog
+in") should be kept.
+
+Run from the backend directory:
+
+    python -m benchmarks.compaction [--repeat 100]
+"""
+
+import argparse
+import copy
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+from agents.compactor import ResearchCompactorAgent  # noqa: E402
+from benchmarks.fakes import load_fixture  # noqa: E402
+from benchmarks.pipeline import REQUEST  # noqa: E402
+
+# (sentence, whether clean keeps it)
+SENTENCES = [
+    ("Accept cookies to continue.", False),
+    ("Skip to main content.", False),
+    ("Sign up for our newsletter to get the best deals every week.", False),
+    ("Log in to save this itinerary to your account.", False),
+    ("© 2024 Example Travel Ltd. All rights reserved.", False),
+    ("This website uses cookies to improve your experience.", False),
+    (
+        "Levain Bakery sells the most famous chocolate chip cookie in New York.",
+        True,
+    ),
+    (
+        "Browse the catalog in the gift shop for prints of the collection.",
+        True,
+    ),
+    ("Cookie lovers should not miss the bakeries of the Marais district.", True),
+    ("Sign in at the visitor centre before walking up to the glacier.", True),
+    ("The museum's newsletter archive dates back to its opening in 1897.", True),
+]
+
+
+def research() -> dict:
+    """
+    Returns the research stage output for ``REQUEST``, with the recorded
+    activity search answering every activity query.
+    """
+    activities = load_fixture("search_activities")["results"]
+    queries = 2 + len(REQUEST["interests"])
+    return {
+        "user_form_submission": REQUEST,
+        "activity_research_results": [copy.deepcopy(activities)] * queries,
+        "accomm_research_results": load_fixture("search_accomm"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    compactor = ResearchCompactorAgent()
+    compactor.warm_up()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        compaction = compactor.run(research())["research_compaction"]
+    elapsed = (time.perf_counter() - start) / args.repeat
+    print(
+        f"tokens before {compaction['tokens_before']}, after "
+        f"{compaction['tokens_after']}, {elapsed * 1e3:.2f} ms per run"
+    )
+
+    wrong = 0
+    print(f"\n{'expected':>8}  {'cleaned':>8}  sentence")
+    for sentence, keep in SENTENCES:
+        kept = bool(compactor.clean(sentence, set()))
+        wrong += kept != keep
+        print(
+            f"{'keep' if keep else 'drop':>8}  {'kept' if kept else 'dropped':>8}"
+            f"  {sentence}"
+        )
+    print(f"\n{wrong} of {len(SENTENCES)} sentences misclassified")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Benchmark of editing finished itineraries against generating them, with the
+offline OpenAI and Tavily stand-ins of ``benchmarks.fakes``.
+
+Generates ``--requests`` itineraries for distinct destinations, then applies
+each edit to every one of them in turn: changing the number of days, replacing
+an activity and planning a day again. Reports the latency of each kind of
+request and the prompt tokens and upstream calls it used. The fakes' latency
+does not depend on the prompt size, so the latencies only reflect the calls
+saved. Run from the backend directory:
+
+    python -m benchmarks.edits [--requests 20] [--concurrency 4]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+from .pipeline import (
+    TERMINAL,
+    configure_environment,
+    install_clients,
+    percentile,
+    serve_app,
+)
+
+# Each edit's request, formatted with the task ID
+EDITS = {
+    "num_days": ("/tasks/{}/itinerary/num-days", {"num_days": 2}),
+    "replace": ("/tasks/{}/itinerary/days/1/activities/1/replace", None),
+    "regenerate": ("/tasks/{}/itinerary/days/2/regenerate", None),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--search-latency", type=float, default=0.8)
+    parser.add_argument("--sigma", type=float, default=0.3)
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    # Settings expected by the pipeline benchmark helpers
+    args.record = False
+    args.llm_error_rate = args.search_error_rate = 0.0
+    args.workers = args.concurrency
+    return args
+
+
+class Usage:
+    """
+    Upstream calls and prompt tokens used between two snapshots.
+    """
+
+    def __init__(self, models: dict):
+        from agents.telemetry import llm_tokens
+
+        self.models = models
+        self.tokens = llm_tokens
+        self.start = self.snapshot()
+
+    def snapshot(self) -> dict:
+        return {
+            "search": self.models["search"].stats()["calls"],
+            "llm": self.models["llm"].stats()["calls"],
+            "prompt_tokens": self.tokens.value(model="gpt-4o", kind="prompt"),
+        }
+
+    def since_start(self) -> dict:
+        end = self.snapshot()
+        return {key: end[key] - self.start[key] for key in end}
+
+
+async def generate(http, index: int, args) -> tuple:
+    request = {
+        "location": f"City {index}",
+        "time_range": "June",
+        "budget": "medium",
+        "accomm_type": "hotel",
+        "num_days": 3,
+        "interests": ["art", "food"],
+    }
+    start = time.perf_counter()
+    task_id = (await http.post("/generate-itinerary", json=request)).json()["task_id"]
+    while True:
+        task = (await http.get(f"/task-status/{task_id}")).json()
+        if task["state"] in TERMINAL:
+            break
+        await asyncio.sleep(args.poll_interval)
+    return task_id, time.perf_counter() - start
+
+
+async def edit(http, task_id: str, name: str) -> float:
+    path, body = EDITS[name]
+    start = time.perf_counter()
+    response = await http.post(path.format(task_id), json=body)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def measure(args, models: dict) -> dict:
+    import httpx
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    results = {}
+    async with serve_app() as base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+            usage = Usage(models)
+            runs = await asyncio.gather(
+                *(limited(generate(http, i, args)) for i in range(args.requests))
+            )
+            results["generate"] = {
+                "latencies": [elapsed for _, elapsed in runs],
+                **usage.since_start(),
+            }
+            for name in EDITS:
+                usage = Usage(models)
+                latencies = await asyncio.gather(
+                    *(limited(edit(http, task_id, name)) for task_id, _ in runs)
+                )
+                results[name] = {"latencies": latencies, **usage.since_start()}
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        os.environ["LOG_LEVEL"] = "WARNING"
+        models = install_clients(args)
+        results = asyncio.run(measure(args, models))
+
+    print(f"{args.requests} itineraries, concurrency {args.concurrency}")
+    print(
+        f"{'request':<11} {'p50 s':>7} {'p95 s':>7} {'searches':>9}"
+        f" {'llm calls':>10} {'prompt tokens':>14}"
+    )
+    for name, r in results.items():
+        n = len(r["latencies"])
+        print(
+            f"{name:<11} {percentile(r['latencies'], 50):7.2f}"
+            f" {percentile(r['latencies'], 95):7.2f} {r['search'] / n:9.2f}"
+            f" {r['llm'] / n:10.2f} {r['prompt_tokens'] / n:14.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
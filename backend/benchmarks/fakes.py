@@ -0,0 +1,245 @@
+"""
+Deterministic stand-ins for the OpenAI and Tavily clients, used by the offline
+benchmarks.
+
+The fakes replay recorded responses from ``benchmarks/fixtures`` after a
+simulated network delay and fail a configurable fraction of calls, so pipeline
+performance can be measured without API keys, cost or network jitter. They
+implement only the client methods the agents call:
+``client.chat.completions.create`` (streamed and not) and
+``tavily_client.search``.
+
+``RecordingOpenAI`` and ``RecordingTavily`` wrap the real clients to capture new
+fixtures.
+"""
+
+import asyncio
+import json
+import math
+import os
+import random
+from types import SimpleNamespace
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json")) as f:
+        return json.load(f)
+
+
+def save_fixture(name: str, data: dict):
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), "w") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def completion_fixture(messages: list) -> str:
+    """
+    Returns the name of the fixture answering a chat completion, chosen by the
+    agent that made the request.
+    """
+    if "activity_recs" in messages[0]["content"]:
+        return "recommendations"
+    return "itinerary"
+
+
+def search_fixture(params: dict) -> str:
+    """
+    Returns the name of the fixture answering a search: only the accommodation
+    search asks for images.
+    """
+    return "search_accomm" if params.get("include_images") else "search_activities"
+
+
+class UpstreamError(Exception):
+    """
+    A simulated upstream failure, e.g. a 5xx or a dropped connection.
+    """
+
+
+class LatencyModel:
+    """
+    Simulated upstream behaviour: log-normally distributed delays with the
+    given mean, and independent failures at ``error_rate``.
+
+    Args:
+        mean (float): Mean delay in seconds.
+        sigma (float): Shape of the distribution; 0 gives a constant delay.
+        error_rate (float): Probability that a call fails.
+        rng (random.Random): Source of randomness, seeded for reproducibility.
+    """
+
+    def __init__(
+        self,
+        mean: float,
+        sigma: float = 0.5,
+        error_rate: float = 0.0,
+        rng: random.Random = None,
+    ):
+        self.mean = mean
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rng = rng or random.Random(0)
+        self.calls = 0
+        self.errors = 0
+
+    def sample(self) -> float:
+        if self.mean <= 0:
+            return 0.0
+        # Choose mu so that the distribution's mean is self.mean
+        mu = math.log(self.mean) - self.sigma**2 / 2
+        return self.rng.lognormvariate(mu, self.sigma)
+
+    async def call(self) -> float:
+        """
+        Counts a call and decides its fate up front.
+
+        Returns:
+            float: The delay of the call.
+
+        Raises:
+            UpstreamError: After the delay, if the call fails.
+        """
+        self.calls += 1
+        delay = self.sample()
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(delay)
+            raise UpstreamError("Simulated upstream failure")
+        return delay
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "errors": self.errors}
+
+
+class FakeCompletions:
+    def __init__(self, latency: LatencyModel, stream_chunks: int):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.fixtures = {}
+
+    def content(self, messages: list) -> str:
+        name = completion_fixture(messages)
+        if name not in self.fixtures:
+            self.fixtures[name] = json.dumps(load_fixture(name))
+        return self.fixtures[name]
+
+    async def create(
+        self,
+        model: str,
+        messages: list,
+        stream: bool = False,
+        stream_options: dict = None,
+        **kwargs,
+    ):
+        delay = await self.latency.call()
+        content = self.content(messages)
+        # Token counts estimated at four characters per token
+        usage = SimpleNamespace(
+            prompt_tokens=sum(len(m["content"]) for m in messages) // 4,
+            completion_tokens=len(content) // 4,
+        )
+        if not stream:
+            await asyncio.sleep(delay)
+            message = SimpleNamespace(role="assistant", content=content)
+            return SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(index=0, message=message)],
+                usage=usage,
+            )
+        if not (stream_options or {}).get("include_usage"):
+            usage = None
+        return self.stream(content, delay, usage)
+
+    async def stream(self, content: str, delay: float, usage):
+        # Spread the delay evenly over the chunks, like tokens arriving
+        size = math.ceil(len(content) / self.stream_chunks)
+        for start in range(0, len(content), size):
+            await asyncio.sleep(delay / self.stream_chunks)
+            delta = SimpleNamespace(content=content[start : start + size])
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(index=0, delta=delta)], usage=None
+            )
+        if usage is not None:
+            yield SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeOpenAI:
+    """
+    Replays recorded completions in place of ``openai.AsyncOpenAI``.
+
+    Args:
+        latency (LatencyModel): Delay and failures of each completion; streamed
+            completions spread the delay over ``stream_chunks`` chunks.
+        stream_chunks (int): Number of chunks a streamed completion is split into.
+    """
+
+    def __init__(self, latency: LatencyModel, stream_chunks: int = 20):
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=FakeCompletions(latency, stream_chunks))
+
+
+class FakeTavily:
+    """
+    Replays recorded search results in place of ``agents.search.AsyncTavilyClient``.
+
+    Args:
+        latency (LatencyModel): Delay and failures of each search.
+    """
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.fixtures = {}
+
+    async def search(self, query: str, **params) -> dict:
+        await asyncio.sleep(await self.latency.call())
+        name = search_fixture(params)
+        if name not in self.fixtures:
+            self.fixtures[name] = load_fixture(name)
+        return {**self.fixtures[name], "query": query}
+
+    async def aclose(self):
+        pass
+
+
+class RecordingOpenAI:
+    """
+    Wraps a real ``AsyncOpenAI`` client and saves the first completion of each
+    kind as a fixture. Streamed completions are not recorded.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.recorded = set()
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, **params):
+        response = await self.client.chat.completions.create(**params)
+        name = completion_fixture(params["messages"])
+        if not params.get("stream") and name not in self.recorded:
+            self.recorded.add(name)
+            save_fixture(name, json.loads(response.choices[0].message.content))
+        return response
+
+
+class RecordingTavily:
+    """
+    Wraps a real Tavily client and saves the first result of each kind of
+    search as a fixture.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.recorded = set()
+
+    async def search(self, query: str, **params) -> dict:
+        result = await self.client.search(query=query, **params)
+        name = search_fixture(params)
+        if name not in self.recorded:
+            self.recorded.add(name)
+            save_fixture(name, result)
+        return result
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,55 @@
+"""
+Micro-benchmark for the per-request cost of building the agent graph.
+
+Compares constructing the four agents and compiling a fresh graph on every
+request (the old behaviour of ``TravelForgeAgent.run``) against fetching the
+process-wide compiled graph.
+
+Run from the backend directory:
+
+    python -m benchmarks.graph_construction [iterations]
+"""
+
+import os
+import sys
+import time
+
+# The agent modules create API clients at import time; no requests are made here.
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+from langgraph_agent import TravelForgeAgent  # noqa: E402
+
+
+def per_request_construction():
+    agents = {name: agent_cls() for name, agent_cls in TravelForgeAgent.NODES.items()}
+    return TravelForgeAgent.build_graph(agents)
+
+
+def shared_graph():
+    return TravelForgeAgent.get_graph()
+
+
+def bench(fn, iterations: int) -> float:
+    """
+    Returns the mean wall-clock time of ``fn`` in microseconds.
+    """
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    before = bench(per_request_construction, iterations)
+    after = bench(shared_graph, iterations)
+    print(f"iterations:                 {iterations}")
+    print(f"build + compile per request: {before:10.1f} us")
+    print(f"shared compiled graph:       {after:10.1f} us")
+    print(f"speedup:                     {before / after:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
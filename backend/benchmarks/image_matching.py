@@ -0,0 +1,163 @@
+"""
+Benchmark for matching accommodation names to researched image URLs.
+
+Compares ``FormatterAgent.match_names_to_urls`` against the previous approach
+of filling the score matrix with a Python double loop of ``fuzz.ratio`` calls
+on raw URLs. The current matcher assigns small matrices greedily and larger
+ones in one batched call; it reduces every URL to its words first, which costs
+more than the previous matcher at the smallest sizes but matches far more
+names correctly in larger pools. Each case draws a set of hotel names and a pool of image URLs from
+many sources, of which one per name depicts that hotel; accuracy is the
+fraction of names assigned their own image.
+
+Run from the backend directory:
+
+    python -m benchmarks.image_matching [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from thefuzz import fuzz
+
+from agents.formatter import FormatterAgent
+
+# (names, urls): a typical accommodation search up to images merged from many sources
+SIZES = [(3, 5), (5, 20), (10, 100), (10, 500), (20, 2000)]
+
+WORDS = [
+    "grand",
+    "royal",
+    "palace",
+    "garden",
+    "river",
+    "park",
+    "plaza",
+    "central",
+    "harbour",
+    "crown",
+    "imperial",
+    "golden",
+    "maison",
+    "villa",
+    "opera",
+    "bristol",
+    "regent",
+    "lumiere",
+    "astoria",
+    "marina",
+]
+KINDS = ["hotel", "resort", "suites", "inn", "lodge", "hostel"]
+HOSTS = [
+    "cdn.example.com",
+    "images.travel.net",
+    "q-xx.bstatic.com/xdata",
+    "media-cdn.tripadvisor.com/media/photo-o",
+]
+SUBJECTS = ["pool", "lobby", "room", "beach", "skyline", "breakfast", "view", "spa"]
+
+
+def legacy_match(names: list, urls: list) -> dict:
+    """
+    The matcher as it was before batching, without its debug output.
+    """
+    score_matrix = np.zeros((len(names), len(urls)))
+    for i, name in enumerate(names):
+        for j, url in enumerate(urls):
+            score_matrix[i, j] = fuzz.ratio(name, url)
+    row_ind, col_ind = linear_sum_assignment(score_matrix, maximize=True)
+    return {names[i]: urls[j] for i, j in zip(row_ind, col_ind)}
+
+
+def hotel_name(rng: random.Random) -> str:
+    name = f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {rng.choice(KINDS).title()}"
+    return f"The {name}" if rng.random() < 0.3 else name
+
+
+def image_url(rng: random.Random, slug: str = None) -> str:
+    host = rng.choice(HOSTS)
+    if slug is None:
+        # Opaque CDN image with no name in the path
+        return (
+            f"https://{host}/images/hotel/max1024x768/{rng.randint(10**8, 10**9)}.jpg"
+        )
+    return (
+        f"https://{host}/uploads/{rng.randint(2015, 2024)}/{rng.randint(1, 12):02d}/"
+        f"{slug}-{rng.choice(SUBJECTS)}-{rng.choice(['1024x768', 'scaled', '2'])}.jpg"
+    )
+
+
+def slugify(rng: random.Random, name: str) -> str:
+    words = name.lower().split()
+    if words[0] == "the" and rng.random() < 0.5:
+        words = words[1:]
+    return rng.choice(["-", "_", ""]).join(words)
+
+
+def make_case(rng: random.Random, n_names: int, n_urls: int) -> tuple:
+    """
+    Returns names, a shuffled URL pool and each name's own image. The pool is
+    padded with images of other hotels and opaque CDN images.
+    """
+    names, expected = [], {}
+    while len(names) < n_names:
+        name = hotel_name(rng)
+        if name not in expected:
+            names.append(name)
+            expected[name] = image_url(rng, slugify(rng, name))
+
+    # Images of other hotels, whose names differ by more than a leading "The"
+    taken = {name.removeprefix("The ") for name in names}
+    urls = list(expected.values())
+    while len(urls) < n_urls:
+        other = hotel_name(rng)
+        if other.removeprefix("The ") in taken:
+            continue
+        urls.append(image_url(rng, slugify(rng, other) if rng.random() < 0.5 else None))
+    rng.shuffle(urls)
+    return names, urls, expected
+
+
+def measure(match, names, urls, expected, repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        mapping = match(names, urls)
+    elapsed = (time.perf_counter() - start) / repeat
+    accuracy = sum(mapping.get(n) == u for n, u in expected.items()) / len(expected)
+    return elapsed, accuracy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    formatter = FormatterAgent()
+    print(
+        f"{'names x urls':>14}   {'legacy ms':>10} {'acc':>5}   {'current ms':>10} {'acc':>5}"
+        f"   {'speedup':>7}"
+    )
+    for n_names, n_urls in SIZES:
+        names, urls, expected = make_case(rng, n_names, n_urls)
+        legacy = measure(legacy_match, names, urls, expected, args.repeat)
+        current = measure(
+            formatter.match_names_to_urls, names, urls, expected, args.repeat
+        )
+        print(
+            f"{n_names:>6} x {n_urls:<5}   {legacy[0] * 1e3:10.2f} {legacy[1]:5.0%}"
+            f"   {current[0] * 1e3:10.2f} {current[1]:5.0%}"
+            f"   {legacy[0] / current[0]:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+"""
+End-to-end benchmark of the itinerary API against offline OpenAI and Tavily
+stand-ins.
+
+Starts the FastAPI app in-process on a local port with the upstream clients
+replaced by the fakes in ``benchmarks.fakes``, then submits itinerary requests
+through ``POST /generate-itinerary`` from ``--concurrency`` clients, each
+polling ``/task-status`` until its task finishes. Reports throughput,
+end-to-end latency percentiles, queue wait, time per pipeline stage and peak
+RSS, and writes them as JSON so runs can be compared:
+
+    python -m benchmarks.pipeline --requests 100 --concurrency 16 --output after.json
+    python -m benchmarks.pipeline --compare after.json
+
+Caches and the task store live in a temporary directory, and every request goes
+to a distinct destination unless ``--locations`` is set, so cold-pipeline
+performance is measured. Rate limits and other settings are read from the
+environment as usual. ``--record`` runs one request against the real APIs
+instead and saves the responses as fixtures.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+TERMINAL = ("SUCCESS", "FAILED")
+
+REQUEST = {
+    "location": "Paris, France",
+    "time_range": "June",
+    "budget": "medium",
+    "accomm_type": "hotel",
+    "num_days": 3,
+    "interests": ["art", "food"],
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--workers", type=int, default=4, help="in-process job workers (JOB_WORKERS)"
+    )
+    parser.add_argument(
+        "--locations",
+        type=int,
+        default=0,
+        help="cycle through this many destinations (0: one per request)",
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=2.0, help="mean completion seconds"
+    )
+    parser.add_argument(
+        "--search-latency", type=float, default=0.8, help="mean search seconds"
+    )
+    parser.add_argument(
+        "--sigma", type=float, default=0.5, help="log-normal latency shape"
+    )
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--search-error-rate", type=float, default=0.0)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the app's own output"
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="call the real APIs once and save their responses as fixtures",
+    )
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir: str):
+    """
+    Points caches and the task store at ``workdir`` and sets up the app for the
+    run. Must be called before the app is imported.
+    """
+    os.environ["CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["TASKS_DB_PATH"] = os.path.join(workdir, "tasks.db")
+    os.environ.setdefault("LOG_FILE", os.path.join(workdir, "app.log"))
+    os.environ["JOB_WORKERS"] = str(args.workers)
+    os.environ.setdefault("JOB_POLL_INTERVAL", str(args.poll_interval))
+    os.environ.setdefault("GEOCODER", "local")
+    os.environ.setdefault("RESULT_CACHE_POLICY", "off")
+    os.environ.setdefault("JOB_QUEUE_MAX_DEPTH", str(max(100, args.requests)))
+    if args.record:
+        # Streamed completions are not recorded
+        os.environ["STREAM_PARTIAL_RESULTS"] = "0"
+
+
+def install_clients(args) -> dict:
+    """
+    Replaces the shared upstream clients with fakes (or, with --record, with
+    recorders wrapping the real clients).
+
+    Returns:
+        dict: The latency models of the fakes, keyed by "llm" and "search".
+    """
+    from agents import llm, search  # noqa: F401 (registers the clients)
+    from agents.clients import get_client, set_client
+
+    from .fakes import (
+        FakeOpenAI,
+        FakeTavily,
+        LatencyModel,
+        RecordingOpenAI,
+        RecordingTavily,
+    )
+
+    if args.record:
+        set_client("openai", RecordingOpenAI(get_client("openai")))
+        set_client("tavily", RecordingTavily(get_client("tavily")))
+        return {}
+
+    rng = random.Random(args.seed)
+    models = {
+        "llm": LatencyModel(
+            args.llm_latency,
+            args.sigma,
+            args.llm_error_rate,
+            random.Random(rng.random()),
+        ),
+        "search": LatencyModel(
+            args.search_latency,
+            args.sigma,
+            args.search_error_rate,
+            random.Random(rng.random()),
+        ),
+    }
+    set_client("openai", FakeOpenAI(models["llm"]))
+    set_client("tavily", FakeTavily(models["search"]))
+    return models
+
+
+class StageTimer:
+    """
+    Records when each task enters each pipeline stage by observing the events
+    published on the task event bus.
+    """
+
+    def __init__(self, bus):
+        self.started = defaultdict(dict)
+        self.finished = {}
+        publish = bus.publish
+
+        def observe(task_id: str, event: dict):
+            now = time.perf_counter()
+            if event.get("state") in TERMINAL:
+                self.finished.setdefault(task_id, now)
+            elif event.get("stage") and "partial" not in event:
+                self.started[task_id].setdefault(event["stage"], now)
+            publish(task_id, event)
+
+        bus.publish = observe
+
+    def stage_times(self, task_id: str) -> dict:
+        """
+        Returns the seconds spent in each stage of a finished task.
+        """
+        stages = sorted(self.started[task_id].items(), key=lambda s: s[1])
+        ends = [start for _, start in stages[1:]] + [self.finished.get(task_id)]
+        return {
+            stage: end - start
+            for (stage, start), end in zip(stages, ends)
+            if end is not None
+        }
+
+    def first_stage(self, task_id: str) -> float:
+        starts = self.started[task_id].values()
+        return min(starts) if starts else None
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Returns the q-th percentile (0-100) of values, linearly interpolated.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def submit(http, payload: dict, outcome: dict) -> str:
+    """
+    Submits a request, waiting out 429 responses as the API asks.
+
+    Returns:
+        tuple: The task ID and when the accepted request was sent.
+    """
+    while True:
+        sent = time.perf_counter()
+        response = await http.post("/generate-itinerary", json=payload)
+        if response.status_code != 429:
+            response.raise_for_status()
+            return response.json()["task_id"], sent
+        outcome["rejections"] += 1
+        await asyncio.sleep(min(float(response.headers.get("Retry-After", 1)), 5))
+
+
+async def client(http, requests: asyncio.Queue, args, timer: StageTimer, runs: list):
+    while True:
+        try:
+            index = requests.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        locations = args.locations or args.requests
+        payload = {**REQUEST, "location": f"Paris {index % locations}, France"}
+        outcome = {"rejections": 0}
+        start = time.perf_counter()
+        try:
+            task_id, submitted = await submit(http, payload, outcome)
+            while True:
+                status = (await http.get(f"/task-status/{task_id}")).json()
+                if status["state"] in TERMINAL:
+                    break
+                await asyncio.sleep(args.poll_interval)
+        except Exception as e:
+            outcome.update(state="ERROR", error=repr(e))
+        else:
+            first_stage = timer.first_stage(task_id)
+            outcome.update(
+                state=status["state"],
+                latency=time.perf_counter() - start,
+                queue_wait=first_stage - submitted if first_stage else None,
+                stages=timer.stage_times(task_id),
+            )
+        runs.append(outcome)
+
+
+@contextlib.asynccontextmanager
+async def serve_app():
+    """
+    Serves the app in-process on a free local port, with its startup and
+    shutdown handlers.
+
+    Yields:
+        str: The base URL of the server.
+    """
+    import uvicorn
+
+    from main import app
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="on"))
+    serving = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await serving
+
+
+async def run_load(args, timer: StageTimer) -> tuple:
+    """
+    Serves the app on a local port and drives the requests through it.
+
+    Returns:
+        tuple: The outcome of each request and the wall-clock seconds taken.
+    """
+    import httpx
+
+    requests = asyncio.Queue()
+    for index in range(args.requests):
+        requests.put_nowait(index)
+    runs = []
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with serve_app() as base_url:
+        async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=60
+        ) as http:
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    client(http, requests, args, timer, runs)
+                    for _ in range(args.concurrency)
+                )
+            )
+            elapsed = time.perf_counter() - start
+    return runs, elapsed
+
+
+def report(args, runs: list, elapsed: float, models: dict, rss_at_start: float):
+    succeeded = [r for r in runs if r["state"] == "SUCCESS"]
+    stages = defaultdict(list)
+    for run in succeeded:
+        for stage, seconds in run["stages"].items():
+            stages[stage].append(seconds)
+    return {
+        "benchmark": "pipeline",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            k: v for k, v in vars(args).items() if k not in ("output", "compare")
+        },
+        "requests": {
+            "total": len(runs),
+            "succeeded": len(succeeded),
+            "failed": sum(r["state"] == "FAILED" for r in runs),
+            "errors": sum(r["state"] == "ERROR" for r in runs),
+            "rejections": sum(r["rejections"] for r in runs),
+        },
+        "wall_seconds": elapsed,
+        "throughput_rps": len(succeeded) / elapsed if elapsed else None,
+        "latency": summarize([r["latency"] for r in succeeded]),
+        "queue_wait": summarize(
+            [r["queue_wait"] for r in succeeded if r["queue_wait"] is not None]
+        ),
+        "stages": {stage: summarize(values) for stage, values in stages.items()},
+        "upstream": {name: model.stats() for name, model in models.items()},
+        "rss_mb": {"at_start": rss_at_start, "peak": peak_rss_mb()},
+    }
+
+
+def format_seconds(value) -> str:
+    return f"{value:8.3f}" if value is not None else f"{'-':>8}"
+
+
+def print_results(results: dict):
+    requests = results["requests"]
+    print(
+        f"{requests['succeeded']}/{requests['total']} succeeded, "
+        f"{requests['failed']} failed, {requests['errors']} client errors, "
+        f"{requests['rejections']} rejected with 429"
+    )
+    print(
+        f"{results['wall_seconds']:.2f}s wall, "
+        f"{results['throughput_rps'] or 0:.2f} itineraries/s, "
+        f"peak RSS {results['rss_mb']['peak']:.0f} MB"
+    )
+    print(f"\n{'seconds':<20} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    rows = [("end-to-end", results["latency"]), ("queue wait", results["queue_wait"])]
+    rows += [(f"  {stage}", stats) for stage, stats in results["stages"].items()]
+    for name, stats in rows:
+        print(
+            f"{name:<20} "
+            + " ".join(format_seconds(stats[k]) for k in ("mean", "p50", "p95", "p99"))
+        )
+    for name, stats in results["upstream"].items():
+        print(f"upstream {name}: {stats['calls']} calls, {stats['errors']} errors")
+
+
+def comparable_metrics(results: dict) -> dict:
+    """
+    Flattens the headline metrics of a run for comparison.
+    """
+    metrics = {"throughput_rps": results["throughput_rps"]}
+    for q in ("p50", "p95", "p99"):
+        metrics[f"latency_{q}"] = results["latency"][q]
+    metrics["queue_wait_p50"] = results["queue_wait"]["p50"]
+    for stage, stats in results["stages"].items():
+        metrics[f"stage_{stage}_mean"] = stats["mean"]
+    metrics["peak_rss_mb"] = results["rss_mb"]["peak"]
+    return metrics
+
+
+def print_comparison(baseline: dict, results: dict):
+    before, after = comparable_metrics(baseline), comparable_metrics(results)
+    print(
+        f"\nCompared to {baseline.get('git_revision')} ({baseline.get('timestamp')}):"
+    )
+    print(f"{'metric':<32} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in after:
+        old, new = before.get(name), after[name]
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old:+8.1%}" if old else f"{'-':>8}"
+        print(f"{name:<32} {old:10.3f} {new:10.3f} {change}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.record:
+        args.requests, args.concurrency = 1, 1
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        models = install_clients(args)
+        from events import task_events
+
+        timer = StageTimer(task_events)
+        rss_at_start = peak_rss_mb()
+        quiet = contextlib.nullcontext()
+        if not args.verbose:
+            quiet = contextlib.redirect_stdout(io.StringIO())
+        with quiet:
+            runs, elapsed = asyncio.run(run_load(args, timer))
+
+    results = report(args, runs, elapsed, models, rss_at_start)
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,584 @@
+"""
+A local stand-in for a Redis server, for running the Redis task store backend
+and event relay (``TASKS_BACKEND=redis``) without one.
+
+Speaks the Redis protocol over TCP and implements, in memory, the commands
+``db.redis_store`` and ``events.RedisEventRelay`` use: strings, hashes and
+sorted sets with expiry, optimistic transactions (WATCH/MULTI/EXEC) and
+publish/subscribe. Commands run one at a time on one event loop, so
+transactions are atomic as on Redis. Nothing is persisted. Run from the
+backend directory:
+
+    python -m benchmarks.redis_standin [--port 6379]
+
+or start one in a background thread with ``StandIn``.
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import socket
+import threading
+import time
+from collections import defaultdict
+
+
+class RedisError(Exception):
+    """
+    An error reply, e.g. to an unknown command.
+    """
+
+
+class Simple(str):
+    """
+    A simple string reply, e.g. OK.
+    """
+
+
+OK = Simple("OK")
+QUEUED = Simple("QUEUED")
+# Reply of EXEC when a watched key changed
+ABORTED = object()
+
+
+def encode_reply(reply) -> bytes:
+    if isinstance(reply, Simple):
+        return b"+%s\r\n" % reply.encode()
+    if isinstance(reply, RedisError):
+        return b"-%s\r\n" % str(reply).encode()
+    if isinstance(reply, bool) or isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if reply is None:
+        return b"$-1\r\n"
+    if reply is ABORTED:
+        return b"*-1\r\n"
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(map(encode_reply, reply))
+    if isinstance(reply, float):
+        reply = repr(reply).encode()
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+async def read_command(reader: asyncio.StreamReader) -> list:
+    """
+    Reads one command, sent by clients as an array of bulk strings.
+    """
+    line = await reader.readline()
+    if not line.startswith(b"*"):
+        raise ConnectionError("Connection closed by the client")
+    command = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+def score_bytes(score: float) -> bytes:
+    return (b"%d" % score) if score == int(score) else repr(score).encode()
+
+
+def parse_bound(value: bytes) -> tuple:
+    """
+    Parses a ZRANGEBYSCORE bound, e.g. "-inf", "1.5" or "(1.5" (exclusive).
+    """
+    exclusive = value.startswith(b"(")
+    return float(value[1:] if exclusive else value), exclusive
+
+
+class Store:
+    """
+    The keyspace: values by key, with expiry times and a version bumped on
+    every change for WATCH.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.versions = defaultdict(int)
+
+    def get(self, key: bytes, kind=None):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+        value = self.values.get(key)
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise RedisError(
+                "WRONGTYPE Operation against a key holding the wrong kind of value"
+            )
+        return value
+
+    def get_or_create(self, key: bytes, kind):
+        value = self.get(key, kind)
+        if value is None:
+            value = self.values[key] = kind()
+        return value
+
+    def touch(self, key: bytes):
+        self.versions[key] += 1
+        if (
+            key in self.values
+            and not self.values[key]
+            and not isinstance(self.values[key], bytes)
+        ):
+            # Empty hashes and sorted sets do not exist
+            self.delete(key)
+
+    def delete(self, key: bytes) -> bool:
+        self.expires.pop(key, None)
+        existed = self.values.pop(key, None) is not None
+        self.versions[key] += 1
+        return existed
+
+    def keys(self) -> list:
+        return [key for key in list(self.values) if self.get(key) is not None]
+
+
+class Commands:
+    """
+    The data commands, each taking the store and its arguments as bytes.
+    """
+
+    @staticmethod
+    def ping(store, *args):
+        return args[0] if args else Simple("PONG")
+
+    @staticmethod
+    def get(store, key):
+        return store.get(key, bytes)
+
+    @staticmethod
+    def set(store, key, value, *options):
+        options = [o.upper() for o in options]
+        exists = store.get(key) is not None
+        if (b"NX" in options and exists) or (b"XX" in options and not exists):
+            return None
+        store.delete(key)
+        store.values[key] = value
+        for unit, scale in ((b"EX", 1), (b"PX", 0.001)):
+            if unit in options:
+                seconds = int(options[options.index(unit) + 1]) * scale
+                store.expires[key] = time.time() + seconds
+        store.touch(key)
+        return OK
+
+    @staticmethod
+    def delete(store, *keys):
+        return sum(store.delete(key) for key in keys if store.get(key) is not None)
+
+    @staticmethod
+    def exists(store, *keys):
+        return sum(store.get(key) is not None for key in keys)
+
+    @staticmethod
+    def pexpire(store, key, milliseconds):
+        if store.get(key) is None:
+            return 0
+        store.expires[key] = time.time() + int(milliseconds) / 1000
+        store.touch(key)
+        return 1
+
+    @staticmethod
+    def expire(store, key, seconds):
+        return Commands.pexpire(store, key, int(seconds) * 1000)
+
+    @staticmethod
+    def persist(store, key):
+        if store.get(key) is None or store.expires.pop(key, None) is None:
+            return 0
+        store.touch(key)
+        return 1
+
+    @staticmethod
+    def pttl(store, key):
+        if store.get(key) is None:
+            return -2
+        expires = store.expires.get(key)
+        return -1 if expires is None else int((expires - time.time()) * 1000)
+
+    @staticmethod
+    def hset(store, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise RedisError("ERR wrong number of arguments for 'hset' command")
+        fields = store.get_or_create(key, dict)
+        added = sum(field not in fields for field in pairs[::2])
+        fields.update(zip(pairs[::2], pairs[1::2]))
+        store.touch(key)
+        return added
+
+    @staticmethod
+    def hsetnx(store, key, field, value):
+        fields = store.get_or_create(key, dict)
+        if field in fields:
+            return 0
+        fields[field] = value
+        store.touch(key)
+        return 1
+
+    @staticmethod
+    def hget(store, key, field):
+        return (store.get(key, dict) or {}).get(field)
+
+    @staticmethod
+    def hmget(store, key, *fields):
+        values = store.get(key, dict) or {}
+        return [values.get(field) for field in fields]
+
+    @staticmethod
+    def hgetall(store, key):
+        values = store.get(key, dict) or {}
+        return [part for item in values.items() for part in item]
+
+    @staticmethod
+    def hdel(store, key, *fields):
+        values = store.get(key, dict)
+        if values is None:
+            return 0
+        removed = sum(values.pop(field, None) is not None for field in fields)
+        store.touch(key)
+        return removed
+
+    @staticmethod
+    def hincrby(store, key, field, increment):
+        fields = store.get_or_create(key, dict)
+        value = int(fields.get(field, 0)) + int(increment)
+        fields[field] = b"%d" % value
+        store.touch(key)
+        return value
+
+    @staticmethod
+    def zadd(store, key, *args):
+        options = set()
+        while args and args[0].upper() in (b"NX", b"XX"):
+            options.add(args[0].upper())
+            args = args[1:]
+        scores = store.get(key, dict) if b"XX" in options else None
+        scores = scores if scores is not None else store.get_or_create(key, dict)
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            exists = member in scores
+            if (b"NX" in options and exists) or (b"XX" in options and not exists):
+                continue
+            added += not exists
+            scores[member] = float(score)
+        store.touch(key)
+        return added
+
+    @staticmethod
+    def zrem(store, key, *members):
+        scores = store.get(key, dict)
+        if scores is None:
+            return 0
+        removed = sum(scores.pop(member, None) is not None for member in members)
+        store.touch(key)
+        return removed
+
+    @staticmethod
+    def ordered(store, key) -> list:
+        scores = store.get(key, dict) or {}
+        return sorted(scores.items(), key=lambda item: (item[1], item[0]))
+
+    @staticmethod
+    def zrange(store, key, start, stop, *options):
+        entries = Commands.ordered(store, key)
+        start, stop = int(start), int(stop)
+        start = max(start + len(entries) if start < 0 else start, 0)
+        stop = stop + len(entries) if stop < 0 else stop
+        entries = entries[start : stop + 1]
+        if b"WITHSCORES" in (o.upper() for o in options):
+            return [part for m, s in entries for part in (m, score_bytes(s))]
+        return [member for member, _ in entries]
+
+    @staticmethod
+    def zrangebyscore(store, key, low, high, *options):
+        (low, low_open), (high, high_open) = parse_bound(low), parse_bound(high)
+        entries = [
+            (member, score)
+            for member, score in Commands.ordered(store, key)
+            if (low < score if low_open else low <= score)
+            and (score < high if high_open else score <= high)
+        ]
+        options = [o.upper() for o in options]
+        if b"LIMIT" in options:
+            offset, count = map(int, options[options.index(b"LIMIT") + 1 :][:2])
+            entries = entries[offset:] if count < 0 else entries[offset:][:count]
+        if b"WITHSCORES" in options:
+            return [part for m, s in entries for part in (m, score_bytes(s))]
+        return [member for member, _ in entries]
+
+    @staticmethod
+    def zrank(store, key, member):
+        members = [m for m, _ in Commands.ordered(store, key)]
+        return members.index(member) if member in members else None
+
+    @staticmethod
+    def zscore(store, key, member):
+        score = (store.get(key, dict) or {}).get(member)
+        return None if score is None else score_bytes(score)
+
+    @staticmethod
+    def zcard(store, key):
+        return len(store.get(key, dict) or {})
+
+    @staticmethod
+    def scan(store, cursor, *options):
+        options = list(options)
+        pattern = b"*"
+        if b"MATCH" in (o.upper() for o in options):
+            index = [o.upper() for o in options].index(b"MATCH")
+            pattern = options[index + 1]
+        keys = [k for k in store.keys() if fnmatch.fnmatchcase(k, pattern)]
+        return [b"0", keys]
+
+    @staticmethod
+    def dbsize(store):
+        return len(store.keys())
+
+    @staticmethod
+    def flushdb(store, *args):
+        for key in list(store.values):
+            store.delete(key)
+        return OK
+
+    @staticmethod
+    def auth(store, *args):
+        return OK
+
+    @staticmethod
+    def select(store, db):
+        return OK
+
+
+COMMANDS = {
+    name.encode().upper(): getattr(Commands, name)
+    for name in vars(Commands)
+    if not name.startswith("_") and name != "ordered"
+}
+COMMANDS[b"DEL"] = COMMANDS.pop(b"DELETE")
+
+
+class StandInServer:
+    """
+    The server: one keyspace shared by every connection.
+    """
+
+    def __init__(self):
+        self.store = Store()
+        # Subscribed connections' queues, by channel and by pattern
+        self.channels = defaultdict(set)
+        self.patterns = defaultdict(set)
+        self.connections = set()
+
+    def publish(self, channel: bytes, message: bytes) -> int:
+        receivers = 0
+        for queue in self.channels.get(channel, ()):
+            queue.put_nowait([b"message", channel, message])
+            receivers += 1
+        for pattern, queues in self.patterns.items():
+            if fnmatch.fnmatchcase(channel, pattern):
+                for queue in queues:
+                    queue.put_nowait([b"pmessage", pattern, channel, message])
+                    receivers += 1
+        return receivers
+
+    def run(self, args: list):
+        name, args = args[0].upper(), args[1:]
+        if name not in COMMANDS:
+            return RedisError(f"ERR unknown command '{name.decode()}'")
+        try:
+            return COMMANDS[name](self.store, *args)
+        except RedisError as e:
+            return e
+        except (TypeError, ValueError, IndexError) as e:
+            return RedisError(f"ERR {e}")
+
+    async def handle(self, reader, writer):
+        connection = Connection(self, writer)
+        self.connections.add(connection)
+        try:
+            while True:
+                try:
+                    command = await read_command(reader)
+                except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+                    return
+                writer.write(encode_reply(connection.run(command)))
+                await writer.drain()
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 6379, sock=None):
+        if sock is not None:
+            server = await asyncio.start_server(self.handle, sock=sock)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+class Connection:
+    """
+    One client connection's transaction and subscription state.
+    """
+
+    def __init__(self, server: StandInServer, writer):
+        self.server = server
+        self.writer = writer
+        self.watched = {}
+        self.queued = None
+        self.subscriptions = []
+        self.messages = None
+        self.forwarder = None
+
+    def run(self, command: list):
+        name = command[0].upper()
+        if name == b"MULTI":
+            if self.queued is not None:
+                return RedisError("ERR MULTI calls can not be nested")
+            self.queued = []
+            return OK
+        if name == b"EXEC":
+            if self.queued is None:
+                return RedisError("ERR EXEC without MULTI")
+            queued, self.queued = self.queued, None
+            store = self.server.store
+            changed = any(store.versions[k] != v for k, v in self.watched.items())
+            self.watched = {}
+            if changed:
+                return ABORTED
+            return [self.run(c) for c in queued]
+        if name == b"DISCARD":
+            self.queued, self.watched = None, {}
+            return OK
+        if self.queued is not None:
+            if name == b"WATCH":
+                return RedisError("ERR WATCH inside MULTI is not allowed")
+            self.queued.append(command)
+            return QUEUED
+        if name == b"WATCH":
+            for key in command[1:]:
+                self.server.store.get(key)
+                self.watched.setdefault(key, self.server.store.versions[key])
+            return OK
+        if name == b"UNWATCH":
+            self.watched = {}
+            return OK
+        if name == b"PUBLISH":
+            return self.server.publish(command[1], command[2])
+        if name in (b"SUBSCRIBE", b"PSUBSCRIBE"):
+            return self.subscribe(name, command[1:])
+        if name == b"UNSUBSCRIBE":
+            return self.unsubscribe(command[1:])
+        return self.server.run(command)
+
+    def subscribe(self, name: bytes, targets: list):
+        if self.messages is None:
+            self.messages = asyncio.Queue()
+            self.forwarder = asyncio.ensure_future(self.forward())
+        registry = (
+            self.server.channels if name == b"SUBSCRIBE" else self.server.patterns
+        )
+        replies = []
+        for target in targets:
+            registry[target].add(self.messages)
+            self.subscriptions.append((registry, target))
+            replies.append([name.lower(), target, len(self.subscriptions)])
+        # Each subscription is confirmed with its own reply
+        for reply in replies[:-1]:
+            self.writer.write(encode_reply(reply))
+        return replies[-1]
+
+    def unsubscribe(self, channels: list):
+        channels = channels or [
+            target
+            for registry, target in self.subscriptions
+            if registry is self.server.channels
+        ]
+        replies = []
+        for channel in channels:
+            self.subscriptions = [
+                (registry, target)
+                for registry, target in self.subscriptions
+                if registry is not self.server.channels or target != channel
+            ]
+            if channel in self.server.channels:
+                self.server.channels[channel].discard(self.messages)
+                if not self.server.channels[channel]:
+                    del self.server.channels[channel]
+            replies.append([b"unsubscribe", channel, len(self.subscriptions)])
+        if not replies:
+            return [b"unsubscribe", None, len(self.subscriptions)]
+        for reply in replies[:-1]:
+            self.writer.write(encode_reply(reply))
+        return replies[-1]
+
+    async def forward(self):
+        while True:
+            message = await self.messages.get()
+            self.writer.write(encode_reply(message))
+            await self.writer.drain()
+
+    def close(self):
+        for registry, target in self.subscriptions:
+            registry[target].discard(self.messages)
+            if not registry[target]:
+                del registry[target]
+        if self.forwarder:
+            self.forwarder.cancel()
+
+
+class StandIn:
+    """
+    Runs a stand-in server on a free local port in a background thread.
+
+        with StandIn() as url:
+            os.environ["REDIS_URL"] = url
+    """
+
+    def __enter__(self) -> str:
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        self.loop = asyncio.new_event_loop()
+        self.stopping = asyncio.Event()
+        started = threading.Event()
+
+        async def serve():
+            standin = StandInServer()
+            server = await asyncio.start_server(standin.handle, sock=sock)
+            started.set()
+            async with server:
+                await self.stopping.wait()
+                # Hang up on clients still connected
+                for connection in list(standin.connections):
+                    connection.writer.close()
+                while standin.connections:
+                    await asyncio.sleep(0.01)
+
+        self.thread = threading.Thread(
+            target=self.loop.run_until_complete, args=(serve(),), daemon=True
+        )
+        self.thread.start()
+        started.wait()
+        return f"redis://127.0.0.1:{port}/0"
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
+        self.loop.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args(argv)
+    print(f"Serving on redis://{args.host}:{args.port}/0")
+    try:
+        asyncio.run(StandInServer().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Latency benchmark for request logging and payload logging.
+
+Compares the previous setup against the current one:
+
+- before: ``BaseHTTPMiddleware`` logging through synchronous stream and file
+  handlers, with agents printing whole payloads to stdout;
+- after: the pure-ASGI ``RequestLoggingMiddleware`` logging through the
+  queue-backed handler, with payloads logged at DEBUG (and so skipped at the
+  default INFO level).
+
+Two endpoints are driven in-process at the given concurrency: a small status
+lookup, and one that also logs a formatted itinerary the way the formatter
+agent does. Both setups write to files in a temporary directory.
+
+Run from the backend directory:
+
+    python -m benchmarks.request_logging [--requests 2000] [--concurrency 32]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+import httpx
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from .pipeline import percentile
+
+PAYLOAD = [
+    {
+        "day": day,
+        "activity_recs": [
+            {
+                "title": f"Visit place {day}-{i}",
+                "description": "An enticing description of the place. " * 8,
+                "reasoning": "Matches the user's interests in art and food. " * 4,
+            }
+            for i in range(5)
+        ],
+    }
+    for day in range(1, 8)
+]
+TASK = {"id": "0" * 36, "state": "RUNNING", "result": None, "error": None}
+
+
+def legacy_app(log_path: str) -> FastAPI:
+    """
+    The app's logging as it was before: one synchronous FileHandler and
+    StreamHandler written to from the event loop, and print() for payloads.
+    """
+    logger = logging.getLogger("benchmark.legacy")
+    logger.propagate = False
+    formatter = logging.Formatter(
+        fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    stream_handler = logging.StreamHandler(sys.stdout)
+    file_handler = logging.FileHandler(log_path)
+    stream_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+    logger.handlers = [stream_handler, file_handler]
+    logger.setLevel(logging.INFO)
+
+    async def log_requests(request, call_next):
+        logger.info(f"Request: {request.method} {request.url}")
+        try:
+            response = await call_next(request)
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise e
+        return response
+
+    app = FastAPI()
+    app.add_middleware(BaseHTTPMiddleware, dispatch=log_requests)
+
+    @app.get("/task-status")
+    async def task_status():
+        return TASK
+
+    @app.get("/format")
+    async def format_itinerary():
+        print("Formatted Itinerary: ", PAYLOAD)
+        return TASK
+
+    return app
+
+
+def current_app() -> FastAPI:
+    from logger import configure_logging
+    from middleware import RequestLoggingMiddleware
+
+    configure_logging()
+    logger = logging.getLogger("agents.formatter")
+
+    app = FastAPI()
+    app.add_middleware(RequestLoggingMiddleware)
+
+    @app.get("/task-status")
+    async def task_status():
+        return TASK
+
+    @app.get("/format")
+    async def format_itinerary():
+        logger.debug("Formatted itinerary", extra={"payload": PAYLOAD})
+        return TASK
+
+    return app
+
+
+async def drive(app: FastAPI, path: str, requests: int, concurrency: int) -> dict:
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client(http):
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await http.get(path)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        # Warm up
+        await http.get(path)
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "rps": requests / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["LOG_FILE"] = os.path.join(workdir, "app.log")
+        # Both setups write their "stdout" to a file, like a log collector would
+        with open(os.path.join(workdir, "stdout.log"), "w") as stdout:
+            with contextlib.redirect_stdout(stdout):
+                apps = {
+                    "before": legacy_app(os.path.join(workdir, "legacy.log")),
+                    "after": current_app(),
+                }
+                results = {
+                    (name, path): asyncio.run(
+                        drive(app, path, args.requests, args.concurrency)
+                    )
+                    for path in ("/task-status", "/format")
+                    for name, app in apps.items()
+                }
+
+    print(f"{'endpoint':<14} {'setup':<7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for (name, path), r in results.items():
+        print(
+            f"{path:<14} {name:<7} {r['rps']:8.0f} {r['p50'] * 1e3:8.2f}"
+            f" {r['p99'] * 1e3:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark of recovering from pipeline failures, with the offline OpenAI and
+Tavily stand-ins of ``benchmarks.fakes`` failing ``--llm-error-rate`` of the
+completions and the client-side retries of each call disabled.
+
+Submits ``--requests`` distinct itinerary requests and, until each succeeds
+(or ``--max-attempts`` is reached), recovers its failures in one of three ways:
+
+- rerun: submit the request again as a new task, as clients had to before
+  tasks could be retried;
+- resume: ``POST /tasks/{id}/retry``, resuming from the last checkpoint;
+- stage: the same, with each stage first retried by its retry policy.
+
+Each mode runs in a fresh process. With ``--no-cache``, the search and LLM
+caches keep nothing, as when a rerun lands after they expired or on a worker
+that does not share them. Reports the wall time, the requests that
+succeeded, the recoveries needed and the upstream calls made per successful
+itinerary. Run from the backend directory:
+
+    python -m benchmarks.retry [--requests 40] [--llm-error-rate 0.3] [--no-cache]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+from .pipeline import TERMINAL, configure_environment, install_clients, serve_app
+
+LOCATIONS = ["Paris", "Rome", "Kyoto", "Lisbon", "Oslo", "Vienna", "Prague", "Seville"]
+MODES = ["rerun", "resume", "stage"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--search-latency", type=float, default=0.5)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--llm-error-rate", type=float, default=0.3)
+    parser.add_argument("--max-attempts", type=int, default=10)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=MODES)
+    args = parser.parse_args(argv)
+    # Settings expected by the pipeline benchmark helpers
+    args.record = False
+    args.search_error_rate = 0.0
+    return args
+
+
+def make_requests(args) -> list:
+    return [
+        {
+            "location": f"{LOCATIONS[i % len(LOCATIONS)]} {i}",
+            "time_range": "June",
+            "budget": "medium",
+            "accomm_type": "hotel",
+            "num_days": 3,
+            "interests": ["art", "food"],
+        }
+        for i in range(args.requests)
+    ]
+
+
+async def wait(http, task_id: str, args) -> str:
+    while True:
+        task = (await http.get(f"/task-status/{task_id}")).json()
+        if task["state"] in TERMINAL:
+            return task["state"]
+        await asyncio.sleep(args.poll_interval)
+
+
+async def run_request(http, request: dict, args) -> dict:
+    task_id = (await http.post("/generate-itinerary", json=request)).json()["task_id"]
+    recoveries = 0
+    while await wait(http, task_id, args) != "SUCCESS":
+        if recoveries + 1 >= args.max_attempts:
+            return {"succeeded": False, "recoveries": recoveries}
+        recoveries += 1
+        if args.mode == "rerun":
+            response = await http.post("/generate-itinerary", json=request)
+            task_id = response.json()["task_id"]
+        else:
+            (await http.post(f"/tasks/{task_id}/retry")).raise_for_status()
+    return {"succeeded": True, "recoveries": recoveries}
+
+
+async def measure(args) -> dict:
+    import httpx
+
+    async with serve_app() as base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+            start = time.perf_counter()
+            runs = await asyncio.gather(
+                *(run_request(http, r, args) for r in make_requests(args))
+            )
+            elapsed = time.perf_counter() - start
+    return {
+        "succeeded": sum(r["succeeded"] for r in runs),
+        "recoveries": sum(r["recoveries"] for r in runs),
+        "wall_seconds": elapsed,
+    }
+
+
+def run_mode(args) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        os.environ["LOG_LEVEL"] = "CRITICAL"
+        os.environ["LLM_MAX_RETRIES"] = "0"
+        os.environ["STREAM_PARTIAL_RESULTS"] = "0"
+        os.environ["STAGE_RETRY_BACKOFF"] = "0.1"
+        if args.no_cache:
+            for setting in (
+                "LLM_CACHE_TTL",
+                "SEARCH_CACHE_TTL",
+                "SEARCH_CACHE_STALE_TTL",
+            ):
+                os.environ[setting] = "0"
+        if args.mode != "stage":
+            os.environ["STAGE_RETRIES"] = ""
+        models = install_clients(args)
+        results = asyncio.run(measure(args))
+    results["upstream"] = {name: model.stats() for name, model in models.items()}
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.mode:
+        print(json.dumps(run_mode(args)))
+        return
+
+    print(
+        f"{args.requests} requests, {args.llm_error_rate:.0%} of completions failing,"
+        f" {args.workers} workers"
+    )
+    print(
+        f"{'mode':<8} {'ok':>4} {'recoveries':>11} {'wall s':>8}"
+        f" {'searches/ok':>12} {'llm calls/ok':>13}"
+    )
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.retry", *argv, "--mode", mode],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        ok = max(r["succeeded"], 1)
+        print(
+            f"{mode:<8} {r['succeeded']:4d} {r['recoveries']:11d}"
+            f" {r['wall_seconds']:8.2f}"
+            f" {r['upstream']['search']['calls'] / ok:12.2f}"
+            f" {r['upstream']['llm']['calls'] / ok:13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Startup benchmark: how long the API takes to import and to serve its first
+request.
+
+Each run is a fresh process, so nothing is cached between runs:
+
+- import: ``import main`` in a new interpreter;
+- first response: from launching ``uvicorn main:app`` until
+  ``GET /task-status/<id>`` first answers (with a 404, as the task does not
+  exist), polled every few milliseconds.
+
+The server runs against a temporary database, cache and log file with dummy
+API keys; no upstream calls are made. Medians over ``--runs`` are reported.
+
+Run from the backend directory:
+
+    python -m benchmarks.startup [--runs 5] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import main; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def environment(workdir: str) -> dict:
+    env = dict(os.environ)
+    env.update(
+        OPENAI_API_KEY="benchmark",
+        TAVILY_API_KEY="benchmark",
+        CACHE_DIR=os.path.join(workdir, "cache"),
+        TASKS_DB_PATH=os.path.join(workdir, "tasks.db"),
+        LOG_FILE=os.path.join(workdir, "app.log"),
+    )
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_import(env: dict) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=BACKEND_DIR,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def time_first_response(env: dict, timeout: float = 60) -> float:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/task-status/benchmark"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                urllib.request.urlopen(url, timeout=1)
+            except urllib.error.HTTPError:
+                # Any HTTP status means the app is serving
+                return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                if server.poll() is not None:
+                    raise RuntimeError("The server exited during startup")
+                time.sleep(0.005)
+            else:
+                return time.perf_counter() - start
+        raise TimeoutError(f"No response within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    imports, responses = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            env = environment(workdir)
+            imports.append(time_import(env))
+            responses.append(time_first_response(env))
+
+    results = {
+        "runs": args.runs,
+        "import_s": statistics.median(imports),
+        "first_response_s": statistics.median(responses),
+    }
+    print(f"import main:     {results['import_s'] * 1e3:7.0f} ms (median)")
+    print(f"first response:  {results['first_response_s'] * 1e3:7.0f} ms (median)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
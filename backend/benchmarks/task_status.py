@@ -0,0 +1,142 @@
+"""
+Benchmark for polling ``GET /task-status`` on a finished task.
+
+Stores one SUCCESS task with a week-long formatted itinerary in a temporary
+database, then polls its status in-process from ``--concurrency`` clients in
+three ways:
+
+- plain: no compression, no conditional requests;
+- gzip: with ``Accept-Encoding: gzip``;
+- conditional: with gzip, sending back the last ETag in If-None-Match, the way
+  a browser revalidates a ``Cache-Control: no-cache`` response.
+
+Reports the stored result size, throughput, latency and bytes sent per
+response. Run from the backend directory:
+
+    python -m benchmarks.task_status [--requests 3000] [--concurrency 16]
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+import httpx
+
+from .pipeline import percentile
+
+RESULT = {
+    "accomm_recs": [
+        {
+            "name": f"Hotel {i}",
+            "link": f"https://example.com/hotels/{i}",
+            "image": f"https://images.example.com/hotels/{i}.jpg",
+            "description": "A comfortable hotel close to the old town. " * 3,
+        }
+        for i in range(5)
+    ],
+    "itinerary": [
+        {
+            "day": day,
+            "activity_recs": [
+                {
+                    "title": f"Visit place {day}-{i}",
+                    "description": "An enticing description of the place. " * 6,
+                    "reasoning": "Matches the user's interests in art and food. " * 3,
+                    "image": f"https://images.example.com/places/{day}-{i}.jpg",
+                    "lat": 48.85 + day / 100,
+                    "lon": 2.35 + i / 100,
+                }
+                for i in range(5)
+            ],
+        }
+        for day in range(1, 8)
+    ],
+}
+
+SCENARIOS = {
+    "plain": {"Accept-Encoding": "identity"},
+    "gzip": {"Accept-Encoding": "gzip"},
+    "conditional": {"Accept-Encoding": "gzip"},
+}
+
+
+async def poll(app, task_id: str, scenario: str, requests: int, concurrency: int):
+    latencies, sizes = [], []
+    remaining = iter(range(requests))
+    path = f"/task-status/{task_id}"
+
+    async def client(http):
+        etag = None
+        for _ in remaining:
+            headers = dict(SCENARIOS[scenario])
+            if scenario == "conditional" and etag:
+                headers["If-None-Match"] = etag
+            start = time.perf_counter()
+            response = await http.get(path, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            sizes.append(response.num_bytes_downloaded)
+            etag = response.headers.get("etag", etag)
+            if response.status_code not in (200, 304):
+                response.raise_for_status()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        # Warm up
+        await http.get(path)
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "rps": requests / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "bytes": sum(sizes) / len(sizes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["TASKS_DB_PATH"] = os.path.join(workdir, "tasks.db")
+        os.environ["CACHE_DIR"] = os.path.join(workdir, "cache")
+        os.environ["LOG_FILE"] = ""
+        os.environ["LOG_LEVEL"] = "WARNING"
+        from db.db import init_db, store_task
+        from db.sqlite_store import DB_PATH
+        from main import app
+
+        init_db()
+        task_id = str(uuid.uuid4())
+        store_task(task_id, "SUCCESS", RESULT)
+        with sqlite3.connect(DB_PATH) as conn:
+            stored = conn.execute(
+                "SELECT LENGTH(result) FROM tasks WHERE id = ?", (task_id,)
+            ).fetchone()[0]
+
+        print(f"stored result: {stored} bytes")
+        print(
+            f"{'scenario':<12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'bytes/resp':>11}"
+        )
+        for scenario in SCENARIOS:
+            r = asyncio.run(
+                poll(app, task_id, scenario, args.requests, args.concurrency)
+            )
+            print(
+                f"{scenario:<12} {r['rps']:8.0f} {r['p50'] * 1e3:8.2f}"
+                f" {r['p99'] * 1e3:8.2f} {r['bytes']:11.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Throughput benchmark for the task store under mixed read/write load.
+
+Compares the pooled WAL-mode store in ``db.sqlite_store`` against the previous
+approach of opening a new connection (rollback journal) for every call. Each
+worker thread performs a mix of ``get_task`` and ``store_task`` calls against a
+temporary database.
+
+Run from the backend directory:
+
+    python -m benchmarks.task_store [--threads 8] [--ops 2000] [--write-ratio 0.2]
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+RESULT = {
+    "accomm_recs": [{"name": "Hotel", "link": "https://example.com", "image": None}],
+    "itinerary": [
+        {"day": d, "activity_recs": [{"title": "t" * 40, "description": "d" * 200}] * 5}
+        for d in range(1, 6)
+    ],
+}
+
+
+class ConnectPerCallStore:
+    """
+    The task store as it was before pooling: one connection per call.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        conn = sqlite3.connect(path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, state TEXT, result TEXT)"
+        )
+        conn.commit()
+        conn.close()
+
+    def store_task(self, task_id, state, result=None):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?)",
+            (task_id, state, json.dumps(result) if result else None),
+        )
+        conn.commit()
+        conn.close()
+
+    def get_task(self, task_id):
+        conn = sqlite3.connect(self.path, timeout=30)
+        task = conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        conn.close()
+        return task
+
+
+class PooledStore:
+    """
+    Adapter exposing the ``db.sqlite_store`` module functions against a given path.
+    """
+
+    def __init__(self, path: str, pool_size: int):
+        from db import sqlite_store as db
+
+        db.pool = db.ConnectionPool(path, pool_size)
+        db.init_db()
+        self.db = db
+
+    def store_task(self, task_id, state, result=None):
+        self.db.store_task(task_id, state, result)
+
+    def get_task(self, task_id):
+        return self.db.get_task(task_id)
+
+
+def run(store, threads: int, ops: int, write_ratio: float) -> dict:
+    task_ids = [str(uuid.uuid4()) for _ in range(200)]
+    for task_id in task_ids:
+        store.store_task(task_id, "SUCCESS", RESULT)
+
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local = []
+        for _ in range(ops):
+            start = time.perf_counter()
+            if rng.random() < write_ratio:
+                store.store_task(rng.choice(task_ids), "RUNNING")
+            else:
+                store.get_task(rng.choice(task_ids))
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "ops_per_sec": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1e3,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=2000, help="operations per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            "connect per call": run(
+                ConnectPerCallStore(os.path.join(tmp, "legacy.db")),
+                args.threads,
+                args.ops,
+                args.write_ratio,
+            ),
+            "pooled + WAL": run(
+                PooledStore(os.path.join(tmp, "pooled.db"), args.pool_size),
+                args.threads,
+                args.ops,
+                args.write_ratio,
+            ),
+        }
+
+    print(
+        f"threads={args.threads} ops/thread={args.ops} write_ratio={args.write_ratio}"
+    )
+    for name, r in results.items():
+        print(
+            f"{name:18} {r['ops_per_sec']:10.0f} ops/s"
+            f"   p50 {r['p50_ms']:7.3f} ms   p99 {r['p99_ms']:7.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
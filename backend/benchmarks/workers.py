@@ -0,0 +1,210 @@
+"""
+Benchmark of running itinerary jobs in separate worker processes that share
+the task store, with the offline OpenAI and Tavily stand-ins of
+``benchmarks.fakes``.
+
+Serves the API from this process without job workers, starts ``--workers``
+processes running ``worker.py``'s loop, and follows each of ``--requests``
+itineraries through ``/task-events`` until it finishes. ``--kill-after``
+seconds in, one worker is killed (SIGKILL), as if it crashed; the jobs it was
+running are requeued once their leases (``--lease-ttl``) expire.
+
+Runs once with each task store backend, in a fresh process: "sqlite", a
+database file shared on this host, and "redis", the local stand-in of
+``benchmarks.redis_standin``. Reports wall time, the itineraries that
+succeeded, the progress events clients received per itinerary and how long
+clients waited to learn each outcome. Run from the backend directory:
+
+    python -m benchmarks.workers [--requests 40] [--workers 3] [--kill-after 3]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+
+from .pipeline import (
+    REQUEST,
+    TERMINAL,
+    configure_environment,
+    install_clients,
+    percentile,
+    serve_app,
+)
+
+BACKENDS = ["sqlite", "redis"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs per worker")
+    parser.add_argument("--kill-after", type=float, default=3.0, help="0: no crash")
+    parser.add_argument("--lease-ttl", type=float, default=3.0)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--search-latency", type=float, default=0.5)
+    parser.add_argument("--sigma", type=float, default=0.3)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=BACKENDS)
+    # Internal: run as one of the worker processes
+    parser.add_argument("--worker-of", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    # Settings expected by the pipeline benchmark helpers
+    args.record = False
+    args.llm_error_rate = args.search_error_rate = 0.0
+    return args
+
+
+def configure(args, workdir: str):
+    configure_environment(args, workdir)
+    os.environ["TASKS_BACKEND"] = args.backend
+    os.environ["TASK_LEASE_TTL"] = str(args.lease_ttl)
+    os.environ["LOG_LEVEL"] = "CRITICAL"
+    os.environ["WARM_UP"] = "0"
+
+
+def run_worker(args):
+    """
+    Runs ``worker.py``'s loop with the fake upstream clients.
+    """
+    configure(args, args.worker_of)
+    os.environ["JOB_WORKERS"] = str(args.concurrency)
+    install_clients(args)
+    import worker
+
+    asyncio.run(worker.main())
+
+
+def start_workers(args, workdir: str) -> list:
+    return [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.workers",
+                *sys.argv[1:],
+                "--worker-of",
+                workdir,
+                "--seed",
+                str(args.seed + 1 + i),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for i in range(args.workers)
+    ]
+
+
+async def follow(http, index: int) -> dict:
+    """
+    Submits a request and reads its event stream until it finishes.
+    """
+    payload = {**REQUEST, "location": f"Paris {index}, France"}
+    start = time.perf_counter()
+    task_id = (await http.post("/generate-itinerary", json=payload)).json()["task_id"]
+    events, state = 0, None
+    async with http.stream("GET", f"/task-events/{task_id}") as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            events += 1
+            state = json.loads(line[len("data: ") :])["state"]
+            if state in TERMINAL:
+                break
+    return {"state": state, "events": events, "latency": time.perf_counter() - start}
+
+
+async def measure(args, workers: list) -> dict:
+    import httpx
+
+    async def crash():
+        await asyncio.sleep(args.kill_after)
+        workers[0].kill()
+
+    async with serve_app() as base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=300) as http:
+            # Let the workers start polling the queue
+            await asyncio.sleep(2)
+            start = time.perf_counter()
+            crashing = asyncio.create_task(crash()) if args.kill_after > 0 else None
+            runs = await asyncio.gather(
+                *(follow(http, i) for i in range(args.requests))
+            )
+            elapsed = time.perf_counter() - start
+            if crashing:
+                crashing.cancel()
+    succeeded = [r for r in runs if r["state"] == "SUCCESS"]
+    latencies = [r["latency"] for r in succeeded]
+    return {
+        "succeeded": len(succeeded),
+        "wall_seconds": elapsed,
+        "events_per_itinerary": sum(r["events"] for r in runs) / len(runs),
+        "latency_p50": percentile(latencies, 50),
+        "latency_max": max(latencies) if latencies else None,
+    }
+
+
+def run_backend(args) -> dict:
+    from .redis_standin import StandIn
+
+    with tempfile.TemporaryDirectory() as workdir:
+        with StandIn() as url:
+            os.environ["REDIS_URL"] = url
+            configure(args, workdir)
+            # Jobs only run in the worker processes
+            os.environ["JOB_WORKERS"] = "0"
+            processes = start_workers(args, workdir)
+            try:
+                return asyncio.run(measure(args, processes))
+            finally:
+                for process in processes:
+                    process.kill()
+                    process.wait()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.worker_of:
+        run_worker(args)
+        return
+    if args.backend:
+        print(json.dumps(run_backend(args)))
+        return
+
+    print(
+        f"{args.requests} itineraries, {args.workers} worker processes of"
+        f" {args.concurrency} jobs"
+        + (f", one killed after {args.kill_after:g}s" if args.kill_after > 0 else "")
+        + f", {args.lease_ttl:g}s leases"
+    )
+    print(
+        f"{'backend':<8} {'ok':>4} {'wall s':>8} {'events/itinerary':>17}"
+        f" {'p50 s':>7} {'max s':>7}"
+    )
+    for backend in BACKENDS:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.workers", *argv, "--backend", backend],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{backend:<8} {r['succeeded']:4d} {r['wall_seconds']:8.2f}"
+            f" {r['events_per_itinerary']:17.1f} {r['latency_p50']:7.2f}"
+            f" {r['latency_max']:7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Settings, task states and result encoding shared by the task store backends
+(see ``db.db``).
+"""
+
+import json
+import os
+import socket
+import uuid
+import zlib
+
+# Finished tasks are deleted this many seconds after their last update
+RETENTION = float(os.getenv("TASK_RETENTION", 7 * 24 * 60 * 60))
+# Unfinished tasks not updated for this long are assumed abandoned and failed
+STALE_AFTER = float(os.getenv("TASK_STALE_AFTER", 60 * 60))
+SWEEP_INTERVAL = float(os.getenv("TASK_SWEEP_INTERVAL", 10 * 60))
+# zlib level used for stored results, 1 (fastest) to 9 (smallest)
+RESULT_COMPRESSION_LEVEL = int(os.getenv("TASK_RESULT_COMPRESSION_LEVEL", 6))
+# Checkpoints not updated for this long are deleted, even if the task could
+# still be retried
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL", 24 * 60 * 60))
+# Seconds a worker holds a RUNNING task for without renewing its lease. Tasks
+# whose lease expires, e.g. because their worker crashed, are requeued.
+LEASE_TTL = float(os.getenv("TASK_LEASE_TTL", 30))
+# How often workers renew the leases of their running tasks and look for
+# expired leases
+HEARTBEAT_INTERVAL = float(os.getenv("TASK_HEARTBEAT_INTERVAL", LEASE_TTL / 3))
+# Times a task may be claimed before an expired lease fails it rather than
+# requeueing it, so that a job that crashes its worker is not run forever
+MAX_CLAIMS = int(os.getenv("TASK_MAX_CLAIMS", 3))
+# Identifies this process as the holder of task leases
+WORKER_ID = os.getenv("WORKER_ID") or (
+    f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+)
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+TERMINAL_STATES = {SUCCESS, FAILED, CANCELLED}
+
+# Error stored with tasks failed by the sweeper
+ABANDONED = {"message": "Task abandoned"}
+# Error stored with tasks failed after their lease expired
+LEASE_EXPIRED = {
+    "type": "LeaseExpired",
+    "message": "The worker running the task stopped responding",
+}
+
+
+def encode_result(result: dict) -> bytes:
+    """
+    Encodes a task result for storage as compressed, compact JSON.
+    """
+    if not result:
+        return None
+    text = json.dumps(result, separators=(",", ":"), ensure_ascii=False)
+    return zlib.compress(text.encode(), RESULT_COMPRESSION_LEVEL)
+
+
+def decode_result(value) -> dict:
+    """
+    Decodes a stored task result. Results stored as JSON text by older
+    versions are read as-is.
+    """
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = zlib.decompress(value)
+    return json.loads(value)
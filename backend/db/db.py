@@ -1,74 +1,119 @@
 """
 This module contains the database functions to store and retrieve tasks.
-"""
 
-import sqlite3
-import json
+Tasks are kept by one of two backends, chosen with ``TASKS_BACKEND``:
 
+- "sqlite" (``db.sqlite_store``): a SQLite file, shared by the processes of
+  one host;
+- "redis" (``db.redis_store``): a Redis server, shared by processes on any
+  number of hosts, e.g. several uvicorn workers and ``worker.py`` replicas
+  behind a load balancer.
 
-def init_db():
-    """
-    Initializes the database by creating the tasks table if it doesn't exist.
-    """
-    conn = sqlite3.connect("tasks.db")
-    c = conn.cursor()
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS tasks
-           (id TEXT PRIMARY KEY, state TEXT, result TEXT)"""
-    )
-    conn.commit()
-    conn.close()
+Both offer the functions below, with the same behaviour. Each task moves
+through PENDING -> RUNNING -> SUCCESS or FAILED, or is CANCELLED; finished
+tasks are deleted after ``RETENTION``.
 
+Tasks submitted as part of a batch carry its ``batch_id``. They are run by the
+batch runner rather than claimed from the job queue, and share their pipeline
+with identical tasks submitted on their own (see ``find_inflight`` and
+``adopt_queued``).
 
-def store_task(task_id: str, state: str, result: dict = None):
-    """
-    Stores a task in the database.
+Results are stored as zlib-compressed JSON. Every write to a task increments
+its ``version``, so readers can tell whether a task changed without reading
+its result.
 
-    Args:
-        task_id (str): The unique identifier for the task.
-        state (str): The current state of the task.
-        result (dict, optional): The result of the task. Defaults to None.
-    """
-    conn = sqlite3.connect("tasks.db")
-    c = conn.cursor()
-    c.execute(
-        "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?)",
-        (task_id, state, json.dumps(result) if result else None),
-    )
-    conn.commit()
-    conn.close()
+Successful tasks also keep, as their ``context``, the recommendations their
+itinerary was planned from, so that it can be edited later (see ``edits``).
 
+While a task's pipeline runs, the output of its last completed stage is kept
+as a checkpoint, stored the same way, so that a FAILED task can be retried
+from where it stopped. Checkpoints are deleted once the task succeeds, and by
+the sweeper once the task is gone or no longer resumable, or after
+``CHECKPOINT_TTL``.
 
-def get_task(task_id: str) -> dict:
-    """
-    Retrieves a task from the database.
+A RUNNING task is leased to the worker process running it, which renews the
+lease every ``HEARTBEAT_INTERVAL`` seconds (see ``jobs.heartbeat``). If the
+worker stops doing so, e.g. because it crashed, the lease expires after
+``LEASE_TTL`` seconds and the task is requeued, resuming from its checkpoint.
 
-    Args:
-        task_id (str): The unique identifier for the task.
+Tasks that clients follow are marked as watched while they do, so that those
+the clients have stopped following can be cancelled (see
+``jobs.cancel_unwatched``).
+"""
 
-    Returns:
-        dict: The task details, or None if the task is not found.
-    """
-    conn = sqlite3.connect("tasks.db")
-    c = conn.cursor()
-    c.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
-    task = c.fetchone()
-    conn.close()
-    if task:
-        return {
-            "id": task[0],
-            "state": task[1],
-            "result": json.loads(task[2]) if task[2] else None,
-        }
-    return None
-
-
-def drop_db():
+import asyncio
+import logging
+import os
+
+from db.base import (
+    CANCELLED,
+    CHECKPOINT_TTL,
+    FAILED,
+    HEARTBEAT_INTERVAL,
+    LEASE_TTL,
+    MAX_CLAIMS,
+    PENDING,
+    RETENTION,
+    RUNNING,
+    STALE_AFTER,
+    SUCCESS,
+    SWEEP_INTERVAL,
+    TERMINAL_STATES,
+    WORKER_ID,
+)
+
+logger = logging.getLogger(__name__)
+
+# The task store backend: "sqlite" or "redis"
+TASKS_BACKEND = os.getenv("TASKS_BACKEND", "sqlite")
+
+if TASKS_BACKEND == "sqlite":
+    from db import sqlite_store as backend
+elif TASKS_BACKEND == "redis":
+    from db import redis_store as backend
+else:
+    raise ValueError(f"Unknown TASKS_BACKEND: {TASKS_BACKEND}")
+
+init_db = backend.init_db
+store_task = backend.store_task
+get_task = backend.get_task
+get_task_context = backend.get_task_context
+update_result = backend.update_result
+enqueue_task = backend.enqueue_task
+find_inflight = backend.find_inflight
+adopt_queued = backend.adopt_queued
+attach_to_inflight = backend.attach_to_inflight
+resolve_followers = backend.resolve_followers
+claim_next_task = backend.claim_next_task
+start_task = backend.start_task
+cancel_task = backend.cancel_task
+retry_task = backend.retry_task
+save_checkpoint = backend.save_checkpoint
+load_checkpoint = backend.load_checkpoint
+delete_checkpoint = backend.delete_checkpoint
+aborted_tasks = backend.aborted_tasks
+queue_depth = backend.queue_depth
+queue_position = backend.queue_position
+create_batch = backend.create_batch
+get_batch = backend.get_batch
+touch_batch = backend.touch_batch
+touch_watched = backend.touch_watched
+unwatched_tasks = backend.unwatched_tasks
+renew_leases = backend.renew_leases
+expire_leases = backend.expire_leases
+sweep_tasks = backend.sweep_tasks
+drop_db = backend.drop_db
+
+
+async def retention_sweeper(interval: float = SWEEP_INTERVAL):
     """
-    Drops the tasks table from the database.
+    Runs ``sweep_tasks`` every ``interval`` seconds until cancelled.
     """
-    conn = sqlite3.connect("tasks.db")
-    c = conn.cursor()
-    c.execute("DROP TABLE tasks")
-    conn.commit()
-    conn.close()
+    while True:
+        try:
+            swept = await asyncio.to_thread(sweep_tasks)
+            if any(swept.values()):
+                logger.info("Task sweep", extra=swept)
+        except Exception as e:
+            logger.exception("Task sweep failed")
+        await asyncio.sleep(interval)
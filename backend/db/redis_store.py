@@ -0,0 +1,972 @@
+"""
+The Redis task store backend (see ``db.db``), for deployments whose web and
+worker processes run on several hosts.
+
+Each task is a hash, ``<prefix>task:<id>``, with the fields of the SQLite
+store's columns. Sorted sets index tasks by what the store looks them up by:
+
+- ``queue``: the PENDING tasks workers claim, by priority, then age;
+- ``active``: PENDING and RUNNING tasks, by last update, for the sweeper;
+- ``leases``: RUNNING tasks, by when their lease expires;
+- ``watched``: PENDING and RUNNING tasks clients follow, by when they last did;
+- ``followers:<id>``: the tasks attached to a task, by age.
+
+``inflight:<fingerprint>`` points at the task running a request. Batches and
+checkpoints are hashes of their own.
+
+State transitions WATCH what they read and apply their writes in one
+MULTI/EXEC transaction, which runs again if a watched key changed in the
+meantime, so that e.g. two workers never claim the same task. Instead of being
+deleted by the sweeper, finished tasks expire ``RETENTION`` seconds after
+their last update and checkpoints ``CHECKPOINT_TTL`` seconds after theirs.
+"""
+
+import json
+import logging
+import os
+import time
+
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+from db.base import (
+    ABANDONED,
+    CANCELLED,
+    CHECKPOINT_TTL,
+    FAILED,
+    LEASE_EXPIRED,
+    LEASE_TTL,
+    MAX_CLAIMS,
+    PENDING,
+    RETENTION,
+    RUNNING,
+    STALE_AFTER,
+    SUCCESS,
+    TERMINAL_STATES,
+    WORKER_ID,
+    decode_result,
+    encode_result,
+)
+
+logger = logging.getLogger(__name__)
+
+# redis:// or, for TLS, rediss://
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 8))
+# Seconds to wait for a pooled connection, and for Redis to reply
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", 5))
+# Retries of commands that failed to reach Redis, e.g. after a failover
+REDIS_MAX_RETRIES = int(os.getenv("REDIS_MAX_RETRIES", 3))
+# Prepended to every key and channel, so that deployments can share a server
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "travelforge:")
+
+# Orders the job queue by priority, then by creation time
+PRIORITY_WEIGHT = 1e10
+
+
+def key(*parts: str) -> str:
+    return REDIS_KEY_PREFIX + ":".join(parts)
+
+
+QUEUE = key("queue")
+ACTIVE = key("active")
+LEASES = key("leases")
+WATCHED = key("watched")
+
+
+def connection_options(retry_class=Retry) -> dict:
+    """
+    Returns the options of connections to ``REDIS_URL``, shared with the event
+    relay, which passes the asyncio ``retry_class``: commands time out after
+    ``REDIS_TIMEOUT`` seconds and are retried, on a new connection, when Redis
+    cannot be reached.
+    """
+    return {
+        "socket_connect_timeout": REDIS_TIMEOUT,
+        "socket_timeout": REDIS_TIMEOUT,
+        "retry": retry_class(ExponentialBackoff(cap=1), REDIS_MAX_RETRIES),
+        "retry_on_error": [redis.ConnectionError, redis.TimeoutError],
+    }
+
+
+# Waits up to REDIS_TIMEOUT seconds for a connection when all are in use
+client = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=REDIS_POOL_SIZE,
+        timeout=REDIS_TIMEOUT,
+        **connection_options(),
+    )
+)
+
+
+def text(value: bytes) -> str:
+    return value.decode() if value is not None else None
+
+
+def milliseconds(seconds: float) -> int:
+    return max(1, int(seconds * 1000))
+
+
+def queue_score(priority, created_at) -> float:
+    return int(priority or 0) * PRIORITY_WEIGHT + float(created_at)
+
+
+def transaction(fn, *keys: str):
+    """
+    Runs ``fn(pipe)`` as an optimistic transaction. ``fn`` reads through
+    ``pipe`` with ``keys`` watched, watching more keys as needed, then calls
+    ``pipe.multi()`` and queues its writes. If a watched key changed in the
+    meantime, nothing is written and ``fn`` runs again.
+
+    Returns:
+        The value returned by ``fn`` on its last run.
+    """
+    return client.transaction(fn, *keys, value_from_callable=True)
+
+
+def read(conn, task_id: str, *fields: str) -> dict:
+    """
+    Reads fields of a task's hash, as bytes (None if missing).
+    """
+    return dict(zip(fields, conn.hmget(key("task", task_id), fields)))
+
+
+def read_states(task_ids: list) -> list:
+    if not task_ids:
+        return []
+    with client.pipeline(transaction=False) as pipe:
+        for task_id in task_ids:
+            pipe.hget(key("task", task_id), "state")
+        return [text(state) for state in pipe.execute()]
+
+
+def read_followers(conn, task_id: str, watch: bool = False) -> list:
+    """
+    Returns ``(task_id, created_at, state)`` for each task attached to a task,
+    oldest first, optionally watching them.
+    """
+    entries = conn.zrange(key("followers", task_id), 0, -1, withscores=True)
+    ids = [text(follower_id) for follower_id, _ in entries]
+    if watch and ids:
+        conn.watch(*(key("task", i) for i in ids))
+    states = [text(conn.hget(key("task", i), "state")) for i in ids]
+    return list(zip(ids, (score for _, score in entries), states))
+
+
+def write(pipe, task_id: str, now: float, state: str, **fields):
+    """
+    Queues the commands that update a task to ``state``: set its fields
+    (removing those set to None), increment its version and keep the indexes
+    and its expiry in line with the state.
+    """
+    task_key = key("task", task_id)
+    fields = {"state": state, "updated_at": now, **fields}
+    pipe.hset(task_key, mapping={f: v for f, v in fields.items() if v is not None})
+    removed = [field for field, value in fields.items() if value is None]
+    if removed:
+        pipe.hdel(task_key, *removed)
+    pipe.hincrby(task_key, "version", 1)
+    if state in TERMINAL_STATES:
+        pipe.zrem(QUEUE, task_id)
+        pipe.zrem(ACTIVE, task_id)
+        pipe.zrem(LEASES, task_id)
+        pipe.zrem(WATCHED, task_id)
+        pipe.pexpire(task_key, milliseconds(RETENTION))
+        pipe.pexpire(key("followers", task_id), milliseconds(RETENTION))
+        if state != FAILED:
+            # Only failed tasks can be resumed
+            pipe.delete(key("checkpoint", task_id))
+    else:
+        pipe.zadd(ACTIVE, {task_id: now})
+        pipe.persist(task_key)
+        pipe.persist(key("followers", task_id))
+        pipe.zrem(QUEUE if state == RUNNING else LEASES, task_id)
+
+
+def lease(pipe, task_id: str, worker_id: str):
+    """
+    Queues the commands that move a task to RUNNING, leased to ``worker_id``.
+    """
+    now = time.time()
+    lease_until = now + LEASE_TTL
+    write(pipe, task_id, now, RUNNING, worker_id=worker_id, lease_until=lease_until)
+    pipe.hincrby(key("task", task_id), "claims", 1)
+    pipe.zadd(LEASES, {task_id: lease_until})
+
+
+def init_db():
+    """
+    Checks that the Redis server can be reached; keys need no setup.
+    """
+    client.ping()
+
+
+def store_task(
+    task_id: str,
+    state: str,
+    result: dict = None,
+    error: dict = None,
+    context: dict = None,
+):
+    """
+    Stores a task, unless it has been cancelled.
+    """
+    task_key = key("task", task_id)
+
+    def upsert(pipe):
+        if text(pipe.hget(task_key, "state")) == CANCELLED:
+            return
+        now = time.time()
+        pipe.multi()
+        pipe.hsetnx(task_key, "created_at", now)
+        write(
+            pipe,
+            task_id,
+            now,
+            state,
+            result=encode_result(result),
+            error=json.dumps(error) if error else None,
+            context=encode_result(context),
+        )
+
+    transaction(upsert, task_key)
+
+
+def get_task(task_id: str, include_result: bool = True) -> dict:
+    """
+    Retrieves a task, optionally without reading its result.
+
+    Returns:
+        dict: The task details, or None if the task is not found.
+    """
+    fields = ["state", "error", "created_at", "updated_at", "leader_id", "version"]
+    if include_result:
+        fields.append("result")
+    task = read(client, task_id, *fields)
+    if task["state"] is None:
+        return None
+    return {
+        "id": task_id,
+        "state": text(task["state"]),
+        "result": decode_result(task.get("result")),
+        "error": json.loads(task["error"]) if task["error"] else None,
+        "created_at": float(task["created_at"] or 0),
+        "updated_at": float(task["updated_at"] or 0),
+        "leader_id": text(task["leader_id"]),
+        "version": int(task["version"] or 0),
+    }
+
+
+def get_task_context(task_id: str) -> dict:
+    """
+    Retrieves what editing a task's result needs.
+
+    Returns:
+        dict: The task's "state", "result", "context" and "version", or None
+        if the task is not found.
+    """
+    task = read(client, task_id, "state", "result", "context", "version")
+    if task["state"] is None:
+        return None
+    return {
+        "state": text(task["state"]),
+        "result": decode_result(task["result"]),
+        "context": decode_result(task["context"]),
+        "version": int(task["version"] or 0),
+    }
+
+
+def update_result(task_id: str, version: int, result: dict, context: dict) -> bool:
+    """
+    Replaces the result and context of a SUCCESS task, unless the task has
+    changed since ``version`` was read.
+
+    Returns:
+        bool: False if the task was changed in the meantime.
+    """
+
+    def update(pipe):
+        task = read(pipe, task_id, "state", "version")
+        if text(task["state"]) != SUCCESS or int(task["version"] or 0) != version:
+            return False
+        pipe.multi()
+        write(
+            pipe,
+            task_id,
+            time.time(),
+            SUCCESS,
+            result=encode_result(result),
+            context=encode_result(context),
+        )
+        return True
+
+    return transaction(update, key("task", task_id))
+
+
+def enqueue_task(
+    task_id: str, payload: dict, priority: int = 0, fingerprint: str = None
+):
+    """
+    Adds a PENDING task to the job queue.
+    """
+    now = time.time()
+    with client.pipeline() as pipe:
+        write(
+            pipe,
+            task_id,
+            now,
+            PENDING,
+            payload=json.dumps(payload),
+            priority=priority,
+            fingerprint=fingerprint,
+            created_at=now,
+        )
+        pipe.zadd(QUEUE, {task_id: queue_score(priority, now)})
+        if fingerprint:
+            pipe.set(
+                key("inflight", fingerprint), task_id, px=milliseconds(STALE_AFTER)
+            )
+        pipe.execute()
+
+
+def in_flight(leader: dict) -> bool:
+    """
+    Whether identical requests can attach to a task, given its "state",
+    "leader_id" and "batch_id". Batch items only qualify once RUNNING, as
+    they wait for their batch's turn.
+    """
+    state = text(leader["state"])
+    if state not in (PENDING, RUNNING) or leader["leader_id"]:
+        return False
+    return leader["batch_id"] is None or state == RUNNING
+
+
+def find_inflight(fingerprint: str) -> str:
+    """
+    Returns the id of the RUNNING task with the given fingerprint that
+    identical requests attach to, or None, like the SQLite store.
+    """
+    leader_id = text(client.get(key("inflight", fingerprint)))
+    if leader_id is None:
+        return None
+    leader = read(client, leader_id, "state", "leader_id", "batch_id")
+    if not in_flight(leader) or text(leader["state"]) != RUNNING:
+        return None
+    return leader_id
+
+
+def adopt_queued(task_id: str, fingerprint: str) -> list:
+    """
+    Attaches the queued task with the given fingerprint, if any, and its
+    followers to the RUNNING batch item ``task_id``, like the SQLite store,
+    and points identical requests submitted from now on at the item.
+
+    Returns:
+        list: The ids of the tasks taken out of the queue.
+    """
+    inflight = key("inflight", fingerprint)
+    followers_key = key("followers", task_id)
+
+    def adopt(pipe):
+        leader_id = text(pipe.get(inflight))
+        queued, followers = None, []
+        if leader_id is not None and leader_id != task_id:
+            pipe.watch(key("task", leader_id), key("followers", leader_id))
+            leader = read(
+                pipe,
+                leader_id,
+                "state",
+                "leader_id",
+                "batch_id",
+                "payload",
+                "priority",
+                "created_at",
+            )
+            if (
+                text(leader["state"]) == PENDING
+                and leader["leader_id"] is None
+                and leader["batch_id"] is None
+                and leader["payload"] is not None
+            ):
+                queued = leader
+                followers = read_followers(pipe, leader_id, True)
+        priority = pipe.hget(key("task", task_id), "priority")
+        pipe.multi()
+        pipe.set(inflight, task_id, px=milliseconds(STALE_AFTER))
+        if queued is None:
+            return []
+        now = time.time()
+        write(
+            pipe,
+            leader_id,
+            now,
+            PENDING,
+            leader_id=task_id,
+            payload=None,
+            fingerprint=None,
+        )
+        pipe.zrem(QUEUE, leader_id)
+        pipe.zadd(followers_key, {leader_id: float(queued["created_at"])})
+        for follower_id, created_at, _ in followers:
+            pipe.hset(key("task", follower_id), "leader_id", task_id)
+            pipe.zadd(followers_key, {follower_id: created_at})
+        pipe.delete(key("followers", leader_id))
+        # Batch items have no priority of their own
+        if priority is None or int(queued["priority"] or 0) < int(priority):
+            pipe.hset(key("task", task_id), "priority", queued["priority"] or 0)
+        return [leader_id]
+
+    return transaction(adopt, inflight, key("task", task_id), followers_key)
+
+
+def attach_to_inflight(task_id: str, fingerprint: str, priority: int = 0) -> str:
+    """
+    Creates ``task_id`` as a follower of the PENDING or RUNNING task with the
+    same fingerprint, if there is one, promoting the leader to the follower's
+    priority if that is higher.
+
+    Returns:
+        str: The leader's task id, or None if no equivalent task is in flight.
+    """
+    inflight = key("inflight", fingerprint)
+
+    def attach(pipe):
+        leader_id = text(pipe.get(inflight))
+        if leader_id is None:
+            return None
+        pipe.watch(key("task", leader_id))
+        leader = read(
+            pipe, leader_id, "state", "leader_id", "batch_id", "priority", "created_at"
+        )
+        if not in_flight(leader):
+            return None
+        state = text(leader["state"])
+        now = time.time()
+        pipe.multi()
+        write(pipe, task_id, now, PENDING, leader_id=leader_id, created_at=now)
+        pipe.zadd(key("followers", leader_id), {task_id: now})
+        # Batch items have no priority of their own
+        if leader["priority"] is None or priority < int(leader["priority"]):
+            pipe.hset(key("task", leader_id), "priority", priority)
+            if state == PENDING:
+                score = queue_score(priority, leader["created_at"])
+                pipe.zadd(QUEUE, {leader_id: score}, xx=True)
+        return leader_id
+
+    return transaction(attach, inflight)
+
+
+def resolve_followers(
+    leader_id: str,
+    state: str,
+    result: dict = None,
+    error: dict = None,
+    context: dict = None,
+) -> list:
+    """
+    Copies a leader task's final state to all of its followers.
+
+    Returns:
+        list: The ids of the resolved followers.
+    """
+    fields = {
+        "result": encode_result(result),
+        "error": json.dumps(error) if error else None,
+        "context": encode_result(context),
+    }
+
+    def resolve(pipe):
+        resolved = [
+            follower_id
+            for follower_id, _, follower_state in read_followers(pipe, leader_id, True)
+            if follower_state not in (None, CANCELLED)
+        ]
+        now = time.time()
+        pipe.multi()
+        for follower_id in resolved:
+            write(pipe, follower_id, now, state, **fields)
+        return resolved
+
+    return transaction(resolve, key("followers", leader_id))
+
+
+def claim_next_task(worker_id: str = WORKER_ID):
+    """
+    Atomically moves the highest-priority, oldest PENDING task to RUNNING,
+    leased to ``worker_id`` for ``LEASE_TTL`` seconds.
+
+    Returns:
+        tuple: ``(task_id, payload, created_at)``, or None if the queue is empty.
+    """
+
+    def claim(pipe):
+        entries = pipe.zrange(QUEUE, 0, 0)
+        if not entries:
+            return None
+        task_id = text(entries[0])
+        pipe.watch(key("task", task_id))
+        task = read(pipe, task_id, "state", "payload", "created_at")
+        pipe.multi()
+        if text(task["state"]) != PENDING or task["payload"] is None:
+            # Not claimable any more; drop it and look again
+            pipe.zrem(QUEUE, task_id)
+            return False
+        lease(pipe, task_id, worker_id)
+        return task_id, json.loads(task["payload"]), float(task["created_at"])
+
+    while True:
+        claimed = transaction(claim, QUEUE)
+        if claimed is not False:
+            return claimed
+
+
+def start_task(task_id: str, worker_id: str = WORKER_ID) -> bool:
+    """
+    Moves a PENDING task to RUNNING, leased to ``worker_id`` like a claimed task.
+
+    Returns:
+        bool: False if the task was no longer PENDING, e.g. cancelled.
+    """
+    task_key = key("task", task_id)
+
+    def start(pipe):
+        if text(pipe.hget(task_key, "state")) != PENDING:
+            return False
+        pipe.multi()
+        lease(pipe, task_id, worker_id)
+        return True
+
+    return transaction(start, task_key)
+
+
+def cancel_task(task_id: str) -> dict:
+    """
+    Cancels a PENDING or RUNNING task, passing a PENDING task's place in the
+    queue to its oldest follower, like the SQLite store. The duplicates of a
+    batch item within its batch are cancelled with it.
+
+    Returns:
+        dict: The task's "state" before cancelling and whether its pipeline
+        should be "aborted", or None if the task is not found.
+    """
+    followers_key = key("followers", task_id)
+
+    def cancel(pipe):
+        task = read(
+            pipe,
+            task_id,
+            "state",
+            "batch_id",
+            "payload",
+            "priority",
+            "fingerprint",
+            "created_at",
+        )
+        state = text(task["state"])
+        if state is None:
+            return None
+        if state in TERMINAL_STATES:
+            return {"state": state, "aborted": False}
+        followers = read_followers(pipe, task_id, True)
+        waiting = [f for f in followers if f[2] in (PENDING, RUNNING)]
+        duplicates = set()
+        if task["batch_id"] is not None:
+            duplicates = {
+                follower_id
+                for follower_id, _, _ in waiting
+                if pipe.hget(key("task", follower_id), "batch_id") == task["batch_id"]
+            }
+            waiting = [f for f in waiting if f[0] not in duplicates]
+        now = time.time()
+        pipe.multi()
+        write(pipe, task_id, now, CANCELLED)
+        for follower_id in duplicates:
+            write(pipe, follower_id, now, CANCELLED)
+        if not waiting:
+            return {"state": state, "aborted": True}
+        if state == PENDING:
+            successor = waiting[0][0]
+            write(
+                pipe,
+                successor,
+                now,
+                PENDING,
+                leader_id=None,
+                payload=task["payload"],
+                priority=task["priority"],
+                fingerprint=task["fingerprint"],
+                created_at=task["created_at"],
+            )
+            score = queue_score(task["priority"], task["created_at"])
+            pipe.zadd(QUEUE, {successor: score})
+            for follower_id, created_at, _ in followers:
+                if follower_id != successor and follower_id not in duplicates:
+                    pipe.hset(key("task", follower_id), "leader_id", successor)
+                    pipe.zadd(key("followers", successor), {follower_id: created_at})
+            pipe.delete(followers_key)
+            if task["fingerprint"]:
+                inflight = key("inflight", text(task["fingerprint"]))
+                pipe.set(inflight, successor, px=milliseconds(STALE_AFTER))
+        return {"state": state, "aborted": False}
+
+    return transaction(cancel, key("task", task_id), followers_key)
+
+
+def retry_task(task_id: str) -> dict:
+    """
+    Requeues a FAILED task, or the task it is attached to, along with the
+    failed tasks attached to that task.
+
+    Returns:
+        dict: The task's "state" before retrying and, if it was requeued, the
+        "job" to run: the "id", "batch_id" and "payload" of the task running
+        the pipeline. None if the task is not found.
+    """
+
+    def retry(pipe):
+        task = read(pipe, task_id, "state", "leader_id")
+        state = text(task["state"])
+        if state is None:
+            return None
+        if state != FAILED:
+            return {"state": state, "job": None}
+        job_id = text(task["leader_id"]) or task_id
+        pipe.watch(key("task", job_id), key("followers", job_id))
+        job = read(
+            pipe,
+            job_id,
+            "state",
+            "payload",
+            "batch_id",
+            "priority",
+            "created_at",
+            "fingerprint",
+        )
+        if text(job["state"]) != FAILED or job["payload"] is None:
+            # E.g. the task this one was attached to was cancelled
+            return {"state": state, "job": None}
+        followers = read_followers(pipe, job_id, True)
+        batch_id = text(job["batch_id"])
+        now = time.time()
+        pipe.multi()
+        write(pipe, job_id, now, PENDING, error=None, claims=0)
+        if batch_id is None:
+            pipe.zadd(QUEUE, {job_id: queue_score(job["priority"], job["created_at"])})
+            if job["fingerprint"]:
+                inflight = key("inflight", text(job["fingerprint"]))
+                pipe.set(inflight, job_id, px=milliseconds(STALE_AFTER))
+        for follower_id, _, follower_state in followers:
+            if follower_state == FAILED:
+                write(pipe, follower_id, now, PENDING, error=None)
+        job = {
+            "id": job_id,
+            "batch_id": batch_id,
+            "payload": json.loads(job["payload"]),
+        }
+        return {"state": state, "job": job}
+
+    return transaction(retry, key("task", task_id))
+
+
+def save_checkpoint(task_id: str, stage: str, state: dict):
+    """
+    Stores the output of a task's last completed pipeline stage, replacing the
+    previous checkpoint, for ``CHECKPOINT_TTL`` seconds.
+    """
+    checkpoint_key = key("checkpoint", task_id)
+    with client.pipeline() as pipe:
+        pipe.hset(
+            checkpoint_key,
+            mapping={"stage": stage, "state": encode_result(state) or b""},
+        )
+        pipe.pexpire(checkpoint_key, milliseconds(CHECKPOINT_TTL))
+        pipe.execute()
+
+
+def load_checkpoint(task_id: str) -> tuple:
+    """
+    Retrieves a task's checkpoint.
+
+    Returns:
+        tuple: ``(stage, state)``: the last completed stage and its output, or
+        None if the task has no checkpoint.
+    """
+    stage, state = client.hmget(key("checkpoint", task_id), ["stage", "state"])
+    if stage is None:
+        return None
+    return text(stage), decode_result(state)
+
+
+def delete_checkpoint(task_id: str):
+    """
+    Deletes a task's checkpoint, if any.
+    """
+    client.delete(key("checkpoint", task_id))
+
+
+def aborted_tasks(task_ids: list) -> list:
+    """
+    Returns the ids of the given tasks that have been cancelled and whose
+    pipeline no follower is waiting for, i.e. those whose jobs should stop.
+    """
+    return [
+        task_id
+        for task_id, state in zip(task_ids, read_states(task_ids))
+        if state == CANCELLED
+        and not any(f[2] in (PENDING, RUNNING) for f in read_followers(client, task_id))
+    ]
+
+
+def queue_depth() -> int:
+    """
+    Returns the number of PENDING tasks waiting for a worker.
+    """
+    return client.zcard(QUEUE)
+
+
+def queue_position(task_id: str) -> int:
+    """
+    Returns the 1-based position of a PENDING task in the job queue, or None if
+    the task is not waiting.
+    """
+    rank = client.zrank(QUEUE, task_id)
+    return rank + 1 if rank is not None else None
+
+
+def create_batch(batch_id: str, items: list):
+    """
+    Stores a batch and its items as PENDING tasks. The batch expires once its
+    items are likely to have expired, see ``touch_batch``.
+
+    Args:
+        batch_id (str): The unique identifier for the batch.
+        items (list): ``(task_id, payload, leader_id, fingerprint)`` tuples in
+            submission order.
+    """
+    now = time.time()
+    batch_key = key("batch", batch_id)
+    with client.pipeline() as pipe:
+        pipe.hset(
+            batch_key,
+            mapping={
+                "task_ids": json.dumps([item[0] for item in items]),
+                "created_at": now,
+            },
+        )
+        pipe.pexpire(batch_key, milliseconds(RETENTION + STALE_AFTER))
+        for task_id, payload, leader_id, fingerprint in items:
+            write(
+                pipe,
+                task_id,
+                now,
+                PENDING,
+                payload=json.dumps(payload),
+                fingerprint=None if leader_id else fingerprint,
+                leader_id=leader_id,
+                batch_id=batch_id,
+                created_at=now,
+            )
+            if leader_id:
+                pipe.zadd(key("followers", leader_id), {task_id: now})
+        pipe.execute()
+
+
+def get_batch(batch_id: str) -> dict:
+    """
+    Retrieves a batch and the state of each of its items.
+
+    Returns:
+        dict: The batch's "id", "created_at", the "task_ids" of its items in
+        submission order and their "states" keyed by task id, or None if the
+        batch is not found.
+    """
+    task_ids, created_at = client.hmget(
+        key("batch", batch_id), ["task_ids", "created_at"]
+    )
+    if task_ids is None:
+        return None
+    task_ids = json.loads(task_ids)
+    states = read_states(task_ids)
+    return {
+        "id": batch_id,
+        "task_ids": task_ids,
+        "created_at": float(created_at),
+        "states": {i: state for i, state in zip(task_ids, states) if state},
+    }
+
+
+def touch_batch(batch_id: str):
+    """
+    Marks the unfinished items of a batch as still alive, and extends the
+    batch's expiry, so that neither is swept while the batch runs.
+    """
+    batch = get_batch(batch_id)
+    if batch is None:
+        return
+    now = time.time()
+    with client.pipeline(transaction=False) as pipe:
+        pipe.pexpire(key("batch", batch_id), milliseconds(RETENTION + STALE_AFTER))
+        for task_id, state in batch["states"].items():
+            if state in (PENDING, RUNNING):
+                pipe.hset(key("task", task_id), "updated_at", now)
+                pipe.zadd(ACTIVE, {task_id: now}, xx=True)
+        pipe.execute()
+
+
+def touch_watched(task_id: str, arm: bool = True):
+    """
+    Records that a client is following a PENDING or RUNNING task, see
+    ``unwatched_tasks``. Unless ``arm``, only tasks already marked as watched
+    are.
+    """
+    task_key = key("task", task_id)
+
+    def touch(pipe):
+        task = read(pipe, task_id, "state", "batch_id")
+        if text(task["state"]) not in (PENDING, RUNNING) or task["batch_id"]:
+            return
+        pipe.multi()
+        pipe.zadd(WATCHED, {task_id: time.time()}, xx=not arm)
+
+    transaction(touch, task_key)
+
+
+def unwatched_tasks(before: float) -> list:
+    """
+    Returns the ids of the PENDING and RUNNING tasks that clients have followed,
+    but not since ``before``, e.g. because the user closed the page. Batch
+    items, which nobody needs to follow, are left out.
+    """
+    return [text(task_id) for task_id in client.zrangebyscore(WATCHED, "-inf", before)]
+
+
+def renew_leases(task_ids: list, worker_id: str = WORKER_ID) -> list:
+    """
+    Extends the leases ``worker_id`` holds on the given RUNNING tasks by
+    ``LEASE_TTL`` seconds.
+
+    Returns:
+        list: The ids of the given tasks whose lease was lost: those requeued or
+        claimed by another worker after the lease expired. Their jobs should stop.
+    """
+    if not task_ids:
+        return []
+
+    def renew(pipe):
+        holders = [read(pipe, i, "state", "worker_id") for i in task_ids]
+        lease_until = time.time() + LEASE_TTL
+        lost = []
+        pipe.multi()
+        for task_id, holder in zip(task_ids, holders):
+            state = text(holder["state"])
+            if state == RUNNING and text(holder["worker_id"]) == worker_id:
+                pipe.hset(key("task", task_id), "lease_until", lease_until)
+                pipe.zadd(LEASES, {task_id: lease_until})
+            elif state in (PENDING, RUNNING):
+                lost.append(task_id)
+        return lost
+
+    return transaction(renew, *(key("task", task_id) for task_id in task_ids))
+
+
+def expire_leases(max_claims: int = MAX_CLAIMS) -> dict:
+    """
+    Takes back the RUNNING tasks whose lease has expired, requeueing them or,
+    for batch items and tasks claimed ``max_claims`` times, failing them along
+    with the tasks attached to them (see ``sqlite_store.expire_leases``).
+
+    Returns:
+        dict: The number of tasks requeued and failed.
+    """
+
+    def take_back(task_id: str):
+        def expire(pipe):
+            task = read(
+                pipe,
+                task_id,
+                "state",
+                "lease_until",
+                "batch_id",
+                "claims",
+                "priority",
+                "created_at",
+            )
+            if text(task["state"]) != RUNNING:
+                pipe.multi()
+                pipe.zrem(LEASES, task_id)
+                return None
+            now = time.time()
+            if float(task["lease_until"] or 0) >= now:
+                return None
+            if task["batch_id"] is None and int(task["claims"] or 0) < max_claims:
+                pipe.multi()
+                write(pipe, task_id, now, PENDING, worker_id=None, lease_until=None)
+                score = queue_score(task["priority"], task["created_at"])
+                pipe.zadd(QUEUE, {task_id: score})
+                return "requeued"
+            followers = read_followers(pipe, task_id, True)
+            error = json.dumps(LEASE_EXPIRED)
+            pipe.multi()
+            write(pipe, task_id, now, FAILED, error=error)
+            for follower_id, _, state in followers:
+                if state == PENDING:
+                    write(pipe, follower_id, now, FAILED, error=error)
+            return "failed"
+
+        return transaction(expire, key("task", task_id), key("followers", task_id))
+
+    expired = {"requeued": 0, "failed": 0}
+    for task_id in client.zrangebyscore(LEASES, "-inf", time.time()):
+        outcome = take_back(text(task_id))
+        if outcome:
+            expired[outcome] += 1
+    return expired
+
+
+def sweep_tasks(
+    retention: float = RETENTION,
+    stale_after: float = STALE_AFTER,
+    checkpoint_ttl: float = CHECKPOINT_TTL,
+) -> dict:
+    """
+    Fails unfinished tasks that have not been updated recently. Finished tasks
+    and checkpoints expire by themselves, after the ``RETENTION`` and
+    ``CHECKPOINT_TTL`` set when they were written, so ``retention`` and
+    ``checkpoint_ttl`` are ignored and nothing is counted as deleted.
+
+    Returns:
+        dict: The number of tasks deleted and failed, and of checkpoints evicted.
+    """
+
+    def abandon(task_id: str, threshold: float) -> bool:
+        def fail(pipe):
+            task = read(pipe, task_id, "state", "updated_at")
+            if text(task["state"]) not in (PENDING, RUNNING):
+                pipe.multi()
+                pipe.zrem(ACTIVE, task_id)
+                return False
+            if float(task["updated_at"]) >= threshold:
+                return False
+            pipe.multi()
+            write(pipe, task_id, time.time(), FAILED, error=json.dumps(ABANDONED))
+            return True
+
+        return transaction(fail, key("task", task_id))
+
+    threshold = time.time() - stale_after
+    failed = sum(
+        abandon(text(task_id), threshold)
+        for task_id in client.zrangebyscore(ACTIVE, "-inf", threshold)
+    )
+    return {"deleted": 0, "failed": failed, "checkpoints_evicted": 0}
+
+
+def drop_db():
+    """
+    Deletes every key of the task store.
+    """
+    keys = list(client.scan_iter(match=REDIS_KEY_PREFIX + "*", count=1000))
+    for start in range(0, len(keys), 1000):
+        client.delete(*keys[start : start + 1000])
@@ -0,0 +1,927 @@
+"""
+The SQLite task store backend (see ``db.db``).
+
+Tasks live in a SQLite database in WAL mode, accessed through a small pool of
+long-lived connections. The database file can be shared by the processes of one
+host, e.g. the web process and ``python worker.py``, but not across hosts.
+
+Results, contexts and checkpoints are stored as zlib-compressed JSON. Finished
+tasks, checkpoints that are no longer needed and batches whose items are all
+gone are deleted by the retention sweeper.
+"""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from db.base import (
+    ABANDONED,
+    CANCELLED,
+    CHECKPOINT_TTL,
+    FAILED,
+    LEASE_EXPIRED,
+    LEASE_TTL,
+    MAX_CLAIMS,
+    PENDING,
+    RETENTION,
+    RUNNING,
+    STALE_AFTER,
+    SUCCESS,
+    TERMINAL_STATES,
+    WORKER_ID,
+    decode_result,
+    encode_result,
+)
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv(
+    "TASKS_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "tasks.db"),
+)
+POOL_SIZE = int(os.getenv("TASKS_DB_POOL_SIZE", 4))
+
+UPSERT_TASK = """INSERT INTO tasks
+                 (id, state, result, error, context, created_at, updated_at, version)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+                 ON CONFLICT(id) DO UPDATE SET state = excluded.state,
+                 result = excluded.result, error = excluded.error,
+                 context = excluded.context, updated_at = excluded.updated_at, version = version + 1
+                 WHERE tasks.state != 'CANCELLED'"""
+# The result is only read when the first parameter is true
+SELECT_TASK = """SELECT id, state, CASE WHEN ? THEN result END, error, created_at,
+                 updated_at, leader_id, version
+                 FROM tasks WHERE id = ?"""
+ENQUEUE_TASK = """INSERT INTO tasks
+                  (id, state, payload, priority, fingerprint, created_at, updated_at,
+                   version)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, 1)"""
+CLAIM_TASK = """UPDATE tasks SET state = ?, updated_at = ?, version = version + 1,
+                worker_id = ?, lease_until = ?, claims = claims + 1
+                WHERE id = (SELECT id FROM tasks
+                            WHERE state = ? AND leader_id IS NULL
+                            AND batch_id IS NULL
+                            ORDER BY priority, created_at LIMIT 1)
+                RETURNING id, payload, created_at"""
+QUEUE_POSITION = """SELECT COUNT(*) FROM tasks q, tasks t
+                    WHERE t.id = ? AND t.state = ? AND t.batch_id IS NULL
+                    AND q.state = ? AND q.leader_id IS NULL AND q.batch_id IS NULL
+                    AND (q.priority < t.priority OR (q.priority = t.priority
+                         AND q.created_at <= t.created_at))"""
+# Batch items are only followed once running, as they wait for their batch's turn
+FIND_INFLIGHT = """SELECT id FROM tasks
+                   WHERE fingerprint = ? AND state IN (?, ?) AND leader_id IS NULL
+                   AND (batch_id IS NULL OR state = ?)
+                   ORDER BY created_at LIMIT 1"""
+ATTACH_TASK = """INSERT INTO tasks
+                 (id, state, leader_id, created_at, updated_at, version)
+                 VALUES (?, ?, ?, ?, ?, 1)"""
+INSERT_BATCH_ITEM = """INSERT INTO tasks
+                       (id, state, payload, fingerprint, leader_id, batch_id,
+                        created_at, updated_at, version)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)"""
+RESOLVE_FOLLOWERS = """UPDATE tasks SET state = ?, result = ?, error = ?, context = ?,
+                       updated_at = ?, version = version + 1
+                       WHERE leader_id = ? AND state != 'CANCELLED' RETURNING id"""
+UPSERT_CHECKPOINT = """INSERT INTO checkpoints (task_id, stage, state, updated_at)
+                       VALUES (?, ?, ?, ?)
+                       ON CONFLICT(task_id) DO UPDATE SET stage = excluded.stage,
+                       state = excluded.state, updated_at = excluded.updated_at"""
+# Cancelled tasks among the given ones whose pipeline no other task waits for
+ABORTED_TASKS = """SELECT id FROM tasks t
+                   WHERE id IN ({ids}) AND state = ? AND NOT EXISTS
+                   (SELECT 1 FROM tasks f WHERE f.leader_id = t.id AND f.state IN (?, ?))"""
+
+
+class ConnectionPool:
+    """
+    A fixed-size pool of SQLite connections shared across threads.
+
+    Connections are opened lazily, configured for WAL mode, and reused so that
+    each call avoids the cost of opening the database file. SQLite caches the
+    compiled form of each parameterized statement per connection, so reusing
+    connections also reuses prepared statements.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, cached_statements=64
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection, committing on success and rolling back on error.
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            conn = self._connect() if can_open else self._idle.get()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+pool = ConnectionPool(DB_PATH, POOL_SIZE)
+
+
+def init_db():
+    """
+    Initializes the database by creating the tasks table if it doesn't exist,
+    adding columns missing from databases created by older versions.
+    """
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS tasks
+               (id TEXT PRIMARY KEY, state TEXT, result TEXT)"""
+        )
+        columns = {row[1] for row in c.execute("PRAGMA table_info(tasks)")}
+        for column, definition in [
+            ("error", "TEXT"),
+            ("created_at", "REAL"),
+            ("updated_at", "REAL"),
+            ("payload", "TEXT"),
+            ("priority", "INTEGER"),
+            ("fingerprint", "TEXT"),
+            ("leader_id", "TEXT"),
+            ("version", "INTEGER NOT NULL DEFAULT 0"),
+            ("batch_id", "TEXT"),
+            ("context", "BLOB"),
+            ("worker_id", "TEXT"),
+            ("lease_until", "REAL"),
+            ("claims", "INTEGER NOT NULL DEFAULT 0"),
+            ("watched_at", "REAL"),
+        ]:
+            if column not in columns:
+                c.execute(f"ALTER TABLE tasks ADD COLUMN {column} {definition}")
+        now = time.time()
+        c.execute(
+            "UPDATE tasks SET created_at = ?, updated_at = ? WHERE updated_at IS NULL",
+            (now, now),
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at)")
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_state_updated_at ON tasks (state, updated_at)"
+        )
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS tasks_queue
+               ON tasks (state, priority, created_at)"""
+        )
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS tasks_fingerprint
+               ON tasks (fingerprint, state)"""
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_leader_id ON tasks (leader_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_batch_id ON tasks (batch_id)")
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_lease ON tasks (state, lease_until)"
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS batches
+               (id TEXT PRIMARY KEY, task_ids TEXT, created_at REAL)"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS checkpoints
+               (task_id TEXT PRIMARY KEY, stage TEXT, state BLOB, updated_at REAL)"""
+        )
+
+
+def store_task(
+    task_id: str,
+    state: str,
+    result: dict = None,
+    error: dict = None,
+    context: dict = None,
+):
+    """
+    Stores a task in the database.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        state (str): The current state of the task.
+        result (dict, optional): The result of the task. Defaults to None.
+        error (dict, optional): Details of the failure for FAILED tasks. Defaults to None.
+        context (dict, optional): What edits of a SUCCESS task's result reuse.
+            Defaults to None.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        conn.execute(
+            UPSERT_TASK,
+            (
+                task_id,
+                state,
+                encode_result(result),
+                json.dumps(error) if error else None,
+                encode_result(context),
+                now,
+                now,
+            ),
+        )
+
+
+def get_task(task_id: str, include_result: bool = True) -> dict:
+    """
+    Retrieves a task from the database.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        include_result (bool, optional): Read and decode the result. When False,
+            "result" is None, which is cheaper for callers that only need the
+            state or version. Defaults to True.
+
+    Returns:
+        dict: The task details, or None if the task is not found.
+    """
+    with pool.connection() as conn:
+        task = conn.execute(SELECT_TASK, (include_result, task_id)).fetchone()
+    if task:
+        return {
+            "id": task[0],
+            "state": task[1],
+            "result": decode_result(task[2]),
+            "error": json.loads(task[3]) if task[3] else None,
+            "created_at": task[4],
+            "updated_at": task[5],
+            "leader_id": task[6],
+            "version": task[7],
+        }
+    return None
+
+
+def get_task_context(task_id: str) -> dict:
+    """
+    Retrieves what editing a task's result needs.
+
+    Returns:
+        dict: The task's "state", "result", "context" and "version", or None
+        if the task is not found.
+    """
+    with pool.connection() as conn:
+        task = conn.execute(
+            "SELECT state, result, context, version FROM tasks WHERE id = ?",
+            (task_id,),
+        ).fetchone()
+    if task:
+        return {
+            "state": task[0],
+            "result": decode_result(task[1]),
+            "context": decode_result(task[2]),
+            "version": task[3],
+        }
+    return None
+
+
+def update_result(task_id: str, version: int, result: dict, context: dict) -> bool:
+    """
+    Replaces the result and context of a SUCCESS task, unless the task has
+    changed since ``version`` was read.
+
+    Returns:
+        bool: False if the task was changed in the meantime.
+    """
+    with pool.connection() as conn:
+        return (
+            conn.execute(
+                """UPDATE tasks SET result = ?, context = ?, updated_at = ?,
+                   version = version + 1
+                   WHERE id = ? AND version = ? AND state = ?""",
+                (
+                    encode_result(result),
+                    encode_result(context),
+                    time.time(),
+                    task_id,
+                    version,
+                    SUCCESS,
+                ),
+            ).rowcount
+            > 0
+        )
+
+
+def enqueue_task(
+    task_id: str, payload: dict, priority: int = 0, fingerprint: str = None
+):
+    """
+    Adds a PENDING task to the job queue.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        payload (dict): The job input, handed to the worker that claims the task.
+        priority (int, optional): Lower values are claimed first. Defaults to 0.
+        fingerprint (str, optional): Identifies equivalent jobs, see ``attach_to_inflight``.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        conn.execute(
+            ENQUEUE_TASK,
+            (task_id, PENDING, json.dumps(payload), priority, fingerprint, now, now),
+        )
+
+
+def find_inflight(fingerprint: str) -> str:
+    """
+    Returns the id of the RUNNING task with the given fingerprint that
+    identical requests attach to (see ``attach_to_inflight``), or None. Batch
+    items use it to share the pipeline of a request submitted on its own;
+    queued ones are taken over instead (see ``adopt_queued``).
+    """
+    with pool.connection() as conn:
+        leader = conn.execute(
+            FIND_INFLIGHT, (fingerprint, RUNNING, RUNNING, RUNNING)
+        ).fetchone()
+    return leader[0] if leader else None
+
+
+def adopt_queued(task_id: str, fingerprint: str) -> list:
+    """
+    Attaches the queued tasks with the given fingerprint, and their followers,
+    to the RUNNING batch item ``task_id``, which runs the same request, taking
+    them out of the job queue. Should the item be cancelled, the oldest of them
+    takes its place in the queue back (see ``cancel_task``).
+
+    Returns:
+        list: The ids of the tasks taken out of the queue.
+    """
+    with pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        queued = conn.execute(
+            """SELECT id, priority FROM tasks WHERE fingerprint = ? AND state = ?
+               AND leader_id IS NULL AND batch_id IS NULL AND payload IS NOT NULL""",
+            (fingerprint, PENDING),
+        ).fetchall()
+        if not queued:
+            return []
+        ids = [row[0] for row in queued]
+        marks = ", ".join("?" * len(ids))
+        conn.execute(
+            f"""UPDATE tasks SET leader_id = ?, version = version + 1
+                WHERE leader_id IN ({marks})""",
+            (task_id, *ids),
+        )
+        conn.execute(
+            f"""UPDATE tasks SET leader_id = ?, payload = NULL, fingerprint = NULL,
+                version = version + 1 WHERE id IN ({marks})""",
+            (task_id, *ids),
+        )
+        # Batch items have no priority of their own
+        priority = min(row[1] for row in queued)
+        conn.execute(
+            "UPDATE tasks SET priority = COALESCE(MIN(priority, ?), ?) WHERE id = ?",
+            (priority, priority, task_id),
+        )
+    return ids
+
+
+def attach_to_inflight(task_id: str, fingerprint: str, priority: int = 0) -> str:
+    """
+    Creates ``task_id`` as a follower of a PENDING or RUNNING task with the same
+    fingerprint, if there is one, or RUNNING batch item. Followers are never
+    claimed by workers; they receive the leader's outcome through
+    ``resolve_followers``. The leader is promoted to the follower's priority if
+    that is higher.
+
+    Args:
+        task_id (str): The unique identifier for the new task.
+        fingerprint (str): The fingerprint of the job.
+        priority (int, optional): The priority of the new task.
+
+    Returns:
+        str: The leader's task id, or None if no equivalent task is in flight.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        # Take the write lock up front so concurrent submissions see each other
+        conn.execute("BEGIN IMMEDIATE")
+        leader = conn.execute(
+            FIND_INFLIGHT, (fingerprint, PENDING, RUNNING, RUNNING)
+        ).fetchone()
+        if leader is None:
+            return None
+        conn.execute(ATTACH_TASK, (task_id, PENDING, leader[0], now, now))
+        # Batch items have no priority of their own
+        conn.execute(
+            "UPDATE tasks SET priority = COALESCE(MIN(priority, ?), ?) WHERE id = ?",
+            (priority, priority, leader[0]),
+        )
+    return leader[0]
+
+
+def resolve_followers(
+    leader_id: str,
+    state: str,
+    result: dict = None,
+    error: dict = None,
+    context: dict = None,
+) -> list:
+    """
+    Copies a leader task's final state to all of its followers.
+
+    Returns:
+        list: The ids of the resolved followers.
+    """
+    with pool.connection() as conn:
+        followers = conn.execute(
+            RESOLVE_FOLLOWERS,
+            (
+                state,
+                encode_result(result),
+                json.dumps(error) if error else None,
+                encode_result(context),
+                time.time(),
+                leader_id,
+            ),
+        ).fetchall()
+    return [f[0] for f in followers]
+
+
+def claim_next_task(worker_id: str = WORKER_ID):
+    """
+    Atomically moves the highest-priority, oldest PENDING task to RUNNING,
+    leased to ``worker_id`` for ``LEASE_TTL`` seconds.
+
+    Returns:
+        tuple: ``(task_id, payload, created_at)``, or None if the queue is empty.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        task = conn.execute(
+            CLAIM_TASK, (RUNNING, now, worker_id, now + LEASE_TTL, PENDING)
+        ).fetchone()
+    if task:
+        return task[0], json.loads(task[1]), task[2]
+    return None
+
+
+def start_task(task_id: str, worker_id: str = WORKER_ID) -> bool:
+    """
+    Moves a PENDING task to RUNNING, leased to ``worker_id`` like a claimed task.
+
+    Returns:
+        bool: False if the task was no longer PENDING, e.g. cancelled.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        return (
+            conn.execute(
+                """UPDATE tasks SET state = ?, updated_at = ?, version = version + 1,
+                   worker_id = ?, lease_until = ?, claims = claims + 1
+                   WHERE id = ? AND state = ?""",
+                (RUNNING, now, worker_id, now + LEASE_TTL, task_id, PENDING),
+            ).rowcount
+            > 0
+        )
+
+
+def cancel_task(task_id: str) -> dict:
+    """
+    Cancels a PENDING or RUNNING task.
+
+    Identical requests attached to the task (see ``attach_to_inflight``) keep
+    its job going: a PENDING task's place in the queue passes to its oldest
+    follower, and a RUNNING task's pipeline keeps running for its followers.
+    Within a batch, the duplicates of a cancelled item are cancelled with it,
+    but requests attached to the item from outside the batch keep it going.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+
+    Returns:
+        dict: The task's "state" before cancelling and whether its pipeline
+        should be "aborted", or None if the task is not found. Tasks already
+        in a terminal state are left as they are.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        task = conn.execute(
+            """SELECT state, batch_id, payload, priority, fingerprint, created_at
+               FROM tasks WHERE id = ?""",
+            (task_id,),
+        ).fetchone()
+        if task is None:
+            return None
+        state, batch_id, payload, priority, fingerprint, created_at = task
+        if state in TERMINAL_STATES:
+            return {"state": state, "aborted": False}
+        cancel = """UPDATE tasks SET state = ?, updated_at = ?, version = version + 1
+                    WHERE {} AND state IN (?, ?)"""
+        conn.execute(
+            cancel.format("id = ?"), (CANCELLED, now, task_id, PENDING, RUNNING)
+        )
+        if batch_id is not None:
+            conn.execute(
+                cancel.format("leader_id = ? AND batch_id = ?"),
+                (CANCELLED, now, task_id, batch_id, PENDING, RUNNING),
+            )
+
+        followers = conn.execute(
+            """SELECT id FROM tasks WHERE leader_id = ? AND state IN (?, ?)
+               ORDER BY created_at""",
+            (task_id, PENDING, RUNNING),
+        ).fetchall()
+        if not followers:
+            return {"state": state, "aborted": True}
+        if state == PENDING:
+            successor = followers[0][0]
+            conn.execute(
+                """UPDATE tasks SET leader_id = NULL, payload = ?, priority = ?,
+                   fingerprint = ?, created_at = ?, version = version + 1
+                   WHERE id = ?""",
+                (payload, priority, fingerprint, created_at, successor),
+            )
+            conn.execute(
+                "UPDATE tasks SET leader_id = ? WHERE leader_id = ?",
+                (successor, task_id),
+            )
+    return {"state": state, "aborted": False}
+
+
+def retry_task(task_id: str) -> dict:
+    """
+    Requeues a FAILED task, so that its pipeline runs again from its last
+    checkpoint.
+
+    A task attached to an identical request (see ``attach_to_inflight``) is
+    retried by retrying the task running that request, and the other failed
+    tasks attached to it are requeued along with it. Batch items are requeued
+    as PENDING but not claimed from the job queue; the caller runs them.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+
+    Returns:
+        dict: The task's "state" before retrying and, if it was requeued, the
+        "job" to run: the "id", "batch_id" and "payload" of the task running
+        the pipeline. None if the task is not found.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        task = conn.execute(
+            "SELECT state, leader_id FROM tasks WHERE id = ?", (task_id,)
+        ).fetchone()
+        if task is None:
+            return None
+        state, leader_id = task
+        if state != FAILED:
+            return {"state": state, "job": None}
+        requeue = """UPDATE tasks SET state = ?, error = NULL, updated_at = ?,
+                     claims = 0, watched_at = NULL, version = version + 1
+                     WHERE {} AND state = ?"""
+        job_id = leader_id or task_id
+        job = conn.execute(
+            requeue.format("id = ? AND payload IS NOT NULL")
+            + " RETURNING id, batch_id, payload",
+            (PENDING, now, job_id, FAILED),
+        ).fetchone()
+        if job is None:
+            # E.g. the task this one was attached to was cancelled
+            return {"state": state, "job": None}
+        conn.execute(requeue.format("leader_id = ?"), (PENDING, now, job_id, FAILED))
+    return {
+        "state": state,
+        "job": {"id": job[0], "batch_id": job[1], "payload": json.loads(job[2])},
+    }
+
+
+def save_checkpoint(task_id: str, stage: str, state: dict):
+    """
+    Stores the output of a task's last completed pipeline stage, replacing the
+    previous checkpoint.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        stage (str): The completed stage.
+        state (dict): Its output.
+    """
+    with pool.connection() as conn:
+        conn.execute(
+            UPSERT_CHECKPOINT, (task_id, stage, encode_result(state), time.time())
+        )
+
+
+def load_checkpoint(task_id: str) -> tuple:
+    """
+    Retrieves a task's checkpoint.
+
+    Returns:
+        tuple: ``(stage, state)``: the last completed stage and its output, or
+        None if the task has no checkpoint.
+    """
+    with pool.connection() as conn:
+        checkpoint = conn.execute(
+            "SELECT stage, state FROM checkpoints WHERE task_id = ?", (task_id,)
+        ).fetchone()
+    if checkpoint:
+        return checkpoint[0], decode_result(checkpoint[1])
+    return None
+
+
+def delete_checkpoint(task_id: str):
+    """
+    Deletes a task's checkpoint, if any.
+    """
+    with pool.connection() as conn:
+        conn.execute("DELETE FROM checkpoints WHERE task_id = ?", (task_id,))
+
+
+def aborted_tasks(task_ids: list) -> list:
+    """
+    Returns the ids of the given tasks that have been cancelled and whose
+    pipeline no follower is waiting for, i.e. those whose jobs should stop.
+    """
+    if not task_ids:
+        return []
+    query = ABORTED_TASKS.format(ids=",".join("?" * len(task_ids)))
+    with pool.connection() as conn:
+        rows = conn.execute(query, (*task_ids, CANCELLED, PENDING, RUNNING))
+        return [row[0] for row in rows]
+
+
+def queue_depth() -> int:
+    """
+    Returns the number of PENDING tasks waiting for a worker.
+    """
+    with pool.connection() as conn:
+        return conn.execute(
+            """SELECT COUNT(*) FROM tasks
+               WHERE state = ? AND leader_id IS NULL AND batch_id IS NULL""",
+            (PENDING,),
+        ).fetchone()[0]
+
+
+def queue_position(task_id: str) -> int:
+    """
+    Returns the 1-based position of a PENDING task in the job queue, or None if
+    the task is not waiting.
+    """
+    with pool.connection() as conn:
+        position = conn.execute(QUEUE_POSITION, (task_id, PENDING, PENDING)).fetchone()[
+            0
+        ]
+    return position or None
+
+
+def create_batch(batch_id: str, items: list):
+    """
+    Stores a batch and its items as PENDING tasks.
+
+    Args:
+        batch_id (str): The unique identifier for the batch.
+        items (list): ``(task_id, payload, leader_id, fingerprint)`` tuples in
+            submission order. Items with a leader_id are not run themselves;
+            they receive the outcome of that item through ``resolve_followers``.
+            Identical requests submitted on their own attach to the others
+            while they run.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        conn.execute(
+            "INSERT INTO batches (id, task_ids, created_at) VALUES (?, ?, ?)",
+            (batch_id, json.dumps([item[0] for item in items]), now),
+        )
+        conn.executemany(
+            INSERT_BATCH_ITEM,
+            [
+                (
+                    task_id,
+                    PENDING,
+                    json.dumps(payload),
+                    None if leader_id else fingerprint,
+                    leader_id,
+                    batch_id,
+                    now,
+                    now,
+                )
+                for task_id, payload, leader_id, fingerprint in items
+            ],
+        )
+
+
+def get_batch(batch_id: str) -> dict:
+    """
+    Retrieves a batch and the state of each of its items.
+
+    Args:
+        batch_id (str): The unique identifier for the batch.
+
+    Returns:
+        dict: The batch's "id", "created_at", the "task_ids" of its items in
+        submission order and their "states" keyed by task id, or None if the
+        batch is not found.
+    """
+    with pool.connection() as conn:
+        batch = conn.execute(
+            "SELECT id, task_ids, created_at FROM batches WHERE id = ?", (batch_id,)
+        ).fetchone()
+        if batch is None:
+            return None
+        states = conn.execute(
+            "SELECT id, state FROM tasks WHERE batch_id = ?", (batch_id,)
+        ).fetchall()
+    return {
+        "id": batch[0],
+        "task_ids": json.loads(batch[1]),
+        "created_at": batch[2],
+        "states": dict(states),
+    }
+
+
+def touch_batch(batch_id: str):
+    """
+    Marks the unfinished items of a batch as still alive, so that items waiting
+    for their turn are not failed as abandoned by the retention sweeper.
+    """
+    with pool.connection() as conn:
+        conn.execute(
+            "UPDATE tasks SET updated_at = ? WHERE batch_id = ? AND state IN (?, ?)",
+            (time.time(), batch_id, PENDING, RUNNING),
+        )
+
+
+def touch_watched(task_id: str, arm: bool = True):
+    """
+    Records that a client is following a PENDING or RUNNING task, see
+    ``unwatched_tasks``. Unless ``arm``, only tasks already marked as watched
+    are.
+    """
+    query = "UPDATE tasks SET watched_at = ? WHERE id = ? AND state IN (?, ?)"
+    if not arm:
+        query += " AND watched_at IS NOT NULL"
+    with pool.connection() as conn:
+        conn.execute(query, (time.time(), task_id, PENDING, RUNNING))
+
+
+def unwatched_tasks(before: float) -> list:
+    """
+    Returns the ids of the PENDING and RUNNING tasks that clients have followed,
+    but not since ``before``, e.g. because the user closed the page. Batch
+    items, which nobody needs to follow, are left out.
+    """
+    with pool.connection() as conn:
+        rows = conn.execute(
+            """SELECT id FROM tasks WHERE state IN (?, ?) AND batch_id IS NULL
+               AND watched_at < ?""",
+            (PENDING, RUNNING, before),
+        )
+        return [row[0] for row in rows]
+
+
+def renew_leases(task_ids: list, worker_id: str = WORKER_ID) -> list:
+    """
+    Extends the leases ``worker_id`` holds on the given RUNNING tasks by
+    ``LEASE_TTL`` seconds.
+
+    Returns:
+        list: The ids of the given tasks whose lease was lost: those requeued or
+        claimed by another worker after the lease expired. Their jobs should stop.
+    """
+    if not task_ids:
+        return []
+    ids = ",".join("?" * len(task_ids))
+    with pool.connection() as conn:
+        conn.execute(
+            f"""UPDATE tasks SET lease_until = ?
+                WHERE id IN ({ids}) AND state = ? AND worker_id = ?""",
+            (time.time() + LEASE_TTL, *task_ids, RUNNING, worker_id),
+        )
+        rows = conn.execute(
+            f"""SELECT id FROM tasks WHERE id IN ({ids})
+                AND (state = ? OR (state = ? AND worker_id IS NOT ?))""",
+            (*task_ids, PENDING, RUNNING, worker_id),
+        )
+        return [row[0] for row in rows]
+
+
+def expire_leases(max_claims: int = MAX_CLAIMS) -> dict:
+    """
+    Takes back the RUNNING tasks whose lease has expired, e.g. because their
+    worker crashed. Queued tasks are requeued, keeping their place in the
+    queue, and resume from their last checkpoint; batch items, which are not
+    claimed from the queue, and tasks already claimed ``max_claims`` times are
+    failed instead, along with the tasks attached to them.
+
+    Returns:
+        dict: The number of tasks requeued and failed.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        expired = conn.execute(
+            """SELECT id, batch_id IS NULL AND claims < ? FROM tasks
+               WHERE state = ? AND lease_until < ?""",
+            (max_claims, RUNNING, now),
+        ).fetchall()
+        requeue = [task_id for task_id, requeue in expired if requeue]
+        fail = [task_id for task_id, requeue in expired if not requeue]
+        conn.executemany(
+            """UPDATE tasks SET state = ?, worker_id = NULL, lease_until = NULL,
+               updated_at = ?, version = version + 1 WHERE id = ?""",
+            [(PENDING, now, task_id) for task_id in requeue],
+        )
+        conn.executemany(
+            """UPDATE tasks SET state = ?, error = ?, updated_at = ?,
+               version = version + 1
+               WHERE id = ? OR (leader_id = ? AND state = ?)""",
+            [
+                (FAILED, json.dumps(LEASE_EXPIRED), now, task_id, task_id, PENDING)
+                for task_id in fail
+            ],
+        )
+    return {"requeued": len(requeue), "failed": len(fail)}
+
+
+def sweep_tasks(
+    retention: float = RETENTION,
+    stale_after: float = STALE_AFTER,
+    checkpoint_ttl: float = CHECKPOINT_TTL,
+) -> dict:
+    """
+    Deletes finished tasks older than the retention period and fails unfinished
+    tasks that have not been updated recently (e.g. after a worker crash).
+    Deletes the checkpoints of tasks that can no longer be resumed and those
+    older than ``checkpoint_ttl``.
+
+    Returns:
+        dict: The number of tasks deleted and failed, and of checkpoints evicted.
+    """
+    now = time.time()
+    with pool.connection() as conn:
+        deleted = conn.execute(
+            "DELETE FROM tasks WHERE state IN (?, ?, ?) AND updated_at < ?",
+            (SUCCESS, FAILED, CANCELLED, now - retention),
+        ).rowcount
+        failed = conn.execute(
+            """UPDATE tasks SET state = ?, error = ?, updated_at = ?,
+               version = version + 1
+               WHERE state IN (?, ?) AND updated_at < ?""",
+            (
+                FAILED,
+                json.dumps(ABANDONED),
+                now,
+                PENDING,
+                RUNNING,
+                now - stale_after,
+            ),
+        ).rowcount
+        # Batches whose items have all been deleted
+        conn.execute(
+            """DELETE FROM batches WHERE NOT EXISTS
+               (SELECT 1 FROM tasks WHERE tasks.batch_id = batches.id)"""
+        )
+        evicted = conn.execute(
+            """DELETE FROM checkpoints WHERE updated_at < ? OR NOT EXISTS
+               (SELECT 1 FROM tasks WHERE tasks.id = checkpoints.task_id
+                AND tasks.state IN (?, ?, ?))""",
+            (now - checkpoint_ttl, PENDING, RUNNING, FAILED),
+        ).rowcount
+    return {"deleted": deleted, "failed": failed, "checkpoints_evicted": evicted}
+
+
+def drop_db():
+    """
+    Drops the tasks, batches and checkpoints tables from the database.
+    """
+    with pool.connection() as conn:
+        conn.execute("DROP TABLE tasks")
+        conn.execute("DROP TABLE IF EXISTS batches")
+        conn.execute("DROP TABLE IF EXISTS checkpoints")
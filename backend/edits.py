@@ -0,0 +1,251 @@
+"""
+This module contains incremental edits of finished itineraries: planning one
+day again, replacing one activity, or changing the number of days.
+
+Edits reuse the recommendations a task's itinerary was planned from, kept as
+the task's context (see ``edit_context``), so research and recommendations
+are not run again. Only the itinerary generator is asked to plan the affected
+days, with a prompt listing just the candidate activities by title (see
+``ItineraryGeneratorAgent.plan_with_llm``), and the formatter prepares them.
+The edited itinerary replaces the task's result.
+"""
+
+import asyncio
+import copy
+import logging
+
+from agents.itinerary_generator import ITINERARY_LLM_TIMEOUT, ITINERARY_SCHEDULER
+from db.db import SUCCESS, get_task_context, update_result
+from langgraph_agent import TravelForgeAgent
+
+logger = logging.getLogger(__name__)
+
+
+class EditConflict(Exception):
+    """
+    The task's itinerary cannot be edited as asked, e.g. because the task has
+    not finished or was edited concurrently.
+    """
+
+
+def edit_context(state: dict) -> dict:
+    """
+    Returns a copy of the part of a pipeline state that edits reuse: the
+    request and the activity recommendations.
+    """
+    return copy.deepcopy(
+        {
+            "user_form_submission": state["user_form_submission"],
+            "activity_recs": state["activity_recs"],
+        }
+    )
+
+
+class EditableItinerary:
+    """
+    A task's itinerary, as the recommendation ids planned on each day.
+    """
+
+    def __init__(self, task_id: str, task: dict):
+        if task["state"] != SUCCESS:
+            raise EditConflict(f"Task is {task['state']}")
+        if task["context"] is None:
+            raise EditConflict("This itinerary cannot be edited")
+        self.task_id = task_id
+        self.version = task["version"]
+        self.result = task["result"]
+        self.context = task["context"]
+        self.recs = {rec["id"]: rec for rec in self.context["activity_recs"]}
+        # The formatted result keeps each activity's title, but not its id
+        ids_by_title = {rec["title"]: rec["id"] for rec in self.recs.values()}
+        self.days = [
+            [
+                ids_by_title[activity["title"]]
+                for activity in day["activity_recs"]
+                if activity.get("title") in ids_by_title
+            ]
+            for day in self.result["itinerary"]
+        ]
+
+    def unused(self) -> list:
+        """
+        Returns the recommendations not planned on any day.
+        """
+        used = {activity_id for day in self.days for activity_id in day}
+        return [rec for rec in self.recs.values() if rec["id"] not in used]
+
+    def titles(self, ids: list) -> str:
+        return ", ".join(f"'{self.recs[i]['title']}'" for i in ids)
+
+    def check_day(self, day: int):
+        if not 1 <= day <= len(self.result["itinerary"]):
+            raise LookupError(f"Day {day} is not in the itinerary")
+
+    def render(self, day: int, ids: list) -> dict:
+        """
+        Formats a planned day like the pipeline's result.
+        """
+        formatter = TravelForgeAgent.get_agent("format")
+        itinerary_day = {
+            "day": day,
+            "activity_recs": [copy.deepcopy(self.recs[i]) for i in ids],
+        }
+        return formatter.remove_ids_from_itinerary_activities([itinerary_day])[0]
+
+    async def save(self, itinerary: list) -> dict:
+        """
+        Replaces the task's itinerary, keeping its accommodation recommendations.
+
+        Returns:
+            dict: The new result.
+        """
+        result = {**self.result, "itinerary": itinerary}
+        saved = await asyncio.to_thread(
+            update_result, self.task_id, self.version, result, self.context
+        )
+        if not saved:
+            raise EditConflict("The itinerary was changed meanwhile, please retry")
+        return result
+
+
+async def load(task_id: str) -> EditableItinerary:
+    task = await asyncio.to_thread(get_task_context, task_id)
+    if task is None:
+        raise LookupError("Task not found")
+    return EditableItinerary(task_id, task)
+
+
+async def regenerate_day(task_id: str, day: int) -> dict:
+    """
+    Plans one day of a task's itinerary again, from its current activities and
+    the recommendations not planned on other days.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        day (int): The day number.
+
+    Returns:
+        dict: The task's new result.
+    """
+    itinerary = await load(task_id)
+    itinerary.check_day(day)
+    current = itinerary.days[day - 1]
+    candidates = [itinerary.recs[i] for i in current] + itinerary.unused()
+    per_day = round(len(itinerary.recs) / max(len(itinerary.days), 1))
+    instructions = (
+        f"Plan day {day} again; it currently includes"
+        f" {itinerary.titles(current) or 'nothing'}. Suggest a different selection"
+        f" of about {max(len(current), per_day, 1)} candidates that work well"
+        f" together on one day. Output only day {day}."
+    )
+    agent = TravelForgeAgent.get_agent("generate_itinerary")
+    planned = await agent.plan_with_llm(itinerary.context, instructions, candidates)
+    ids = next((d["recommended_activity_ids"] for d in planned if d["day"] == day), [])
+    if not ids:
+        raise ValueError(f"The model did not plan day {day}")
+    days = list(itinerary.result["itinerary"])
+    days[day - 1] = itinerary.render(day, ids)
+    return await itinerary.save(days)
+
+
+async def replace_activity(task_id: str, day: int, position: int) -> dict:
+    """
+    Replaces one activity of a task's itinerary with a recommendation not
+    planned on any day.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        day (int): The day number.
+        position (int): The 1-based position of the activity within the day.
+
+    Returns:
+        dict: The task's new result.
+    """
+    itinerary = await load(task_id)
+    itinerary.check_day(day)
+    activities = itinerary.result["itinerary"][day - 1]["activity_recs"]
+    if not 1 <= position <= len(activities):
+        raise LookupError(f"Day {day} has no activity {position}")
+    candidates = itinerary.unused()
+    if not candidates:
+        raise EditConflict("No other recommendations are left to choose from")
+    current = itinerary.days[day - 1]
+    instructions = (
+        f"Day {day} includes {itinerary.titles(current)}."
+        f" Replace '{activities[position - 1]['title']}' with the candidate that"
+        " fits best with the rest of the day. Output only day"
+        f" {day}, with just the id of the replacement."
+    )
+    agent = TravelForgeAgent.get_agent("generate_itinerary")
+    planned = await agent.plan_with_llm(itinerary.context, instructions, candidates)
+    replacement = next(
+        (ids[0] for ids in (d["recommended_activity_ids"] for d in planned) if ids),
+        None,
+    )
+    if replacement is None:
+        raise ValueError("The model did not suggest a replacement")
+    days = list(itinerary.result["itinerary"])
+    replaced = itinerary.render(day, [replacement])["activity_recs"][0]
+    days[day - 1] = {
+        **days[day - 1],
+        "activity_recs": [
+            replaced if i == position - 1 else activity
+            for i, activity in enumerate(activities)
+        ],
+    }
+    return await itinerary.save(days)
+
+
+async def change_num_days(task_id: str, num_days: int) -> dict:
+    """
+    Plans a task's itinerary again over a different number of days, from all
+    of its recommendations. Follows the request's scheduler, like the
+    pipeline (see ``ItineraryGeneratorAgent.run``); the local planner geocodes
+    recommendations kept without coordinates first, and the coordinates are
+    saved with them.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        num_days (int): The new number of days.
+
+    Returns:
+        dict: The task's new result.
+    """
+    itinerary = await load(task_id)
+    itinerary.context["user_form_submission"]["num_days"] = num_days
+    travel_info = itinerary.context
+    agent = TravelForgeAgent.get_agent("generate_itinerary")
+    scheduler = (
+        travel_info["user_form_submission"].get("scheduler") or ITINERARY_SCHEDULER
+    )
+
+    async def plan() -> list:
+        instructions = (
+            f"Plan the whole trip over {num_days} days, spreading the candidates"
+            " over the days. Output every day."
+        )
+        planned = await agent.plan_with_llm(
+            travel_info, instructions, list(itinerary.recs.values())
+        )
+        ids_by_day = {d["day"]: d["recommended_activity_ids"] for d in planned}
+        return [ids_by_day.get(day, []) for day in range(1, num_days + 1)]
+
+    async def plan_locally() -> list:
+        # Geocodes the recommendations in place if the pipeline did not, so
+        # that the saved context and result keep their coordinates
+        planned = await agent.plan_itinerary_locally(travel_info)
+        return [[rec["id"] for rec in day["activity_recs"]] for day in planned]
+
+    if scheduler == "local":
+        days = await plan_locally()
+    elif scheduler == "auto":
+        try:
+            days = await asyncio.wait_for(plan(), ITINERARY_LLM_TIMEOUT)
+        except Exception as e:
+            logger.warning("Falling back to local itinerary planning: %r", e)
+            days = await plan_locally()
+    else:
+        days = await plan()
+    return await itinerary.save(
+        [itinerary.render(day, ids) for day, ids in enumerate(days, start=1)]
+    )
@@ -0,0 +1,316 @@
+"""
+This module contains the publish/subscribe channel used to push task progress
+to connected clients.
+
+Events are fanned out in-process. With the Redis task store backend, they are
+also relayed through Redis pub/sub, so that a client connected to one web
+process follows a task run by a worker in another process or on another host.
+"""
+
+import asyncio
+import json
+import logging
+from collections import defaultdict
+
+from db.db import STALE_AFTER, TASKS_BACKEND, TERMINAL_STATES, WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# Seconds a new subscriber waits for Redis to confirm its task's subscription
+SUBSCRIBE_TIMEOUT = 5
+
+
+class RedisEventRelay:
+    """
+    Carries task events between processes over Redis pub/sub.
+
+    Each event is published on the task's channel, tagged with the publishing
+    process so that it does not deliver its own events twice, and kept as the
+    task's latest event for processes whose clients subscribe mid-run. A
+    process only subscribes to the channels of the tasks its clients follow
+    (see ``watch``), so it does not receive the events of other tasks.
+    Publishing never blocks the caller: events are sent in the background, in
+    order, and dropped (with a warning) while Redis cannot be reached.
+    """
+
+    def __init__(self, url: str, prefix: str):
+        self.url = url
+        self.prefix = prefix
+        self.retention = None
+        self._redis = None
+        self._pubsub = None
+        self._outbox = None
+        self._tasks = []
+        # Tasks followed in this process, the channels subscribed to for them
+        # and the lock under which subscriptions are brought in line
+        self._watched = set()
+        self._subscribed = set()
+        self._subscribing = None
+        self._unwatching = set()
+        # Subscriptions not yet confirmed by Redis, by channel
+        self._unconfirmed = {}
+
+    def channel(self, task_id: str) -> str:
+        return f"{self.prefix}events:{task_id}"
+
+    def latest_key(self, task_id: str) -> str:
+        return f"{self.prefix}event:{task_id}"
+
+    async def start(self, deliver, retention: float):
+        """
+        Starts relaying events: those published here to Redis, and those
+        published by other processes on watched tasks to ``deliver(task_id,
+        event)``. The latest event of a finished task is kept for ``retention``
+        seconds.
+        """
+        from redis import asyncio as aioredis
+        from redis.asyncio.retry import Retry
+
+        from db.redis_store import connection_options
+
+        self.retention = retention
+        self._redis = aioredis.Redis.from_url(
+            self.url, **connection_options(retry_class=Retry)
+        )
+        self._pubsub = self._redis.pubsub()
+        self._subscribing = asyncio.Lock()
+        self._outbox = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._send()),
+            asyncio.create_task(self._listen(deliver)),
+        ]
+
+    async def stop(self):
+        tasks = self._tasks + list(self._unwatching)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks, self._outbox = [], None
+        if self._redis is not None:
+            await self._pubsub.aclose()
+            await self._redis.aclose()
+            self._redis = self._pubsub = None
+        self._watched.clear()
+        self._subscribed.clear()
+        self._unconfirmed.clear()
+
+    def send(self, task_id: str, event: dict):
+        if self._outbox is not None:
+            self._outbox.put_nowait((task_id, event))
+
+    async def latest(self, task_id: str) -> dict:
+        """
+        Returns the latest event published for a task by any process, or None.
+        """
+        if self._redis is None:
+            return None
+        message = await self._redis.get(self.latest_key(task_id))
+        return json.loads(message)["event"] if message else None
+
+    async def watch(self, task_id: str):
+        """
+        Subscribes to a task's events, when a client of this process starts
+        following the task. Returns once Redis has confirmed the subscription,
+        so that events published from then on are delivered and earlier ones
+        can be read with ``latest``.
+        """
+        self._watched.add(task_id)
+        confirmed = await self._update_subscription(task_id)
+        if confirmed is not None:
+            try:
+                await asyncio.wait_for(confirmed.wait(), SUBSCRIBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Subscribing to task events timed out")
+
+    def unwatch(self, task_id: str):
+        """
+        Unsubscribes from a task's events, in the background, when the last
+        client of this process following the task has left.
+        """
+        self._watched.discard(task_id)
+        if self._redis is not None:
+            task = asyncio.create_task(self._update_subscription(task_id))
+            self._unwatching.add(task)
+            task.add_done_callback(self._unwatching.discard)
+
+    async def _update_subscription(self, task_id: str) -> asyncio.Event:
+        """
+        Subscribes to or unsubscribes from a task's channel, as its clients
+        require. Returns an event set once a new subscription is confirmed.
+        """
+        if self._redis is None:
+            return None
+        channel = self.channel(task_id)
+        # Run in order, so that the last of a task's watch and unwatch wins
+        async with self._subscribing:
+            try:
+                if task_id in self._watched and channel not in self._subscribed:
+                    confirmed = self._unconfirmed[channel] = asyncio.Event()
+                    await self._pubsub.subscribe(channel)
+                    self._subscribed.add(channel)
+                    return confirmed
+                elif task_id not in self._watched and channel in self._subscribed:
+                    self._subscribed.discard(channel)
+                    await self._pubsub.unsubscribe(channel)
+            except Exception as e:
+                logger.warning("Updating task event subscriptions failed: %r", e)
+        return None
+
+    async def _send(self):
+        while True:
+            events = [await self._outbox.get()]
+            while not self._outbox.empty():
+                events.append(self._outbox.get_nowait())
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    for task_id, event in events:
+                        message = json.dumps({"origin": WORKER_ID, "event": event})
+                        ttl = (
+                            self.retention
+                            if event["state"] in TERMINAL_STATES
+                            else STALE_AFTER
+                        )
+                        pipe.set(self.latest_key(task_id), message, px=int(ttl * 1000))
+                        pipe.publish(self.channel(task_id), message)
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning("Relaying %d task events failed: %r", len(events), e)
+
+    async def _listen(self, deliver):
+        prefix = self.channel("")
+        while True:
+            try:
+                # Connects, or reconnects and subscribes again after a failure
+                await self._pubsub.connect()
+                message = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Task event subscription lost, reconnecting: %r", e)
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message["channel"].decode()
+            if message["type"] == "subscribe":
+                confirmed = self._unconfirmed.pop(channel, None)
+                if confirmed is not None:
+                    confirmed.set()
+            elif message["type"] == "message":
+                relayed = json.loads(message["data"])
+                if relayed["origin"] != WORKER_ID:
+                    deliver(channel[len(prefix) :], relayed["event"])
+
+
+class TaskEventBus:
+    """
+    Fans out task progress events to every subscriber of a task.
+
+    The latest event of each task is retained so that clients subscribing
+    mid-run immediately learn the current stage. Retained events of finished
+    tasks are dropped after ``retention`` seconds; the task store remains the
+    source of truth for final results.
+    """
+
+    def __init__(self, retention: float = 60, relay: RedisEventRelay = None):
+        self.retention = retention
+        self.relay = relay
+        self._subscribers = defaultdict(set)
+        self._latest = {}
+
+    async def start(self):
+        """
+        Starts relaying events between processes, if a relay is configured.
+        """
+        if self.relay is not None:
+            await self.relay.start(self._relayed, self.retention)
+
+    async def stop(self):
+        if self.relay is not None:
+            await self.relay.stop()
+
+    def publish(self, task_id: str, event: dict):
+        """
+        Publishes an event to all current subscribers of a task, in this
+        process and, through the relay, in others.
+
+        Args:
+            task_id (str): The unique identifier for the task.
+            event (dict): The event payload; must contain a "state" key.
+        """
+        self._deliver(task_id, event)
+        if self.relay is not None:
+            self.relay.send(task_id, event)
+
+    def _deliver(self, task_id: str, event: dict):
+        self._latest[task_id] = event
+        for queue in self._subscribers.get(task_id, ()):
+            queue.put_nowait(event)
+        if event["state"] in TERMINAL_STATES:
+            asyncio.get_running_loop().call_later(
+                self.retention, self._latest.pop, task_id, None
+            )
+
+    def _relayed(self, task_id: str, event: dict):
+        # Events of other processes' tasks are only kept while subscribed to;
+        # the relay keeps the latest one for later subscribers
+        if task_id in self._subscribers:
+            self._deliver(task_id, event)
+
+    async def subscribe(self, task_id: str, heartbeat: float = None):
+        """
+        Yields events for a task as they are published, starting with the latest
+        retained event, until a terminal event has been delivered.
+
+        Args:
+            task_id (str): The unique identifier for the task.
+            heartbeat (float, optional): If set, yields None whenever no event
+                has arrived for this many seconds, so callers can keep idle
+                connections alive.
+        """
+        queue = asyncio.Queue()
+        self._subscribers[task_id].add(queue)
+        try:
+            if self.relay is not None and len(self._subscribers[task_id]) == 1:
+                await self.relay.watch(task_id)
+            if task_id in self._latest:
+                queue.put_nowait(self._latest[task_id])
+            elif self.relay is not None:
+                # The task may be running in another process
+                try:
+                    latest = await self.relay.latest(task_id)
+                except Exception as e:
+                    logger.warning("Reading the latest task event failed: %r", e)
+                    latest = None
+                if latest is not None and queue.empty():
+                    queue.put_nowait(latest)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield event
+                if event["state"] in TERMINAL_STATES:
+                    return
+        finally:
+            self._subscribers[task_id].discard(queue)
+            if not self._subscribers[task_id]:
+                del self._subscribers[task_id]
+                if self.relay is not None:
+                    self.relay.unwatch(task_id)
+
+
+def make_relay() -> RedisEventRelay:
+    """
+    Returns the relay for the configured task store backend, or None if events
+    stay within the process.
+    """
+    if TASKS_BACKEND != "redis":
+        return None
+    from db.redis_store import REDIS_KEY_PREFIX, REDIS_URL
+
+    return RedisEventRelay(REDIS_URL, REDIS_KEY_PREFIX)
+
+
+task_events = TaskEventBus(relay=make_relay())
@@ -0,0 +1,599 @@
+"""
+This module contains the itinerary job queue: admission control for new jobs
+and the worker pool that runs them.
+
+Jobs are queued as PENDING tasks in the task store, so workers can run inside
+the web process (``JOB_WORKERS`` > 0) or in separate processes started with
+``python worker.py``, or both.
+
+Jobs save the output of each completed stage as a checkpoint of their task,
+and resume from it when the task is retried after failing.
+
+Jobs of cancelled tasks are aborted wherever they run: the process handling
+the cancellation aborts its own job straight away, and every process checks
+the task store for cancelled tasks among the jobs it is running. Tasks whose
+clients have all stopped following their event streams, e.g. because the page
+was closed, are cancelled after ``TASK_ABANDON_AFTER`` seconds (see
+``cancel_unwatched``).
+
+Every process also renews the leases of the jobs it is running (see
+``heartbeat``), so that the tasks of a process that crashed or hung are
+requeued once their leases expire, and resume from their last checkpoint.
+"""
+
+import asyncio
+import contextlib
+import copy
+import logging
+import math
+import os
+import time
+
+from db.db import (
+    CANCELLED,
+    FAILED,
+    HEARTBEAT_INTERVAL,
+    RUNNING,
+    SUCCESS,
+    TERMINAL_STATES,
+    WORKER_ID,
+    aborted_tasks,
+    attach_to_inflight,
+    cancel_task,
+    claim_next_task,
+    delete_checkpoint,
+    enqueue_task,
+    expire_leases,
+    get_task,
+    get_task_context,
+    load_checkpoint,
+    queue_depth,
+    renew_leases,
+    resolve_followers,
+    save_checkpoint,
+    store_task,
+    touch_watched,
+    unwatched_tasks,
+)
+from agents.deadlines import request_budget
+from agents.telemetry import Counter, Gauge, Histogram, bind_log_fields, span, trace
+from edits import edit_context
+from events import task_events
+from langgraph_agent import TravelForgeAgent
+from result_cache import RESULT, result_cache
+from schemas import ItineraryRequest
+
+logger = logging.getLogger(__name__)
+
+# Number of pipelines run concurrently by each process's worker pool
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+# Maximum number of PENDING jobs before new submissions are rejected with 429
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", 100))
+# How often idle workers check the queue for jobs enqueued by other processes
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+# How often the task store is checked for cancelled tasks among running jobs
+JOB_CANCEL_POLL_INTERVAL = float(os.getenv("JOB_CANCEL_POLL_INTERVAL", 1.0))
+
+# Cancel PENDING and RUNNING tasks once no client has followed them for this
+# many seconds, e.g. because the user closed the page; 0 disables. Reloading
+# the page reconnects well within it. Should exceed the 15 s heartbeat of the
+# event streams, which keeps idle followers marked as watched.
+TASK_ABANDON_AFTER = float(os.getenv("TASK_ABANDON_AFTER", 60))
+
+# Priority lanes: lower values are claimed first. Lower lanes are admitted only
+# while the queue is below the given fraction of JOB_QUEUE_MAX_DEPTH, keeping
+# headroom for higher lanes under load.
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+LANE_ADMISSION = {"high": 1.0, "normal": 0.8, "low": 0.5}
+
+# Stream LLM output and push partial results to /task-events subscribers
+STREAM_PARTIAL_RESULTS = os.getenv("STREAM_PARTIAL_RESULTS", "1") == "1"
+
+# Submissions attached to an identical in-flight pipeline, and the upstream
+# calls that pipeline would otherwise have made
+dedup_stats = {"attached": 0, "saved_search_calls": 0, "saved_llm_calls": 0}
+
+jobs_total = Counter("travelforge_jobs_total", "Itinerary jobs by outcome", ("state",))
+jobs_in_flight = Gauge("travelforge_jobs_in_flight", "Jobs being run by this process")
+job_duration = Histogram(
+    "travelforge_job_duration_seconds", "Time from claiming a job to its outcome"
+)
+queue_wait = Histogram(
+    "travelforge_queue_wait_seconds",
+    "Time jobs spend queued before a worker claims them",
+)
+queue_depth_gauge = Gauge(
+    "travelforge_queue_depth", "Jobs waiting for a worker", collect=queue_depth
+)
+leases_expired = Counter(
+    "travelforge_leases_expired_total",
+    "RUNNING tasks taken back from unresponsive workers, by what became of them",
+    ("outcome",),
+)
+
+# Jobs running in this process, by task ID, so that they can be aborted
+running_jobs = {}
+# When this process last marked each task as watched, see ``watch_task``
+watched_tasks = {}
+
+# Pipeline stage that produces each kind of partial result
+PARTIAL_RESULT_STAGES = {
+    "activity_recs": "recommend",
+    "accomm_recs": "recommend",
+    "itinerary": "generate_itinerary",
+}
+
+
+async def generate_itinerary_job(
+    task_id: str, user_form_submission: dict, research_fn=None
+):
+    """
+    Runs the itinerary pipeline for a claimed task and stores the outcome.
+
+    A task retried after failing resumes after the last stage it completed.
+    Otherwise, stages whose output can be reused from the result cache are
+    skipped, and the finished itinerary is added to the cache.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        user_form_submission (dict): The user's submitted preferences.
+        research_fn (callable, optional): Runs the research stage in place of
+            the pipeline's researcher, e.g. with searches shared across a batch
+            (see ``batches``). Awaited with the submission, unless the result
+            cache can skip past research.
+    """
+
+    # Stage in progress, reported with failures
+    current_stage = None
+
+    def publish_stage(stage: str):
+        nonlocal current_stage
+        current_stage = stage
+        task_events.publish(task_id, {"id": task_id, "state": RUNNING, "stage": stage})
+
+    def publish_partial(key: str, item: dict):
+        # Other arrays the model may emit are not partial results
+        stage = PARTIAL_RESULT_STAGES.get(key)
+        if stage is None:
+            return
+        if item is None:
+            # Clients drop the partial results they received under key
+            partial = {"key": key, "reset": True}
+        else:
+            partial = {"key": key, "item": item}
+        task_events.publish(
+            task_id,
+            {"id": task_id, "state": RUNNING, "stage": stage, "partial": partial},
+        )
+
+    # Output of each completed stage, keyed by stage name
+    stage_outputs = {}
+    # The latest recommendations, kept with the result for later edits
+    context = None
+
+    async def save_output(stage: str, output: dict):
+        nonlocal context
+        stage_outputs[stage] = output
+        if "activity_recs" in output:
+            context = edit_context(output)
+        if stage == TravelForgeAgent.FINISH_POINT:
+            return
+        try:
+            await asyncio.to_thread(
+                save_checkpoint,
+                task_id,
+                stage,
+                TravelForgeAgent.checkpoint(stage, output),
+            )
+        except Exception as e:
+            logger.warning("Saving the %s checkpoint failed: %r", stage, e)
+
+    request = ItineraryRequest(**user_form_submission).canonical()
+    checkpoint = await asyncio.to_thread(load_checkpoint, task_id)
+    if checkpoint and TravelForgeAgent.next_stage(checkpoint[0]) is None:
+        # Left by a stage that is no longer part of the pipeline
+        checkpoint = None
+    match = None
+    if result_cache is not None and checkpoint is None:
+        try:
+            match = await result_cache.alookup(request)
+        except Exception as e:
+            logger.warning("Result cache lookup failed: %r", e)
+        result_cache.record(match.level if match else None)
+    tf = TravelForgeAgent()
+    try:
+        if match and match.level == RESULT:
+            result = match.result
+            context = edit_context(
+                {**match.state, "user_form_submission": user_form_submission}
+            )
+        else:
+            start_at, state = None, None
+            # The time budget covers the pipeline run, see agents.deadlines
+            with request_budget():
+                if checkpoint:
+                    completed, state = checkpoint
+                    start_at = TravelForgeAgent.next_stage(completed)
+                    logger.info("Resuming after the %s stage", completed)
+                elif match:
+                    completed, state = match.resume(user_form_submission)
+                    start_at = TravelForgeAgent.next_stage(completed)
+                    logger.info("Reusing cached %s", match.level)
+                    if completed == "recommend":
+                        # The recommend stage is skipped; cache the output it reused
+                        stage_outputs["recommend"] = copy.deepcopy(state)
+                elif research_fn is not None:
+                    publish_stage("research")
+                    state = await research_fn(user_form_submission)
+                    await save_output("research", copy.deepcopy(state))
+                    start_at = TravelForgeAgent.next_stage("research")
+                if state and "activity_recs" in state:
+                    context = edit_context(state)
+                result = await tf.arun(
+                    user_form_submission,
+                    on_stage=publish_stage,
+                    on_partial=publish_partial if STREAM_PARTIAL_RESULTS else None,
+                    on_output=save_output,
+                    start_at=start_at,
+                    state=state,
+                )
+    except Exception as e:
+        jobs_total.inc(state=FAILED)
+        error = {"type": type(e).__name__, "message": str(e), "stage": current_stage}
+        await asyncio.to_thread(store_task, task_id, FAILED, error=error)
+        await asyncio.to_thread(resolve_followers, task_id, FAILED, error=error)
+        task_events.publish(task_id, {"id": task_id, "state": FAILED, "error": error})
+        raise e
+    jobs_total.inc(state=SUCCESS)
+    await asyncio.to_thread(store_task, task_id, SUCCESS, result, context=context)
+    await asyncio.to_thread(
+        resolve_followers, task_id, SUCCESS, result, context=context
+    )
+    task_events.publish(task_id, {"id": task_id, "state": SUCCESS, "result": result})
+    try:
+        await asyncio.to_thread(delete_checkpoint, task_id)
+    except Exception as e:
+        logger.warning("Deleting the checkpoint failed: %r", e)
+
+    if result_cache is not None and "recommend" in stage_outputs:
+        try:
+            await result_cache.astore(request, result, stage_outputs["recommend"])
+        except Exception as e:
+            logger.warning("Caching the result failed: %r", e)
+
+
+async def follow_inflight(
+    task_id: str, leader_id: str, user_form_submission: dict
+) -> bool:
+    """
+    Waits for an identical task in flight and, if it succeeds, stores its
+    result as the outcome of ``task_id`` and of the tasks attached to it,
+    relaying the leader's progress events meanwhile. Batch items, which run in
+    their batch rather than being attached in the task store, use it to share
+    the pipeline of a request submitted on its own.
+
+    Args:
+        task_id (str): The unique identifier for the RUNNING task.
+        leader_id (str): The task running the identical request.
+        user_form_submission (dict): The task's request.
+
+    Returns:
+        bool: Whether the task was resolved. It is not if the leader failed or
+        was cancelled, in which case the caller runs the task's own pipeline.
+    """
+    state = None
+    # Only events of leaders running in this process or relayed through Redis
+    # arrive here; fall back to the task store when idle
+    events = task_events.subscribe(leader_id, heartbeat=HEARTBEAT_INTERVAL)
+    async with contextlib.aclosing(events):
+        async for event in events:
+            if event is None:
+                leader = await asyncio.to_thread(get_task, leader_id, False)
+                state = leader["state"] if leader else FAILED
+            else:
+                state = event["state"]
+                if state not in TERMINAL_STATES:
+                    task_events.publish(task_id, {**event, "id": task_id})
+            if state in TERMINAL_STATES:
+                break
+    if state != SUCCESS:
+        return False
+    leader = await asyncio.to_thread(get_task_context, leader_id)
+    if leader is None or leader["state"] != SUCCESS:
+        return False
+    result, context = leader["result"], leader["context"]
+    saved = upstream_calls(user_form_submission)
+    dedup_stats["attached"] += 1
+    dedup_stats["saved_search_calls"] += saved["search"]
+    dedup_stats["saved_llm_calls"] += saved["llm"]
+    await asyncio.to_thread(store_task, task_id, SUCCESS, result, context=context)
+    await asyncio.to_thread(
+        resolve_followers, task_id, SUCCESS, result, context=context
+    )
+    task_events.publish(task_id, {"id": task_id, "state": SUCCESS, "result": result})
+    return True
+
+
+async def run_cancellable(task_id: str, job) -> bool:
+    """
+    Runs a job as a task registered in ``running_jobs``, so that ``abort_job``
+    can cancel it.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        job: The job's coroutine.
+
+    Returns:
+        bool: False if the job was aborted.
+    """
+    job = asyncio.ensure_future(job)
+    running_jobs[task_id] = job
+    try:
+        await job
+        return True
+    except asyncio.CancelledError:
+        # Only swallow the job's own cancellation, not the caller's
+        if asyncio.current_task().cancelling():
+            raise
+        jobs_total.inc(state=CANCELLED)
+        logger.info("Job aborted")
+        return False
+    finally:
+        running_jobs.pop(task_id, None)
+
+
+def abort_job(task_id: str) -> bool:
+    """
+    Cancels the task's job if it is running in this process, which also
+    cancels its in-flight upstream calls.
+
+    Returns:
+        bool: Whether a job was running.
+    """
+    job = running_jobs.get(task_id)
+    if job is None:
+        return False
+    job.cancel()
+    return True
+
+
+async def cancel_job(task_id: str) -> dict:
+    """
+    Cancels a task and aborts its job if it is running in this process, unless
+    an identical request attached to the task still needs it. Jobs running in
+    other processes are aborted by their own ``watch_cancellations``.
+
+    Returns:
+        dict: The outcome of ``cancel_task``: the task's "state" before
+        cancelling and whether its job was "aborted", or None if the task does
+        not exist.
+    """
+    outcome = await asyncio.to_thread(cancel_task, task_id)
+    if outcome and outcome["state"] not in TERMINAL_STATES and outcome["aborted"]:
+        abort_job(task_id)
+        task_events.publish(task_id, {"id": task_id, "state": CANCELLED})
+    return outcome
+
+
+async def watch_task(task_id: str, arm: bool = True):
+    """
+    Marks a task as followed by a client of this process, e.g. over its event
+    stream, so that it is not cancelled by ``cancel_unwatched``. Writes to the
+    task store at most every ``TASK_ABANDON_AFTER / 4`` seconds per task.
+
+    Unless ``arm``, only tasks a client has already followed this way are
+    marked, e.g. when a client polls after its event stream dropped.
+    """
+    if TASK_ABANDON_AFTER <= 0:
+        return
+    now = time.monotonic()
+    if now - watched_tasks.get(task_id, -math.inf) < TASK_ABANDON_AFTER / 4:
+        return
+    watched_tasks[task_id] = now
+    try:
+        await asyncio.to_thread(touch_watched, task_id, arm)
+    except Exception as e:
+        logger.warning("Marking a task as watched failed: %r", e)
+
+
+async def cancel_unwatched(after: float = TASK_ABANDON_AFTER):
+    """
+    Every ``after / 4`` seconds until cancelled, cancels the PENDING and
+    RUNNING tasks that clients followed (see ``watch_task``) but have not for
+    ``after`` seconds. Tasks only ever polled through /task-status, e.g. by
+    older clients, and batch items are never cancelled this way.
+    """
+    while True:
+        await asyncio.sleep(after / 4)
+        threshold = time.monotonic() - after
+        for task_id, watched_at in list(watched_tasks.items()):
+            if watched_at < threshold:
+                del watched_tasks[task_id]
+        try:
+            unwatched = await asyncio.to_thread(unwatched_tasks, time.time() - after)
+            for task_id in unwatched:
+                outcome = await cancel_job(task_id)
+                if outcome and outcome["state"] not in TERMINAL_STATES:
+                    logger.info("Cancelled unwatched task", extra={"task_id": task_id})
+        except Exception:
+            logger.exception("Cancelling unwatched tasks failed")
+
+
+async def watch_cancellations(interval: float = JOB_CANCEL_POLL_INTERVAL):
+    """
+    Aborts running jobs whose tasks were cancelled by another process, checking
+    every ``interval`` seconds until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if not running_jobs:
+            continue
+        try:
+            for task_id in await asyncio.to_thread(aborted_tasks, list(running_jobs)):
+                abort_job(task_id)
+        except Exception:
+            logger.exception("Checking for cancelled tasks failed")
+
+
+async def heartbeat(interval: float = HEARTBEAT_INTERVAL):
+    """
+    Every ``interval`` seconds until cancelled, renews the leases of the jobs
+    running in this process, aborting those whose lease was lost to another
+    worker, and takes back the tasks whose leases have expired.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if running_jobs:
+                lost = await asyncio.to_thread(renew_leases, list(running_jobs))
+                for task_id in lost:
+                    logger.warning(
+                        "Lease lost, aborting job", extra={"task_id": task_id}
+                    )
+                    abort_job(task_id)
+            expired = await asyncio.to_thread(expire_leases)
+            if any(expired.values()):
+                logger.warning("Task leases expired", extra=expired)
+            for outcome, count in expired.items():
+                leases_expired.inc(count, outcome=outcome)
+        except Exception:
+            logger.exception("Renewing task leases failed")
+
+
+class WorkerPool:
+    """
+    A fixed number of asyncio workers that claim queued tasks and run them.
+
+    Bounding the number of workers bounds the number of pipelines, and thus
+    outbound LLM and search calls, in flight in this process.
+    """
+
+    def __init__(self, handler, concurrency: int, poll_interval: float):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.busy = 0
+        # Moving average of job duration, used to estimate Retry-After
+        self.avg_job_seconds = 60.0
+        self._wakeup = asyncio.Event()
+        self._workers = []
+
+    def start(self):
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def notify(self):
+        """
+        Wakes idle workers after a job has been enqueued by this process.
+        """
+        self._wakeup.set()
+
+    async def _work(self):
+        while True:
+            task = await asyncio.to_thread(claim_next_task, WORKER_ID)
+            if task is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task_id, payload, created_at = task
+            queue_wait.observe(max(0.0, time.time() - created_at))
+            self.busy += 1
+            jobs_in_flight.inc()
+            start = time.monotonic()
+            with bind_log_fields(task_id=task_id):
+                try:
+                    with trace(task_id), span("job", task_id=task_id):
+                        await run_cancellable(task_id, self.handler(task_id, payload))
+                except Exception as e:
+                    logger.error("Job failed: %r", e)
+                finally:
+                    self.busy -= 1
+                    jobs_in_flight.dec()
+                    elapsed = time.monotonic() - start
+                    job_duration.observe(elapsed)
+                    self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+
+    def stats(self) -> dict:
+        return {"workers": self.concurrency, "busy": self.busy}
+
+
+def upstream_calls(user_form_submission: dict) -> dict:
+    """
+    Returns the number of search and LLM calls a full pipeline run makes.
+    """
+    return {
+        # Two general activity queries, one per interest and one for accommodation
+        "search": 3 + len(user_form_submission["interests"]),
+        # Recommendations and itinerary
+        "llm": 2,
+    }
+
+
+async def admit(task_id: str, request: ItineraryRequest, priority: str, workers=None):
+    """
+    Enqueues a job unless its lane is over its queue-depth limit.
+
+    Requests the result cache can answer completely are stored as SUCCESS
+    straight away. If an equivalent request (same fingerprint) is already queued
+    or running, the task is attached to it instead and resolves to the shared
+    result; such tasks do not count against the queue-depth limit.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        request (ItineraryRequest): The user's submitted preferences.
+        priority (str): One of the ``PRIORITIES`` lanes.
+        workers (WorkerPool, optional): The local worker pool to wake up.
+
+    Returns:
+        int: None if the job was enqueued, attached or served from the cache,
+        otherwise the suggested number of seconds to wait before retrying.
+    """
+    user_form_submission = request.model_dump()
+    # Serve finished itineraries for equivalent requests without queueing
+    if result_cache is not None:
+        match = await result_cache.alookup(request.canonical(), [RESULT])
+        if match:
+            result_cache.record(RESULT)
+            context = edit_context(
+                {**match.state, "user_form_submission": user_form_submission}
+            )
+            await asyncio.to_thread(
+                store_task, task_id, SUCCESS, match.result, context=context
+            )
+            return None
+
+    fingerprint = request.fingerprint()
+    if await asyncio.to_thread(
+        attach_to_inflight, task_id, fingerprint, PRIORITIES[priority]
+    ):
+        saved = upstream_calls(user_form_submission)
+        dedup_stats["attached"] += 1
+        dedup_stats["saved_search_calls"] += saved["search"]
+        dedup_stats["saved_llm_calls"] += saved["llm"]
+        return None
+
+    depth = await asyncio.to_thread(queue_depth)
+    limit = math.floor(JOB_QUEUE_MAX_DEPTH * LANE_ADMISSION[priority])
+    if depth >= limit:
+        # Estimate how long until enough jobs have been claimed to admit this one
+        avg_job_seconds = workers.avg_job_seconds if workers else 60.0
+        concurrency = workers.concurrency if workers and workers.concurrency else 1
+        return max(1, math.ceil((depth - limit + 1) * avg_job_seconds / concurrency))
+
+    await asyncio.to_thread(
+        enqueue_task, task_id, user_form_submission, PRIORITIES[priority], fingerprint
+    )
+    if workers:
+        workers.notify()
+    return None
@@ -1,51 +1,311 @@
-from typing import Dict
+from typing import Callable, Dict
+import asyncio
+import copy
+import inspect
+import logging
 import os
+import threading
 import time
 import json
 
-from langgraph.graph import Graph
-
 # Import agent classes
 from agents import (
     ResearcherAgent,
+    ResearchCompactorAgent,
     RecommenderAgent,
     ItineraryGeneratorAgent,
     FormatterAgent,
+    MapperAgent,
 )
+from agents.clients import warm_up_clients
+from agents.deadlines import with_deadline
+from agents.progress import partial_results
+from agents.retries import with_retries
+from agents.telemetry import instrument_stage
+
+logger = logging.getLogger(__name__)
+
+# Deduplicate, rank and trim research results to a token budget before they
+# are sent to the recommender
+COMPACT_RESEARCH = os.getenv("COMPACT_RESEARCH", "1") == "1"
+# Geocode activity recommendations between the recommend and
+# generate_itinerary stages, attaching "lat" and "lng" to each. Requests whose
+# days are planned locally are geocoded either way, by the itinerary generator
+GEOCODE_ACTIVITIES = os.getenv("GEOCODE_ACTIVITIES", "0") == "1"
 
 
 class TravelForgeAgent:
-    def run(self, user_form_submission: Dict[str, str]):
-        # Initialize agents
-        researcher = ResearcherAgent()
-        recommender = RecommenderAgent()
-        itinerary_generator = ItineraryGeneratorAgent()
-        formatter = FormatterAgent()
+    """
+    Runs the research -> recommend -> generate_itinerary -> format pipeline,
+    with optional compact (research compaction) and map (geocoding) stages
+    before recommend and generate_itinerary respectively.
+
+    The compiled graph and the agent instances backing its nodes are shared by the
+    whole process: they are built once (at startup via ``TravelForgeAgent.warm_up()``
+    or lazily on first use) and reused by every request. Agents keep no per-request
+    state, so concurrent ``arun`` calls on the same compiled graph are safe.
+    """
+
+    # Node name -> agent class whose ``run`` method implements the node
+    NODES = {
+        "research": ResearcherAgent,
+        **({"compact": ResearchCompactorAgent} if COMPACT_RESEARCH else {}),
+        "recommend": RecommenderAgent,
+        **({"map": MapperAgent} if GEOCODE_ACTIVITIES else {}),
+        "generate_itinerary": ItineraryGeneratorAgent,
+        "format": FormatterAgent,
+    }
+    # Each stage feeds the next, in the order of NODES
+    EDGES = list(zip(NODES, list(NODES)[1:]))
+    ENTRY_POINT = "research"
+    FINISH_POINT = "format"
+    # Parts of the pipeline state and the last stage that reads each; they are
+    # left out of the checkpoints of later stages
+    LAST_READ_BY = {"activity_research_results": "recommend"}
+
+    _graph = None
+    # Entry point -> compiled graph running the pipeline from that stage onwards
+    _subgraphs: Dict[str, object] = {}
+    _topology = None
+    _agents: Dict[str, object] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def topology(cls) -> tuple:
+        """
+        Returns a hashable description of the current graph topology.
+        """
+        return (
+            tuple((name, agent_cls) for name, agent_cls in cls.NODES.items()),
+            tuple(cls.EDGES),
+            cls.ENTRY_POINT,
+            cls.FINISH_POINT,
+        )
+
+    @classmethod
+    def next_stage(cls, stage: str) -> str:
+        """
+        Returns the stage that follows ``stage``, or None for the last stage.
+        """
+        return dict(cls.EDGES).get(stage)
+
+    @classmethod
+    def downstream(cls, entry_point: str) -> list:
+        """
+        Returns the node names reachable from ``entry_point``, in pipeline order.
+        """
+        next_stages = dict(cls.EDGES)
+        stages = [entry_point]
+        while stages[-1] in next_stages:
+            stages.append(next_stages[stages[-1]])
+        return stages
+
+    @classmethod
+    def checkpoint(cls, stage: str, state: dict) -> dict:
+        """
+        Returns the part of a stage's output that the stages after it read,
+        i.e. what a run resuming after ``stage`` needs.
+        """
+        stages = list(cls.NODES)
+        return {
+            key: value
+            for key, value in state.items()
+            if key not in cls.LAST_READ_BY
+            or cls.LAST_READ_BY[key] not in stages
+            or stages.index(cls.LAST_READ_BY[key]) > stages.index(stage)
+        }
+
+    @classmethod
+    def build_graph(cls, agents: Dict[str, object], entry_point: str = None):
+        """
+        Builds and compiles the LangGraph pipeline from the given agent instances.
+
+        Args:
+            agents (dict): Mapping of node name to agent instance.
+            entry_point (str, optional): The stage to start from. Stages before it
+                are left out of the graph. Defaults to ``ENTRY_POINT``.
+
+        Returns:
+            The compiled graph.
+        """
+        entry_point = entry_point or cls.ENTRY_POINT
+        stages = set(cls.downstream(entry_point))
+
+        from langgraph.graph import Graph
 
         # Define a Langchain graph
         graph_builder = Graph()
 
-        # Add nodes for each agent
-        graph_builder.add_node("research", researcher.run)
-        graph_builder.add_node("recommend", recommender.run)
-        graph_builder.add_node("generate_itinerary", itinerary_generator.run)
-        graph_builder.add_node("format", formatter.run)
+        # Add nodes for each agent, with its retry policy and deadline, timed and
+        # traced per stage
+        for name, agent in agents.items():
+            if name in stages:
+                node = with_deadline(name, with_retries(name, agent.run))
+                graph_builder.add_node(name, instrument_stage(name, node))
 
         # Define the edges between the agents
-        graph_builder.add_edge("research", "recommend")
-        graph_builder.add_edge("recommend", "generate_itinerary")
-        graph_builder.add_edge("generate_itinerary", "format")
+        for start, end in cls.EDGES:
+            if start in stages:
+                graph_builder.add_edge(start, end)
 
         # Set up start and end nodes
-        graph_builder.set_entry_point("research")
-        graph_builder.set_finish_point("format")
+        graph_builder.set_entry_point(entry_point)
+        graph_builder.set_finish_point(cls.FINISH_POINT)
 
         # Compile the graph
-        graph = graph_builder.compile()
-        print("Graph compiled successfully!")
+        return graph_builder.compile()
+
+    @classmethod
+    def compile(cls, force: bool = False):
+        """
+        Builds the process-wide agent registry and compiled graph.
+
+        Rebuilds only when the topology (``NODES``, ``EDGES``, entry or finish
+        point) has changed since the last compile, or when ``force`` is set.
+        Agent instances are reused across rebuilds where the node's agent class
+        is unchanged. The new graph is swapped in atomically; runs already in
+        flight finish on the graph they started with.
+
+        Returns:
+            The compiled graph.
+        """
+        with cls._lock:
+            topology = cls.topology()
+            if cls._graph is not None and topology == cls._topology and not force:
+                return cls._graph
+
+            agents = {}
+            for name, agent_cls in cls.NODES.items():
+                existing = cls._agents.get(name)
+                agents[name] = existing if type(existing) is agent_cls else agent_cls()
+
+            graph = cls.build_graph(agents)
+            cls._agents, cls._graph, cls._topology = agents, graph, topology
+            cls._subgraphs = {cls.ENTRY_POINT: graph}
+            logger.info("Graph compiled successfully!")
+            return graph
+
+    @classmethod
+    def reload(cls):
+        """
+        Forces a rebuild of the compiled graph, e.g. after editing ``NODES`` or ``EDGES``.
+        """
+        return cls.compile(force=True)
+
+    @classmethod
+    def get_graph(cls, entry_point: str = None):
+        """
+        Returns the shared compiled graph, compiling it on first use or if the
+        topology has changed.
+
+        Args:
+            entry_point (str, optional): Return the graph that starts at this stage
+                instead, e.g. to resume a run from intermediate results. Such
+                graphs are compiled on first use and reused.
+        """
+        graph = cls._graph
+        if graph is None or cls._topology != cls.topology():
+            graph = cls.compile()
+        if entry_point is None or entry_point == cls.ENTRY_POINT:
+            return graph
+
+        subgraphs = cls._subgraphs
+        if entry_point not in subgraphs:
+            if entry_point not in cls.NODES:
+                raise ValueError(f"Unknown pipeline stage: {entry_point}")
+            with cls._lock:
+                subgraphs[entry_point] = cls.build_graph(cls._agents, entry_point)
+        return subgraphs[entry_point]
+
+    @classmethod
+    def warm_up(cls):
+        """
+        Compiles the graph and loads everything the agents otherwise load on
+        first use: API clients, heavy libraries and models. Blocking; meant to
+        run in a background thread once the server is accepting requests.
+        """
+        start = time.perf_counter()
+        cls.get_graph()
+        warm_up_clients()
+        for name, agent in cls._agents.items():
+            if hasattr(agent, "warm_up"):
+                try:
+                    agent.warm_up()
+                except Exception:
+                    logger.exception("Warming up the %s agent failed", name)
+        logger.info("Warm-up finished in %.2fs", time.perf_counter() - start)
+
+    @classmethod
+    def get_agent(cls, name: str):
+        """
+        Returns the shared agent instance registered for the given node name.
+        """
+        cls.get_graph()
+        return cls._agents[name]
+
+    async def arun(
+        self,
+        user_form_submission: Dict[str, str],
+        on_stage: Callable[[str], None] = None,
+        on_partial: Callable[[str, dict], None] = None,
+        on_output: Callable[[str, dict], None] = None,
+        start_at: str = None,
+        state: dict = None,
+    ):
+        """
+        Runs the pipeline and returns the formatted itinerary.
+
+        Args:
+            user_form_submission (dict): The user's submitted preferences. Ignored
+                when resuming with ``start_at``.
+            on_stage (callable, optional): Called with the node name each time a
+                stage of the pipeline starts.
+            on_partial (callable, optional): Called with ``(key, item)`` for each
+                recommendation ("activity_recs" / "accomm_recs") or itinerary day
+                ("itinerary") as soon as it has been generated, and with
+                ``(key, None)`` when those reported so far under ``key`` are
+                replaced (see ``agents.progress.reset_partial``). Setting it
+                switches the LLM stages to streaming mode.
+            on_output (callable, optional): Called with ``(stage, output)`` when a
+                stage completes, and awaited if it returns an awaitable, e.g. to
+                checkpoint the output. ``output`` is a copy, since later stages
+                modify their input in place.
+            start_at (str, optional): Skip the stages before this one, resuming
+                from ``state``.
+            state (dict, optional): The output of the stage preceding ``start_at``.
+        """
+        entry_point = start_at or self.ENTRY_POINT
+        graph = self.get_graph(entry_point)
+        next_stages = dict(self.EDGES)
         # Run the graph
-        print("Running the graph with user form submission...", user_form_submission)
-        res = graph.invoke(user_form_submission)
-        print("Graph run successfully!")
+        logger.debug(
+            "Running the graph",
+            extra={"entry_point": entry_point, "payload": user_form_submission},
+        )
+        if on_stage:
+            on_stage(entry_point)
+        token = partial_results.set(on_partial)
+        try:
+            res = None
+            async for output in graph.astream(
+                state if start_at else user_form_submission
+            ):
+                ((stage, res),) = output.items()
+                if on_output:
+                    saved = on_output(stage, copy.deepcopy(res))
+                    if inspect.isawaitable(saved):
+                        await saved
+                if on_stage and stage in next_stages:
+                    on_stage(next_stages[stage])
+        finally:
+            partial_results.reset(token)
+        logger.debug("Graph run successfully!")
 
         return res
+
+    def run(self, user_form_submission: Dict[str, str]):
+        """
+        Synchronous entry point for scripts; runs ``arun`` on a fresh event loop.
+        Must not be called from inside a running event loop.
+        """
+        return asyncio.run(self.arun(user_form_submission))
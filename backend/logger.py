@@ -1,18 +1,166 @@
+"""
+Logging setup shared by the API and the job workers.
+
+Records are handed to a bounded in-memory queue and written by a background
+thread, so logging never blocks the event loop on disk or terminal I/O. When
+the queue is full, records are dropped and counted rather than waited on.
+
+Records are rendered as one JSON object per line (``LOG_FORMAT=text`` for
+human-readable lines) and carry the ``task_id`` and pipeline ``stage`` they
+were logged from. Extra fields passed with ``extra=`` are included, and long
+values are truncated to ``LOG_MAX_FIELD_CHARS``. The log file is rotated by
+size.
+"""
+
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import time
+
+from agents.telemetry import Counter, log_fields
 
-logger = logging.getLogger(__name__)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" or "text"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Empty to log to stdout only
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Longest message or field value written; payloads beyond it are cut short
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", 1000))
 
-formatter = logging.Formatter(
-    fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Attributes every LogRecord has; anything else was passed with ``extra=``
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+dropped_records = Counter(
+    "travelforge_log_records_dropped_total",
+    "Log records dropped because the log queue was full",
 )
 
-stream_handler = logging.StreamHandler(sys.stdout)
-file_handler = logging.FileHandler("app.log")
 
-stream_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
+def truncate(value, max_chars: int = LOG_MAX_FIELD_CHARS) -> str:
+    """
+    Renders a value as a string of at most ``max_chars`` characters.
+    """
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text) - max_chars} more chars)"
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the fields bound with ``agents.telemetry.bind_log_fields`` (task_id,
+    stage) to each record.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_fields.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records without waiting; records that do not fit are dropped.
+
+    Messages and extra fields are rendered and truncated here, so later
+    changes to logged objects do not affect the record and large payloads
+    are not held in the queue.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = truncate(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and not isinstance(
+                value, (int, float, bool, type(None))
+            ):
+                setattr(record, key, truncate(value))
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = {k: v for k, v in vars(record).items() if k not in STANDARD_ATTRIBUTES}
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+_listener = None
+
+
+def configure_logging():
+    """
+    Routes all loggers through the queue to stdout and the rotating log file.
+    Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(
+            logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+            )
+        )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    # Flush queued records on exit
+    atexit.register(_listener.stop)
 
-logger.handlers = [stream_handler, file_handler]
 
-logger.setLevel(logging.INFO)
+logger = logging.getLogger("travelforge")
@@ -1,28 +1,131 @@
+import asyncio
+import json
+import os
 import uuid
 
-from fastapi import FastAPI, BackgroundTasks
+from typing import Literal
+
+from fastapi import FastAPI, HTTPException, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+
+from agents.llm import cache_stats as llm_cache_stats
+from agents.mapper import cache_stats as geocode_cache_stats
+from agents.search import cache_stats as search_cache_stats
+from agents.telemetry import TRACING, render_metrics, spans
+from batches import BATCH_MAX_ITEMS, BatchRunner, batch_stats, batch_status
+from db.db import (
+    CANCELLED,
+    FAILED,
+    PENDING,
+    SUCCESS,
+    TERMINAL_STATES,
+    init_db,
+    retention_sweeper,
+    retry_task,
+    get_task,
+)
+from edits import EditConflict, change_num_days, regenerate_day, replace_activity
+from events import task_events
+from jobs import (
+    JOB_POLL_INTERVAL,
+    JOB_WORKERS,
+    TASK_ABANDON_AFTER,
+    WorkerPool,
+    admit,
+    cancel_job,
+    cancel_unwatched,
+    dedup_stats,
+    generate_itinerary_job,
+    heartbeat,
+    watch_cancellations,
+    watch_task,
+)
+from langgraph_agent import COMPACT_RESEARCH, TravelForgeAgent
+from logger import configure_logging, logger
+from middleware import CompressionMiddleware, RequestLoggingMiddleware
+from result_cache import result_cache
+from schemas import BatchRequest, ItineraryRequest, NumDaysChange
+from task_status import etag_matches, hot_tasks, task_status
 
-from db.db import init_db, store_task, get_task
-from langgraph_agent import TravelForgeAgent
-from middleware import log_requests
-from schemas import ItineraryRequest
+configure_logging()
 
 app = FastAPI()
 
+# Load API clients, libraries and models in the background at startup rather
+# than on the first request
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+# Responses of at least this many bytes are gzipped for clients that accept it
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+
 
 @app.on_event("startup")
 async def startup():
     """
     Event handler for FastAPI startup event.
-    Initializes the database when the application starts.
+    Initializes the database, starts the task event relay, the task retention
+    sweeper, the lease heartbeat, the canceller of tasks no client follows, the
+    in-process job workers and the batch runner, and warms up the agents in the
+    background so the server accepts requests without waiting for clients and
+    models to load.
     """
     init_db()
+    await task_events.start()
+    app.state.sweeper = asyncio.create_task(retention_sweeper())
+    app.state.cancellations = asyncio.create_task(watch_cancellations())
+    app.state.heartbeat = asyncio.create_task(heartbeat())
+    app.state.unwatched = None
+    if TASK_ABANDON_AFTER > 0:
+        app.state.unwatched = asyncio.create_task(cancel_unwatched())
+    app.state.warm_up = None
+    if WARM_UP:
+        app.state.warm_up = asyncio.create_task(
+            asyncio.to_thread(TravelForgeAgent.warm_up)
+        )
+    app.state.workers = None
+    if JOB_WORKERS > 0:
+        app.state.workers = WorkerPool(
+            generate_itinerary_job, JOB_WORKERS, JOB_POLL_INTERVAL
+        )
+        app.state.workers.start()
+    app.state.batches = BatchRunner()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Event handler for FastAPI shutdown event.
+    Stops the task retention sweeper, the canceller of tasks no client follows,
+    the in-process job workers, the batches running in this process and then
+    the lease heartbeat and the task event relay.
+    """
+    app.state.sweeper.cancel()
+    app.state.cancellations.cancel()
+    if app.state.unwatched:
+        app.state.unwatched.cancel()
+    if app.state.workers:
+        await app.state.workers.stop()
+    await app.state.batches.stop()
+    app.state.heartbeat.cancel()
+    await task_events.stop()
 
 
 # Middleware to log requests
-app.add_middleware(BaseHTTPMiddleware, dispatch=log_requests)
+app.add_middleware(RequestLoggingMiddleware)
+
+# Compress large responses, except the event stream
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=GZIP_MIN_SIZE,
+    compresslevel=GZIP_LEVEL,
+    exclude_prefixes=("/task-events/",),
+)
 
 # CORS middleware configuration
 app.add_middleware(
@@ -34,51 +137,394 @@ app.add_middleware(
 )
 
 
-async def generate_itinerary_background(task_id: str, user_form_submission: dict):
-    """
-    Background task to generate an itinerary.
-
-    Args:
-        task_id (str): The unique identifier for the task.
-        user_form_submission (dict): The user's submitted preferences.
-    """
-    tf = TravelForgeAgent()
-    result = tf.run(user_form_submission)
-    store_task(task_id, "SUCCESS", result)
-
-
 @app.post("/generate-itinerary")
 async def generate_itinerary(
-    request: ItineraryRequest, background_tasks: BackgroundTasks
+    request: ItineraryRequest, priority: Literal["high", "normal", "low"] = "normal"
 ):
     """
     API endpoint to generate an itinerary.
 
+    The request is queued for the job workers. When the queue is full for the
+    requested priority lane, responds with 429 and a Retry-After header.
+
     Args:
         request (ItineraryRequest): The request body containing user preferences.
-        background_tasks (BackgroundTasks): Background tasks manager.
+        priority (str): The priority lane of the job. Defaults to "normal".
 
     Returns:
         dict: Response containing the task ID and a message indicating progress.
     """
     task_id = str(uuid.uuid4())  # Generate a unique task ID
-    store_task(task_id, "PENDING")
-    background_tasks.add_task(
-        generate_itinerary_background, task_id, request.model_dump()
-    )
+    retry_after = await admit(task_id, request, priority, app.state.workers)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many itineraries in progress, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
     return {"task_id": task_id, "message": "Itinerary generation in progress"}
 
 
+@app.post("/tasks/{task_id}/cancel")
+async def cancel(task_id: str):
+    """
+    API endpoint to cancel a PENDING or RUNNING task.
+
+    The task's pipeline is aborted, along with its in-flight upstream calls,
+    unless an identical request attached to the task still needs it.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+
+    Returns:
+        dict: The task ID and its new state. Responds with 404 if the task does
+        not exist and 409 if it has already finished.
+    """
+    outcome = await cancel_job(task_id)
+    if outcome is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if outcome["state"] in TERMINAL_STATES:
+        raise HTTPException(status_code=409, detail=f"Task already {outcome['state']}")
+    return {"id": task_id, "state": CANCELLED}
+
+
+@app.post("/tasks/{task_id}/retry")
+async def retry(task_id: str):
+    """
+    API endpoint to run a FAILED task again.
+
+    The task's pipeline resumes after the last stage it completed before
+    failing, reusing that stage's output, unless its checkpoint has expired.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+
+    Returns:
+        dict: The task ID and its new state. Responds with 404 if the task does
+        not exist and 409 if it has not failed or can no longer be retried.
+    """
+    outcome = await asyncio.to_thread(retry_task, task_id)
+    if outcome is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if outcome["state"] != FAILED:
+        raise HTTPException(status_code=409, detail=f"Task is {outcome['state']}")
+    job = outcome["job"]
+    if job is None:
+        raise HTTPException(status_code=409, detail="Task can no longer be retried")
+    if job["batch_id"] is not None:
+        app.state.batches.retry(job["batch_id"], job["id"], job["payload"])
+    elif app.state.workers:
+        app.state.workers.notify()
+    return {"id": task_id, "state": PENDING}
+
+
+async def apply_edit(task_id: str, edit) -> dict:
+    """
+    Awaits an edit of a task's itinerary (see ``edits``), turning its failures
+    into HTTP errors.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        edit: The edit's coroutine, returning the task's new result.
+
+    Returns:
+        dict: The task ID, its state and its new result.
+    """
+    try:
+        result = await edit
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except EditConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.exception("Editing the itinerary failed")
+        raise HTTPException(status_code=502, detail="Editing the itinerary failed")
+    return {"id": task_id, "state": SUCCESS, "result": result}
+
+
+@app.post("/tasks/{task_id}/itinerary/days/{day}/regenerate")
+async def regenerate_itinerary_day(task_id: str, day: int):
+    """
+    API endpoint to plan one day of a finished itinerary again.
+
+    Only the itinerary generator runs, reusing the task's recommendations: the
+    day's activities are picked again from its current ones and those not
+    planned on other days.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        day (int): The day number.
+
+    Returns:
+        dict: The task ID, its state and its edited result. Responds with 404
+        if the task or day does not exist and 409 if the task cannot be edited.
+    """
+    return await apply_edit(task_id, regenerate_day(task_id, day))
+
+
+@app.post("/tasks/{task_id}/itinerary/days/{day}/activities/{position}/replace")
+async def replace_itinerary_activity(task_id: str, day: int, position: int):
+    """
+    API endpoint to replace one activity of a finished itinerary with one of
+    the task's recommendations not planned on any day.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        day (int): The day number.
+        position (int): The 1-based position of the activity within the day.
+
+    Returns:
+        dict: The task ID, its state and its edited result. Responds with 404
+        if the task, day or activity does not exist and 409 if the task cannot
+        be edited or no recommendations are left.
+    """
+    return await apply_edit(task_id, replace_activity(task_id, day, position))
+
+
+@app.post("/tasks/{task_id}/itinerary/num-days")
+async def change_itinerary_num_days(task_id: str, change: NumDaysChange):
+    """
+    API endpoint to plan a finished itinerary again over a different number of
+    days, reusing the task's recommendations.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        change (NumDaysChange): The new number of days.
+
+    Returns:
+        dict: The task ID, its state and its edited result. Responds with 404
+        if the task does not exist and 409 if it cannot be edited.
+    """
+    return await apply_edit(task_id, change_num_days(task_id, change.num_days))
+
+
+@app.post("/batches")
+async def submit_batch(batch: BatchRequest):
+    """
+    API endpoint to generate itineraries for many requests at once.
+
+    Requests for the same destination share their research searches; the
+    batch runs at most ``concurrency`` items at a time. Each item is a task
+    whose status can be checked like any other.
+
+    Args:
+        batch (BatchRequest): The requests and, optionally, the concurrency.
+
+    Returns:
+        dict: The batch ID and the task ID of each item, in submission order.
+    """
+    if len(batch.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batches are limited to {BATCH_MAX_ITEMS} requests",
+        )
+    return await app.state.batches.submit(batch.requests, batch.concurrency)
+
+
+@app.get("/batches/{batch_id}")
+async def get_batch_status(batch_id: str):
+    """
+    API endpoint to check the aggregate progress of a batch.
+
+    Args:
+        batch_id (str): The unique identifier for the batch.
+
+    Returns:
+        dict: Item counts by state, the fraction finished and each item's state,
+        or a not found message.
+    """
+    status = await asyncio.to_thread(batch_status, batch_id)
+    if status is None:
+        return {"state": "NOT_FOUND"}
+    return status
+
+
 @app.get("/task-status/{task_id}")
-async def get_task_status(task_id: str):
+async def get_task_status(task_id: str, request: Request):
     """
     API endpoint to check the status of a task.
 
+    Responses carry an ETag that changes whenever the task does; a request
+    whose If-None-Match matches it gets an empty 304 response. Polling an
+    unfinished task keeps it from being cancelled as abandoned once a client
+    has followed its event stream; tasks only ever polled are never cancelled
+    that way.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        request (Request): The incoming request, for its conditional headers.
+
+    Returns:
+        Response: Task details including state and result (and the 1-based
+        queue_position while PENDING), or a not found message.
+    """
+    task, etag = await asyncio.to_thread(task_status, task_id, False)
+    if task is None:
+        return {"state": "NOT_FOUND"}
+    if task["state"] not in TERMINAL_STATES:
+        await watch_task(task_id, arm=False)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    entry = hot_tasks.get(task_id, etag)
+    if entry is None:
+        task, etag = await asyncio.to_thread(task_status, task_id)
+        if task is None:
+            return {"state": "NOT_FOUND"}
+        headers["ETag"] = etag
+        entry = hot_tasks.put(task_id, etag, JSONResponse(task).body)
+    body = entry["body"]
+    if len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get(
+        "accept-encoding", ""
+    ):
+        body = hot_tasks.gzipped(entry, GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def task_event_stream(task_id: str, heartbeat: float = None):
+    """
+    Yields progress events for a task until it reaches a terminal state.
+
+    Tasks that have already finished (or do not exist) yield a single event
+    built from the task store. Following a task keeps it from being cancelled
+    as abandoned (see ``jobs.cancel_unwatched``).
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        heartbeat (float, optional): Yield None after this many idle seconds,
+            after checking the task store for a final state.
+    """
+    task = await asyncio.to_thread(get_task, task_id)
+    if task is None:
+        yield {"id": task_id, "state": "NOT_FOUND"}
+        return
+    if task["state"] in TERMINAL_STATES:
+        yield task
+        return
+    # Tasks attached to an identical in-flight request follow the leader's events
+    source_id = task["leader_id"] or task_id
+    await watch_task(task_id)
+    async for event in task_events.subscribe(source_id, heartbeat=heartbeat):
+        await watch_task(task_id)
+        if event is not None:
+            event = {**event, "id": task_id}
+        else:
+            # The task may be running in another worker process, whose events
+            # are only relayed here with the Redis backend; fall back to the
+            # task store when idle.
+            task = await asyncio.to_thread(get_task, task_id)
+            if task and task["state"] in TERMINAL_STATES:
+                yield task
+                return
+        yield event
+
+
+@app.get("/task-events/{task_id}")
+async def stream_task_events(task_id: str):
+    """
+    API endpoint that pushes task progress as Server-Sent Events.
+
+    Each event is a JSON object with the task "state" and, while running, the
+    pipeline "stage" in progress. Partial results arrive as a "partial" with
+    their "key" and "item"; a "partial" with "reset" instead means the items
+    received under its key so far are replaced by those that follow. The
+    stream ends after the final SUCCESS or FAILED event, which carries the
+    result or error.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+
+    Returns:
+        StreamingResponse: A text/event-stream response.
+    """
+
+    async def sse():
+        async for event in task_event_stream(task_id, heartbeat=15):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        sse(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.websocket("/ws/task-events/{task_id}")
+async def websocket_task_events(websocket: WebSocket, task_id: str):
+    """
+    WebSocket variant of /task-events: sends each progress event as a JSON
+    message and closes once the task reaches a terminal state.
+
+    Args:
+        websocket (WebSocket): The client connection.
+        task_id (str): The unique identifier for the task.
+    """
+    await websocket.accept()
+    async for event in task_event_stream(task_id, heartbeat=15):
+        if event is not None:
+            await websocket.send_json(event)
+    await websocket.close()
+
+
+@app.get("/cache-stats")
+async def get_cache_stats():
+    """
+    API endpoint to inspect the hit/miss counters of the agent caches.
+
+    Returns:
+        dict: Cache statistics keyed by cache name.
+    """
+    return {
+        "llm": llm_cache_stats(),
+        "search": search_cache_stats(),
+        "geocode": geocode_cache_stats(),
+        "inflight_dedup": dedup_stats,
+        "results": result_cache.stats() if result_cache is not None else None,
+        "hot_tasks": hot_tasks.stats(),
+        "batch_research": batch_stats,
+        "research_compaction": (
+            TravelForgeAgent.get_agent("compact").stats() if COMPACT_RESEARCH else None
+        ),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    API endpoint exposing the process's metrics in the Prometheus text format:
+    stage and upstream call durations, LLM token counts, upstream errors and
+    retries, queue wait and in-flight gauges.
+
+    Returns:
+        PlainTextResponse: The metrics.
+    """
+    return PlainTextResponse(
+        await asyncio.to_thread(render_metrics),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@app.get("/traces/{task_id}")
+async def get_trace(task_id: str):
+    """
+    API endpoint returning the spans recorded for a task when ``TRACING`` is
+    enabled: the job, each pipeline stage and each upstream call, linked by
+    "parent_span_id".
+
     Args:
         task_id (str): The unique identifier for the task.
 
     Returns:
-        dict: Task details including state and result, or a not found message.
+        dict: The task ID and its spans ordered by start time.
     """
-    task_result = get_task(task_id)
-    return task_result or {"state": "NOT_FOUND"}
+    if not TRACING:
+        raise HTTPException(status_code=404, detail="Tracing is disabled")
+    task_spans = spans.get(task_id)
+    if not task_spans:
+        raise HTTPException(status_code=404, detail="No trace recorded for this task")
+    return {"task_id": task_id, "spans": task_spans}
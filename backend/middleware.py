@@ -1,12 +1,82 @@
-from fastapi import Request
-from logger import logger
-
-
-async def log_requests(request, call_next):
-    logger.info(f"Request: {request.method} {request.url}")
-    try:
-        response = await call_next(request)
-    except Exception as e:
-        logger.error(f"Error: {e}")
-        raise e
-    return response
+"""
+Request logging and response compression middleware.
+
+Implemented directly against ASGI rather than with ``BaseHTTPMiddleware``, which
+runs every request through an extra task and memory stream and buffers
+streaming responses such as the Server-Sent Events endpoint.
+"""
+
+import logging
+import time
+
+from starlette.middleware.gzip import GZipMiddleware
+
+logger = logging.getLogger("travelforge.requests")
+
+
+class RequestLoggingMiddleware:
+    """
+    Logs one record per HTTP request once its response has been sent, with the
+    method, path, status code and duration in milliseconds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = None
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        except Exception:
+            logger.exception(
+                "Request failed",
+                extra={"method": scope["method"], "path": scope["path"]},
+            )
+            raise
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Request",
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                },
+            )
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    Gzips responses of at least ``minimum_size`` bytes for clients that accept
+    it. Responses that already set a Content-Encoding are passed through, and
+    requests under ``exclude_prefixes`` (the Server-Sent Events stream, whose
+    events must not sit in the compressor's buffer) are not compressed.
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = 1024,
+        compresslevel: int = 6,
+        exclude_prefixes: tuple = (),
+    ):
+        super().__init__(app, minimum_size=minimum_size, compresslevel=compresslevel)
+        self.exclude_prefixes = tuple(exclude_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.exclude_prefixes):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
@@ -0,0 +1,329 @@
+"""
+This module contains the completed-itinerary result cache.
+
+Finished itineraries are stored together with the pipeline state they were built
+from (research results and recommendations), keyed by the canonical request. A
+similarity policy decides how much of a stored entry a new request may reuse:
+the formatted itinerary itself, or only the output of the early stages, in
+which case the pipeline resumes after the last stage whose output is reused.
+"""
+
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+from agents.cache import CACHE_DIR, make_key
+from schemas import normalize_text
+
+RESULT_CACHE_PATH = os.getenv(
+    "RESULT_CACHE_PATH", os.path.join(CACHE_DIR, "results.sqlite3")
+)
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 24 * 60 * 60))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 500))
+# One of POLICIES, or "off" to disable the cache
+RESULT_CACHE_POLICY = os.getenv("RESULT_CACHE_POLICY", "near")
+# Largest difference in trip length for which recommendations are reused
+RESULT_CACHE_MAX_DAY_DELTA = int(os.getenv("RESULT_CACHE_MAX_DAY_DELTA", 1))
+
+# Reuse levels, from most to least work saved
+RESULT = "result"
+RECOMMENDATIONS = "recommendations"
+RESEARCH = "research"
+LEVELS = [RESULT, RECOMMENDATIONS, RESEARCH]
+
+# Last pipeline stage whose output is reused at each level
+COMPLETED_STAGE = {RECOMMENDATIONS: "recommend", RESEARCH: "research"}
+
+# Number of stored requests for the same location considered per lookup
+CANDIDATE_LIMIT = 20
+
+
+def location_parts(location: str) -> list:
+    """
+    Splits a location into its normalized comma-separated parts, the most
+    specific first, e.g. ["paris", "france"] for "Paris,  France".
+    """
+    parts = [normalize_text(part) for part in location.split(",")]
+    return parts[:1] + [part for part in parts[1:] if part]
+
+
+def location_key(location: str) -> str:
+    """
+    Reduces a location to its most specific part, e.g. "paris" for "Paris,
+    France". Entries are indexed by it; ``same_place`` decides whether two
+    locations with the same key name the same place.
+    """
+    return location_parts(location)[0]
+
+
+def place_key(location: str) -> str:
+    """
+    Returns the normalized form of a location, e.g. "paris, france".
+    """
+    return ", ".join(location_parts(location))
+
+
+def same_place(location: str, other: str) -> bool:
+    """
+    Tells whether two locations name the same place: their normalized parts
+    are equal, or one of them is unqualified and they share their most specific
+    part. "Paris" matches "paris, France", but "Paris, France" does not match
+    "Paris, Texas".
+    """
+    parts, other_parts = location_parts(location), location_parts(other)
+    if len(parts) == 1 or len(other_parts) == 1:
+        return parts[0] == other_parts[0]
+    return parts == other_parts
+
+
+class ExactMatchPolicy:
+    """
+    Reuses a stored result only for an identical canonical request.
+    """
+
+    def match(self, request: dict, cached: dict) -> str:
+        """
+        Decides how much of a stored entry can be reused for a request.
+
+        Args:
+            request (dict): The canonical request being served.
+            cached (dict): The canonical request the entry was built for.
+
+        Returns:
+            str: One of ``LEVELS``, or None if nothing can be reused.
+        """
+        return RESULT if request == cached else None
+
+
+class NearMatchPolicy(ExactMatchPolicy):
+    """
+    Reuses stored entries for requests that differ in ways the early stages do
+    not depend on.
+
+    Requests for the same place (see ``same_place``), season, budget and
+    accommodation type reuse:
+
+    - the result, when the interests, trip length and scheduler also match;
+    - the recommendations, when the interests match and the trip length differs
+      by at most ``max_day_delta`` days (or only the scheduler differs),
+      re-planning the days;
+    - the research, when the interests are a subset of the stored ones.
+    """
+
+    def __init__(self, max_day_delta: int = RESULT_CACHE_MAX_DAY_DELTA):
+        self.max_day_delta = max_day_delta
+
+    def match(self, request: dict, cached: dict) -> str:
+        if request == cached:
+            return RESULT
+        if not same_place(request["location"], cached["location"]):
+            return None
+        if any(
+            request[k] != cached[k] for k in ("time_range", "budget", "accomm_type")
+        ):
+            return None
+
+        if request["interests"] == cached["interests"]:
+            day_delta = abs(request["num_days"] - cached["num_days"])
+            if day_delta == 0 and request.get("scheduler") == cached.get("scheduler"):
+                return RESULT
+            if day_delta <= self.max_day_delta:
+                return RECOMMENDATIONS
+        if set(request["interests"]) <= set(cached["interests"]):
+            return RESEARCH
+        return None
+
+
+POLICIES = {"exact": ExactMatchPolicy, "near": NearMatchPolicy}
+
+
+class CacheMatch(NamedTuple):
+    """
+    A stored entry that can be reused for a request.
+    """
+
+    level: str
+    result: dict
+    state: dict
+
+    def resume(self, user_form_submission: dict) -> tuple:
+        """
+        Returns ``(stage, state)``: the last stage whose output this entry
+        provides for a new request, and that output. The pipeline resumes at
+        the stage after ``stage``.
+        """
+        # Copy, since the remaining stages modify their input in place
+        state = copy.deepcopy(self.state)
+        state["user_form_submission"] = user_form_submission
+        if self.level == RESEARCH:
+            state.pop("activity_recs", None)
+            state.pop("accomm_recs", None)
+        return COMPLETED_STAGE[self.level], state
+
+
+class ResultCache:
+    """
+    A persistent store of finished itineraries in a SQLite file.
+
+    Each entry holds the formatted result and the output of the "recommend"
+    stage. Entries expire ``ttl`` seconds after they were written; when the cache
+    holds more than ``max_entries`` items, the least recently used ones are
+    evicted. Callers report the outcome of each lookup with ``record`` so that
+    requests looked up more than once are only counted once.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, policy=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.policy = policy or NearMatchPolicy()
+        self.hits = dict.fromkeys(LEVELS, 0)
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS results
+               (key TEXT PRIMARY KEY, location TEXT, request TEXT, result TEXT,
+                state TEXT, created_at REAL, accessed_at REAL)"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_location ON results (location, accessed_at)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)"
+        )
+        self._conn.commit()
+
+    def lookup(self, request: dict, levels: list = LEVELS) -> CacheMatch:
+        """
+        Finds the stored entry that saves the most work for a request.
+
+        Args:
+            request (dict): The canonical request, see ``ItineraryRequest.canonical``.
+            levels (list, optional): The reuse levels acceptable to the caller.
+
+        Returns:
+            CacheMatch: The best match, or None if no entry can be reused.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = self._conn.execute(
+                """SELECT key, request FROM results
+                   WHERE location = ? AND created_at >= ?
+                   ORDER BY accessed_at DESC LIMIT ?""",
+                (location_key(request["location"]), now - self.ttl, CANDIDATE_LIMIT),
+            ).fetchall()
+            best = None
+            for key, cached in candidates:
+                level = self.policy.match(request, json.loads(cached))
+                if level in levels and (
+                    best is None or LEVELS.index(level) < LEVELS.index(best[1])
+                ):
+                    best = key, level
+            if best is None:
+                return None
+
+            key, level = best
+            result, state = self._conn.execute(
+                "SELECT result, state FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "UPDATE results SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+        return CacheMatch(level, json.loads(result), json.loads(state))
+
+    def store(self, request: dict, result: dict, state: dict):
+        """
+        Stores a finished itinerary and evicts expired and least recently used entries.
+
+        Args:
+            request (dict): The canonical request.
+            result (dict): The formatted itinerary.
+            state (dict): The output of the "recommend" stage.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    make_key(request),
+                    location_key(request["location"]),
+                    json.dumps(request),
+                    json.dumps(result),
+                    json.dumps(state),
+                    now,
+                    now,
+                ),
+            )
+            self._conn.execute(
+                "DELETE FROM results WHERE created_at < ?", (now - self.ttl,)
+            )
+            self._conn.execute(
+                """DELETE FROM results WHERE key IN
+                   (SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    async def alookup(self, request: dict, levels: list = LEVELS) -> CacheMatch:
+        return await asyncio.to_thread(self.lookup, request, levels)
+
+    async def astore(self, request: dict, result: dict, state: dict):
+        await asyncio.to_thread(self.store, request, result, state)
+
+    def record(self, level: str):
+        """
+        Counts the outcome of a lookup: a reuse level, or None for a miss.
+        """
+        if level is None:
+            self.misses += 1
+        else:
+            self.hits[level] += 1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM results")
+            self._conn.commit()
+        self.hits = dict.fromkeys(LEVELS, 0)
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        Returns hit counters per reuse level, hit ratios and the current size.
+        """
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "result_hit_rate": self.hits[RESULT] / lookups if lookups else 0.0,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "policy": type(self.policy).__name__,
+        }
+
+
+result_cache = (
+    ResultCache(
+        RESULT_CACHE_PATH,
+        ttl=RESULT_CACHE_TTL,
+        max_entries=RESULT_CACHE_MAX_ENTRIES,
+        policy=POLICIES[RESULT_CACHE_POLICY](),
+    )
+    if RESULT_CACHE_POLICY != "off"
+    else None
+)
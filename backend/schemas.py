@@ -1,4 +1,15 @@
-from pydantic import BaseModel
+import hashlib
+import json
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+def normalize_text(value: str) -> str:
+    """
+    Case-folds a string and collapses runs of whitespace.
+    """
+    return " ".join(value.casefold().split())
 
 
 class ItineraryRequest(BaseModel):
@@ -8,3 +19,38 @@ class ItineraryRequest(BaseModel):
     accomm_type: str
     num_days: int
     interests: list[str]
+    # How to split activities into days, see agents.itinerary_generator;
+    # None uses the server default
+    scheduler: Optional[Literal["llm", "local", "auto"]] = None
+
+    def canonical(self) -> dict:
+        """
+        Returns the request with case, whitespace and interest order normalized,
+        so that equivalent submissions compare equal.
+        """
+        return {
+            "location": normalize_text(self.location),
+            "time_range": normalize_text(self.time_range),
+            "budget": normalize_text(self.budget),
+            "accomm_type": normalize_text(self.accomm_type),
+            "num_days": self.num_days,
+            "interests": sorted({normalize_text(i) for i in self.interests}),
+            "scheduler": self.scheduler,
+        }
+
+    def fingerprint(self) -> str:
+        """
+        Returns a stable hash of the canonical request.
+        """
+        payload = json.dumps(self.canonical(), sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class BatchRequest(BaseModel):
+    requests: list[ItineraryRequest] = Field(min_length=1)
+    # Number of items run at once; None uses the server default
+    concurrency: Optional[int] = Field(None, ge=1)
+
+
+class NumDaysChange(BaseModel):
+    num_days: int = Field(ge=1)
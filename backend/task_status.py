@@ -0,0 +1,129 @@
+"""
+Task status lookups for the polling endpoint.
+
+A status response changes only when the task (or, for a task attached to an
+identical in-flight request, its leader) is written, or when its position in
+the job queue moves. Both are cheap to read, so the endpoint reads them first
+and derives an ETag from them: clients that send it back in If-None-Match get
+a 304 without the result being read, and repeated polls without it are served
+from an in-memory cache of rendered responses keyed by the same ETag.
+"""
+
+import gzip
+import os
+import threading
+from collections import OrderedDict
+
+from db.db import (
+    CANCELLED,
+    PENDING,
+    RUNNING,
+    TERMINAL_STATES,
+    get_task,
+    queue_position,
+)
+
+# Number of tasks whose rendered status response is kept in memory
+HOT_TASK_CACHE_SIZE = int(os.getenv("HOT_TASK_CACHE_SIZE", 256))
+
+
+def task_status(task_id: str, include_result: bool = True) -> tuple:
+    """
+    Reads a task as reported by the status endpoint.
+
+    Args:
+        task_id (str): The unique identifier for the task.
+        include_result (bool, optional): Read and decode the result. Defaults to True.
+
+    Returns:
+        tuple: ``(task, etag)``: the task details (with the 1-based
+        queue_position while PENDING) and their ETag, or ``(None, None)`` if
+        the task is not found.
+    """
+    task = get_task(task_id, include_result)
+    if task is None:
+        return None, None
+    # Tasks attached to an identical in-flight request report the leader's progress
+    leader = task
+    if task["leader_id"] and task["state"] not in TERMINAL_STATES:
+        leader = get_task(task["leader_id"], include_result=False) or task
+        # A cancelled leader's pipeline keeps running for its followers
+        task["state"] = RUNNING if leader["state"] == CANCELLED else leader["state"]
+    position = 0
+    if task["state"] == PENDING:
+        task["queue_position"] = queue_position(leader["id"])
+        position = task["queue_position"] or 0
+    etag = f'W/"{task["version"]}.{leader["version"]}.{position}"'
+    return task, etag
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against an ETag, using the weak comparison
+    that conditional GETs call for.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == opaque
+        for candidate in if_none_match.split(",")
+    )
+
+
+class HotTaskCache:
+    """
+    A bounded LRU cache of rendered status responses, one per task, keyed by
+    the ETag they were rendered for. A gzipped copy of each body is made on
+    first request by a client that accepts it and kept alongside.
+    """
+
+    def __init__(self, max_tasks: int = HOT_TASK_CACHE_SIZE):
+        self.max_tasks = max_tasks
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task_id: str, etag: str) -> dict:
+        """
+        Returns the cached entry for the task, a dict with the rendered "body"
+        and, once made, its "gzip" copy, or None if it was rendered for
+        another ETag or is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry["etag"] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(task_id)
+            self.hits += 1
+            return entry
+
+    def put(self, task_id: str, etag: str, body: bytes) -> dict:
+        entry = {"etag": etag, "body": body, "gzip": None}
+        if self.max_tasks <= 0:
+            return entry
+        with self._lock:
+            self._entries[task_id] = entry
+            self._entries.move_to_end(task_id)
+            while len(self._entries) > self.max_tasks:
+                self._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def gzipped(entry: dict, compresslevel: int) -> bytes:
+        """
+        Returns the entry's body gzipped, compressing it on first use.
+        """
+        if entry["gzip"] is None:
+            entry["gzip"] = gzip.compress(entry["body"], compresslevel)
+        return entry["gzip"]
+
+    def stats(self) -> dict:
+        return {"tasks": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+hot_tasks = HotTaskCache()
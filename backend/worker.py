@@ -0,0 +1,61 @@
+"""
+Standalone job worker process.
+
+Claims queued itinerary jobs from the shared task store and runs them, so that
+pipelines can be executed outside the web process. Run from the backend
+directory (set JOB_WORKERS=0 on the web process to run jobs only here):
+
+    python worker.py
+
+With TASKS_BACKEND=redis, workers can run on any host that can reach
+REDIS_URL, and their progress events reach clients of every web process.
+
+Set WORKER_METRICS_PORT to expose the worker's Prometheus metrics.
+"""
+
+import asyncio
+import os
+
+from agents.telemetry import serve_metrics
+from db.db import init_db, retention_sweeper
+from events import task_events
+from jobs import (
+    JOB_POLL_INTERVAL,
+    JOB_WORKERS,
+    WorkerPool,
+    generate_itinerary_job,
+    heartbeat,
+    watch_cancellations,
+)
+from langgraph_agent import TravelForgeAgent
+from logger import configure_logging, logger
+
+
+async def main():
+    configure_logging()
+    init_db()
+    await task_events.start()
+    TravelForgeAgent.warm_up()
+    workers = WorkerPool(generate_itinerary_job, max(JOB_WORKERS, 1), JOB_POLL_INTERVAL)
+    workers.start()
+    logger.info("Worker started with %d concurrent jobs", workers.concurrency)
+    metrics_server = None
+    if os.getenv("WORKER_METRICS_PORT"):
+        metrics_server = await serve_metrics(int(os.getenv("WORKER_METRICS_PORT")))
+    sweeper = asyncio.create_task(retention_sweeper())
+    cancellations = asyncio.create_task(watch_cancellations())
+    leases = asyncio.create_task(heartbeat())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        sweeper.cancel()
+        cancellations.cancel()
+        if metrics_server:
+            metrics_server.close()
+        await workers.stop()
+        leases.cancel()
+        await task_events.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,9 +2,17 @@ import { useState, useEffect } from "react";
 import axios from "axios";
 import { ApiResponse } from "types";
 
+const API_URL = "http://127.0.0.1:8000";
+const IN_PROGRESS_STATES = ["PENDING", "RUNNING"];
+
 /**
  * Custom hook to fetch task results from the API.
  *
+ * Subscribes to the task's Server-Sent Events stream so the result arrives as
+ * soon as it is ready, and falls back to polling if the stream is unavailable.
+ * Once the page is closed and no client follows the task any more, the server
+ * cancels it (see TASK_ABANDON_AFTER), so reloads do not cancel it.
+ *
  * @param {string | undefined} taskId - The ID of the task to fetch results for
  * @returns {{ loading: boolean, result: ApiResponse | null, error: string | null }}
  *          An object containing the loading state, result data, and any error message
@@ -21,6 +29,9 @@ const useTaskResults = (taskId: string | undefined) => {
       return;
     }
 
+    let cancelled = false;
+    let pollTimeout: ReturnType<typeof setTimeout> | undefined;
+
     /**
      * Fetches the task results from the API.
      * Implements a polling mechanism for pending tasks.
@@ -28,18 +39,20 @@ const useTaskResults = (taskId: string | undefined) => {
     const fetchResults = async () => {
       try {
         const response = await axios.get<ApiResponse>(
-          `http://127.0.0.1:8000/task-status/${taskId}`
+          `${API_URL}/task-status/${taskId}`
         );
+        if (cancelled) return;
 
         if (response.data.state === "SUCCESS") {
           setResult(response.data);
           setLoading(false);
-        } else if (response.data.state === "PENDING") {
-          setTimeout(fetchResults, 2000); // Retry after 2 seconds
+        } else if (IN_PROGRESS_STATES.includes(response.data.state)) {
+          pollTimeout = setTimeout(fetchResults, 2000); // Retry after 2 seconds
         } else {
           throw new Error("Task failed or not found");
         }
       } catch (error) {
+        if (cancelled) return;
         if (axios.isAxiosError(error)) {
           setError(`Network error: ${error.message}`);
         } else if (error instanceof Error) {
@@ -51,7 +64,40 @@ const useTaskResults = (taskId: string | undefined) => {
       }
     };
 
-    fetchResults();
+    if (typeof EventSource === "undefined") {
+      fetchResults();
+      return () => {
+        cancelled = true;
+        clearTimeout(pollTimeout);
+      };
+    }
+
+    const events = new EventSource(`${API_URL}/task-events/${taskId}`);
+
+    events.onmessage = (message) => {
+      const data: ApiResponse = JSON.parse(message.data);
+      if (data.state === "SUCCESS") {
+        events.close();
+        setResult(data);
+        setLoading(false);
+      } else if (!IN_PROGRESS_STATES.includes(data.state)) {
+        events.close();
+        setError("Task failed or not found");
+        setLoading(false);
+      }
+    };
+
+    // Fall back to polling if the stream cannot be established or drops
+    events.onerror = () => {
+      events.close();
+      if (!cancelled) fetchResults();
+    };
+
+    return () => {
+      cancelled = true;
+      events.close();
+      clearTimeout(pollTimeout);
+    };
   }, [taskId]);
 
   return { loading, result, error };